@@ -9,6 +9,42 @@ MAX_RUN_TIME = 60 * 60 * 12
 BACKGROUND_TASK_RUN_ASYNC = True
 BACKGROUND_TASK_ASYNC_THREADS = 100 # DEFAULT: multiprocessing.cpu_count()
 BACKGROUND_TASK_PRIORITY_ORDERING = 'DESC'
+# Base priority of each type of task. Each task pending for the same campaign lowers it by one, so that
+# campaigns share the task runners fairly
+SCHEDULER_PRIORITIES = {
+    'metric': 3000,
+    'metric-bulk': 2000,
+    'operation': 1000,
+}
+# Max tasks of each type running at once in all the task runner processes
+SCHEDULER_CONCURRENCY = {
+    'metric': BACKGROUND_TASK_ASYNC_THREADS,
+    'metric-bulk': 2,
+    'operation': 50,
+}
+# Seconds after which a task finding no free slot of its type is run again
+SCHEDULER_CAPPED_DELAY = 10
+# Metrics on more users + tweets than this are scheduled as 'metric-bulk'
+SCHEDULER_BULK_METRIC_TARGET = 1000
+# Worker processes computing metrics, apart from the task threads (0 = compute in the task thread)
+METRICS_PROCESS_POOL_SIZE = os.cpu_count()
+# Max metrics computed at once for each task queue (defaults to METRICS_PROCESS_POOL_SIZE)
+METRICS_QUEUE_CONCURRENCY = {
+    'metrics-computation': os.cpu_count(),
+}
+# Processes comparing the activity sequences of users in MetricActivityPattern (1 = in the metric process)
+ACTIVITY_PATTERN_PROCESSES = 1
+# Threads computing the metrics of a batch at once (not used with sqlite, which does not support concurrent writes)
+METRIC_BATCH_THREADS = 4
+# Max keep-alive connections kept open towards the Twitter API by each cached client
+TWITTER_API_POOL_MAXSIZE = 10
+# Seconds django.setup() may take in a new process, checked by the benchmark_startup command
+STARTUP_TIME_BUDGET = 1.0
+# Modules defining metrics outside of twitter.models, loaded at startup (see also the tafferugli.metrics entry points)
+METRIC_MODULES = []
+# If set (e.g. 'http://127.0.0.1:8765'), Twitter API and streaming requests are sent to the fake server started
+# with `manage.py fake_twitter_api` instead of Twitter, to run benchmarks without network nor credentials
+TWITTER_FAKE_API_URL = None
 # If true application will proxy twitter users' profile images, storing them
 PROXY_IMAGES = True
 # Redirect user here when not authenticated
@@ -64,8 +100,26 @@ ROOT_URLCONF = 'tafferugli.urls'
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # statuses and users retrieved from Twitter, shared by all the background workers
+    'twitter-api': {
+        'BACKEND': 'twitter.api_cache.CulledFileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'twitter-api'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            # writes between two culls (each lists the whole directory)
+            'CULL_INTERVAL': 1000
+        }
     }
 }
+# Cache used for status and user lookups by id and number of seconds they are considered fresh
+TWITTER_API_CACHE = 'twitter-api'
+TWITTER_API_CACHE_TTL = 60 * 60
+# Directory of the columnar snapshots of the metric targets (None: metrics read their targets from the database),
+# with the seconds after which a snapshot is taken again and the max bytes taken by all of them
+TARGET_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'cache', 'snapshots')
+TARGET_SNAPSHOT_MAX_AGE = 60 * 60
+TARGET_SNAPSHOT_MAX_SIZE = 2 * 1024 ** 3
 
 LOGGING = {
     'version': 1,
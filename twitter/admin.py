@@ -1,12 +1,14 @@
 from django.contrib import admin
 from .models import *
-from twitter.models.operations import OperationConstructNetwork
+from twitter.models.operations import OperationConstructNetwork, OperationRetrieveTweets, OperationHydrateUsers
 
 admin.site.register(TwitterAccount)
 admin.site.register(Entity)
 admin.site.register(Campaign)
 admin.site.register(TwitterUser)
 admin.site.register(Operation)
+admin.site.register(OperationChunk)
+admin.site.register(ScheduledTask)
 admin.site.register(Location)
 admin.site.register(Hashtag)
 admin.site.register(Community)
@@ -28,5 +30,7 @@ admin.site.register(MetricUsernameWithRegex)
 admin.site.register(MetricGraphTweetNetwork)
 admin.site.register(MetricTweetTimeDistribution)
 admin.site.register(OperationConstructNetwork)
+admin.site.register(OperationRetrieveTweets)
+admin.site.register(OperationHydrateUsers)
 admin.site.register(MetricGraphCommunityNetwork)
 admin.site.register(MetricActivityPattern)
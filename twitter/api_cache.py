@@ -0,0 +1,106 @@
+"""
+Read-through cache for the lookups by id of statuses and users.
+Raw json payloads are kept in the TWITTER_API_CACHE cache (on disk, so that all the background workers share it)
+for TWITTER_API_CACHE_TTL seconds and are turned back into tweepy models on a hit.
+The cache is also populated from the ingested statuses and from the users hydrated with users/lookup.
+"""
+import itertools
+import logging
+import tweepy
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+
+logger = logging.getLogger(__name__)
+
+
+class CulledFileBasedCache(FileBasedCache):
+    """
+    FileBasedCache culled once every CULL_INTERVAL writes of the process (OPTIONS, default 1000) instead of on every
+    write, since each cull lists the whole cache directory. Between two culls the cache can exceed MAX_ENTRIES by the
+    writes made in the meantime.
+    """
+    _writes = itertools.count()
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._cull_interval = max(1, int(params.get('OPTIONS', {}).get('CULL_INTERVAL', 1000)))
+
+    def _cull(self):
+        if next(self._writes) % self._cull_interval == 0:
+            super()._cull()
+
+
+def _cache():
+    return caches[settings.TWITTER_API_CACHE]
+
+
+def _status_key(id_str):
+    return 'status:%s' % id_str
+
+
+def _user_key(id_str):
+    return 'user:%s' % id_str
+
+
+def _screen_name_key(screen_name):
+    return 'user:@%s' % screen_name.lower()
+
+
+def _user_entries(status_user):
+    json = getattr(status_user, '_json', None)
+    if not json:
+        return {}
+    return {_user_key(status_user.id_str): json, _screen_name_key(status_user.screen_name): json}
+
+
+def remember_users(status_users):
+    """ Stores tweepy users in a single write, so that they can be looked up both by id and by screen name """
+    entries = {}
+    for status_user in status_users:
+        entries.update(_user_entries(status_user))
+    if entries:
+        _cache().set_many(entries, timeout=settings.TWITTER_API_CACHE_TTL)
+
+
+def remember_user(status_user):
+    """ Stores a tweepy user, so that it can be looked up both by id and by screen name """
+    remember_users([status_user])
+
+
+def remember_status(status):
+    """ Stores a tweepy status together with its author (the json embeds it, but it is looked up on its own too) """
+    json = getattr(status, '_json', None)
+    if not json:
+        return
+    entries = {_status_key(status.id_str): json}
+    if hasattr(status, 'user'):
+        entries.update(_user_entries(status.user))
+    _cache().set_many(entries, timeout=settings.TWITTER_API_CACHE_TTL)
+
+
+def get_status(api, id_str):
+    """ Like api.get_status(id_str), without contacting Twitter if the status was seen within the ttl """
+    json = _cache().get(_status_key(id_str))
+    if json is not None:
+        logger.debug('Status %s found in api cache' % id_str)
+        return tweepy.models.Status.parse(api, json)
+    status = api.get_status(id_str)
+    remember_status(status)
+    return status
+
+
+def get_user(api, id_str=None, screen_name=None):
+    """ Like api.get_user, by id or by screen name, without contacting Twitter if the user was seen within the ttl """
+    key = _user_key(id_str) if id_str is not None else _screen_name_key(screen_name)
+    json = _cache().get(key)
+    if json is not None:
+        logger.debug('User %s found in api cache' % (id_str or screen_name))
+        return tweepy.models.User.parse(api, json)
+    if id_str is not None:
+        status_user = api.get_user(user_id=id_str)
+    else:
+        status_user = api.get_user(screen_name=screen_name)
+    remember_user(status_user)
+    return status_user
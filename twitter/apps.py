@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TwitterConfig(AppConfig):
     name = 'twitter'
+
+    def ready(self):
+        from twitter import registry
+        registry.load()
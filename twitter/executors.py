@@ -0,0 +1,182 @@
+"""
+Process pool running the CPU-bound part of the metrics (their _computation), so that graph algorithms and text
+comparisons do not hold the GIL of the process running streamers and operations threads.
+"""
+import logging
+import multiprocessing
+import sys
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+_semaphores = {}
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _reset_peak_memory():
+    """ Resets the peak resident memory of the process (Linux only), returns False if it cannot be reset """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_memory():
+    """ Peak resident memory of the process in bytes, since it was last reset or since the process started """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def record_peak_memory(*metrics):
+    """
+    Sets the peak_memory of the metrics to the peak resident memory of the process while running the block.
+    Computations running at the same time in other threads of the process are included in the figure, as well as
+    everything allocated before the block where the peak cannot be reset
+    """
+    if not _reset_peak_memory():
+        logger.debug('Cannot reset the peak memory, recording the peak of the process')
+    try:
+        yield
+    finally:
+        peak = get_peak_memory()
+        for metric in metrics:
+            metric.peak_memory = peak
+
+
+def _run_computation(metric, since):
+    with record_peak_memory(metric):
+        if since is not None:
+            return metric._refresh_computation(since)
+        return metric._computation()
+
+
+def _compute_metric(metric_id, since=None):
+    from django.db import connections
+    from twitter.models import Metric
+    try:
+        metric = Metric.objects.get_subclass(pk=metric_id)
+        result = _run_computation(metric, since)
+        # computations may leave their results on the instance, relying on the caller to save it
+        metric.save()
+        return result
+    finally:
+        connections.close_all()
+
+
+def _compute_metric_batch(metric_ids):
+    from django.db import connections
+    from twitter.models import MetricBatch
+    try:
+        return MetricBatch.get(metric_ids)._computation()
+    finally:
+        connections.close_all()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process running many threads and open db connections is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.METRICS_PROCESS_POOL_SIZE, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker)
+        return _pool
+
+
+def _reset_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+
+
+def _get_semaphore(queue):
+    with _pool_lock:
+        if queue not in _semaphores:
+            limit = settings.METRICS_QUEUE_CONCURRENCY.get(queue, settings.METRICS_PROCESS_POOL_SIZE)
+            _semaphores[queue] = threading.BoundedSemaphore(limit)
+        return _semaphores[queue]
+
+
+@contextmanager
+def _queue_slot(queue):
+    """
+    Holds a slot of the queue while running the block. Capped tasks finding no free slot raise scheduler.CapReached
+    and are enqueued again, instead of holding their task runner thread; other callers wait for a slot
+    """
+    from twitter import scheduler
+    semaphore = _get_semaphore(queue)
+    if not semaphore.acquire(blocking=not scheduler.can_reschedule()):
+        raise scheduler.CapReached('No free slot in metrics queue %s' % queue)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def run_metric_computation(metric, queue='metrics-computation', since=None):
+    """
+    Runs metric._computation() in a worker process and returns its result.
+    With since, runs metric._refresh_computation(since) instead, processing only the newer tweets.
+    At most METRICS_QUEUE_CONCURRENCY[queue] computations of the same queue run at once (see _queue_slot).
+    The metric is reloaded afterwards, as the worker saved its results.
+    If METRICS_PROCESS_POOL_SIZE is 0 the computation runs in the calling thread
+    """
+    if not settings.METRICS_PROCESS_POOL_SIZE:
+        return _run_computation(metric, since)
+    with _queue_slot(queue):
+        pool = _get_pool()
+        try:
+            result = pool.submit(_compute_metric, metric.id, since).result()
+        except BrokenProcessPool:
+            logger.error('Metrics worker process died while computing metric %d' % metric.id)
+            _reset_pool(pool)
+            raise
+    metric.refresh_from_db()
+    return result
+
+
+def run_metric_batch_computation(batch, queue='metrics-computation'):
+    """
+    Like run_metric_computation for the metrics of a MetricBatch, computed by the same worker process.
+    Returns a dictionary metric id -> result of the computation
+    """
+    if not settings.METRICS_PROCESS_POOL_SIZE:
+        return batch._computation()
+    with _queue_slot(queue):
+        pool = _get_pool()
+        try:
+            results = pool.submit(_compute_metric_batch, [m.id for m in batch.metrics]).result()
+        except BrokenProcessPool:
+            logger.error('Metrics worker process died while computing metrics %s' % [m.id for m in batch.metrics])
+            _reset_pool(pool)
+            raise
+    for metric in batch.metrics:
+        metric.refresh_from_db()
+    return results
@@ -0,0 +1,399 @@
+"""
+Local stand-in for the Twitter API, used to run benchmarks and integration tests without network nor credentials.
+It serves the streaming filter endpoint, emitting synthetic (or replayed) statuses at a configurable rate, and the
+REST endpoints used by the application (followers/friends ids, user timelines, statuses/show, users/show and
+users/lookup) with simulated per-token rate limits.
+Synthetic data is deterministic: the same ids always get the same profiles, followers and timelines.
+Run it with `manage.py fake_twitter_api` and set TWITTER_FAKE_API_URL to point the application clients at it.
+"""
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Twitter epoch, used to build snowflake status ids
+TWEPOCH_MS = 1288834974657
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+IDS_PAGE_SIZE = 5000
+# requests per window allowed by Twitter for each endpoint
+RATE_LIMITS = {
+    'followers/ids': 15,
+    'friends/ids': 15,
+    'statuses/user_timeline': 900,
+    'statuses/show': 900,
+    'users/show': 900,
+    'users/lookup': 900,
+}
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+
+
+def snowflake(timestamp, sequence=0):
+    return ((int(timestamp * 1000) - TWEPOCH_MS) << 22) | (sequence & 0xfff)
+
+
+def snowflake_timestamp(status_id):
+    return ((status_id >> 22) + TWEPOCH_MS) / 1000
+
+
+class FakeTwitterData(object):
+    """ Deterministic generator of users, relations and statuses """
+
+    def __init__(self, population=100000, followers=200, friends=200, timeline=50, reply_ratio=0.3,
+                 mention_ratio=0.3, unresolvable_ratio=0.01, seed=0):
+        self.population = population
+        self.followers = followers
+        self.friends = friends
+        self.timeline = timeline
+        self.reply_ratio = reply_ratio
+        self.mention_ratio = mention_ratio
+        self.unresolvable_ratio = unresolvable_ratio
+        self.seed = seed
+        self.sequence = itertools.count()
+
+    def _random(self, *key):
+        return random.Random('%d-%s' % (self.seed, '-'.join(str(k) for k in key)))
+
+    def random_user_id(self, rnd):
+        return rnd.randint(1, self.population)
+
+    def exists(self, user_id):
+        return self._random('exists', user_id).random() >= self.unresolvable_ratio
+
+    def user(self, user_id):
+        rnd = self._random('user', user_id)
+        created = time.time() - rnd.randint(30, 4000) * 86400
+        return {
+            'id': user_id,
+            'id_str': str(user_id),
+            'name': 'User %d' % user_id,
+            'screen_name': 'user%d' % user_id,
+            'location': rnd.choice([None, 'Roma', 'Milano', 'Napoli', 'Torino']),
+            'url': None,
+            'description': ' '.join(rnd.choice(WORDS) for _ in range(8)),
+            'protected': False,
+            'verified': rnd.random() < 0.01,
+            'followers_count': rnd.randint(0, 2 * self.followers),
+            'friends_count': rnd.randint(0, 2 * self.friends),
+            'listed_count': rnd.randint(0, 10),
+            'favourites_count': rnd.randint(0, 5000),
+            'statuses_count': rnd.randint(0, 20000),
+            'created_at': time.strftime(TWITTER_DATE_FORMAT, time.gmtime(created)),
+            'profile_image_url_https': 'https://pbs.twimg.com/profile_images/%d/default_normal.png' % user_id,
+            'default_profile': rnd.random() < 0.3,
+            'default_profile_image': rnd.random() < 0.1,
+        }
+
+    def relation(self, kind, user_id):
+        rnd = self._random(kind, user_id)
+        mean = self.followers if kind == 'followers' else self.friends
+        return [self.random_user_id(rnd) for _ in range(rnd.randint(0, 2 * mean))]
+
+    def status(self, status_id, user_id=None, track=None, reply=True):
+        rnd = self._random('status', status_id)
+        if user_id is None:
+            user_id = self.random_user_id(rnd)
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(5, 15))]
+        hashtags = []
+        mentions = []
+        if track:
+            term = rnd.choice(track)
+            words.insert(rnd.randint(0, len(words)), term)
+            if term.startswith('#'):
+                hashtags.append({'text': term[1:], 'indices': [0, 0]})
+        if rnd.random() < self.mention_ratio:
+            mentioned = self.random_user_id(rnd)
+            mentions.append({'id': mentioned, 'id_str': str(mentioned), 'screen_name': 'user%d' % mentioned,
+                             'name': 'User %d' % mentioned, 'indices': [0, 0]})
+            words.insert(0, '@user%d' % mentioned)
+        in_reply_to = None
+        if reply and rnd.random() < self.reply_ratio:
+            # parents are older statuses, which are served by statuses/show
+            in_reply_to = snowflake(snowflake_timestamp(status_id) - rnd.randint(1, 86400), rnd.randint(0, 4095))
+        in_reply_to_user = self.random_user_id(self._random('status', in_reply_to)) if in_reply_to else None
+        return {
+            'id': status_id,
+            'id_str': str(status_id),
+            'created_at': time.strftime(TWITTER_DATE_FORMAT, time.gmtime(snowflake_timestamp(status_id))),
+            'text': ' '.join(words),
+            'source': '<a href="https://example.org/fake" rel="nofollow">Fake client</a>',
+            'truncated': False,
+            'in_reply_to_status_id': in_reply_to,
+            'in_reply_to_status_id_str': str(in_reply_to) if in_reply_to else None,
+            'in_reply_to_user_id': in_reply_to_user,
+            'in_reply_to_user_id_str': str(in_reply_to_user) if in_reply_to_user else None,
+            'in_reply_to_screen_name': 'user%d' % in_reply_to_user if in_reply_to_user else None,
+            'user': self.user(user_id),
+            'coordinates': None,
+            'place': None,
+            'quote_count': 0,
+            'reply_count': rnd.randint(0, 10),
+            'retweet_count': rnd.randint(0, 100),
+            'favorite_count': rnd.randint(0, 100),
+            'entities': {'hashtags': hashtags, 'urls': [], 'user_mentions': mentions, 'symbols': []},
+            'lang': 'it',
+        }
+
+    def new_status(self, track=None):
+        return self.status(snowflake(time.time(), next(self.sequence)), track=track)
+
+    def timeline_ids(self, user_id):
+        rnd = self._random('timeline', user_id)
+        now = time.time()
+        return sorted([snowflake(now - rnd.randint(0, 365 * 86400), rnd.randint(0, 4095))
+                       for _ in range(rnd.randint(0, 2 * self.timeline))], reverse=True)
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qs(self.rfile.read(length).decode()))
+        return url.path, {k: v[0] for k, v in params.items()}
+
+    def _token(self):
+        match = re.search(r'oauth_token="([^"]*)"', self.headers.get('Authorization', ''))
+        return match.group(1) if match else None
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, code, message, headers=None):
+        self._send_json({'errors': [{'code': code, 'message': message}]}, status=status, headers=headers)
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        path, params = self._params()
+        match = re.match(r'^/1\.1/(.+)\.json$', path)
+        if not match:
+            return self._send_error(404, 34, 'Sorry, that page does not exist.')
+        endpoint = match.group(1)
+        if endpoint == 'statuses/filter':
+            return self._stream(params)
+        if endpoint not in RATE_LIMITS:
+            return self._send_error(404, 34, 'Sorry, that page does not exist.')
+        [remaining, reset] = self.server.consume(endpoint, self._token())
+        headers = {'x-rate-limit-limit': RATE_LIMITS[endpoint], 'x-rate-limit-remaining': max(remaining, 0),
+                   'x-rate-limit-reset': int(reset)}
+        if remaining < 0:
+            return self._send_error(429, 88, 'Rate limit exceeded', headers=headers)
+        self.server.simulate_latency()
+        getattr(self, '_%s' % endpoint.replace('/', '_'))(params, headers)
+
+    def _user_id(self, params):
+        if 'user_id' in params:
+            return int(params['user_id'])
+        if 'id' in params and params['id'].isdigit():
+            return int(params['id'])
+        screen_name = params.get('screen_name', params.get('id', ''))
+        match = re.match(r'^user(\d+)$', screen_name)
+        return int(match.group(1)) if match else None
+
+    def _relation(self, kind, params, headers):
+        user_id = self._user_id(params)
+        if user_id is None or not self.server.data.exists(user_id):
+            return self._send_error(401, 179, 'Not authorized.', headers=headers)
+        ids = self.server.data.relation(kind, user_id)
+        page = max(int(params.get('cursor', -1)), 0)
+        count = int(params.get('count', IDS_PAGE_SIZE))
+        page_ids = ids[page * count:(page + 1) * count]
+        next_cursor = page + 1 if (page + 1) * count < len(ids) else 0
+        previous_cursor = page - 1 if page else 0
+        self._send_json({'ids': page_ids, 'next_cursor': next_cursor, 'next_cursor_str': str(next_cursor),
+                         'previous_cursor': previous_cursor, 'previous_cursor_str': str(previous_cursor)},
+                        headers=headers)
+
+    def _followers_ids(self, params, headers):
+        self._relation('followers', params, headers)
+
+    def _friends_ids(self, params, headers):
+        self._relation('friends', params, headers)
+
+    def _statuses_user_timeline(self, params, headers):
+        user_id = self._user_id(params)
+        if user_id is None or not self.server.data.exists(user_id):
+            return self._send_error(401, 179, 'Not authorized.', headers=headers)
+        ids = self.server.data.timeline_ids(user_id)
+        if 'max_id' in params:
+            ids = [i for i in ids if i <= int(params['max_id'])]
+        if 'since_id' in params:
+            ids = [i for i in ids if i > int(params['since_id'])]
+        count = min(int(params.get('count') or 20), 200) or 20
+        self._send_json([self.server.data.status(i, user_id=user_id) for i in ids[:count]], headers=headers)
+
+    def _statuses_show(self, params, headers):
+        status = self.server.data.status(int(params['id']))
+        if not self.server.data.exists(status['user']['id']):
+            return self._send_error(404, 144, 'No status found with that ID.', headers=headers)
+        self._send_json(status, headers=headers)
+
+    def _users_show(self, params, headers):
+        user_id = self._user_id(params)
+        if user_id is None or not self.server.data.exists(user_id):
+            return self._send_error(404, 50, 'User not found.', headers=headers)
+        self._send_json(self.server.data.user(user_id), headers=headers)
+
+    def _users_lookup(self, params, headers):
+        ids = [int(i) for i in params.get('user_id', '').split(',') if i][:100]
+        users = [self.server.data.user(i) for i in ids if self.server.data.exists(i)]
+        if not users:
+            return self._send_error(404, 17, 'No user matches for specified terms.', headers=headers)
+        self._send_json(users, headers=headers)
+
+    def _stream(self, params):
+        track = [t for t in params.get('track', '').split(',') if t]
+        connection = self.server.stream_connected()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        interval = 1.0 / self.server.rate if self.server.rate > 0 else 0
+        sent = 0
+        next_at = time.time()
+        try:
+            if self.server.streams and connection > self.server.streams:
+                # connections beyond the served ones get no statuses until they are closed
+                self.wfile.flush()
+                self.server.idle_streams_closed.wait()
+                return
+            for line in self.server.statuses(track):
+                if self.server.limit and sent >= self.server.limit:
+                    break
+                if interval:
+                    next_at += interval
+                    delay = next_at - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.wfile.write(line + b'\r\n')
+                self.wfile.flush()
+                sent += 1
+                self.server.statuses_sent += 1
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug('Stream client disconnected after %d statuses' % sent)
+
+
+class FakeTwitterServer(ThreadingHTTPServer):
+    """
+    rate: statuses per second emitted by each stream connection (0 means as fast as possible)
+    limit: statuses sent on each stream connection before closing it (0 means never)
+    streams: stream connections served with statuses (0 means all), the following ones are kept idle until
+    close_idle_streams is called. Streaming clients connect again only after handling all the statuses of a closed
+    connection, so waiting for the connection after the served ones (see wait_stream_connections) waits for them
+    replay: path of a file with one status json per line, replayed in loop instead of synthetic statuses
+    window: length in seconds of the rate limit windows (15 minutes on Twitter)
+    latency: seconds waited before answering each REST request
+    """
+    daemon_threads = True
+
+    def __init__(self, address, data=None, rate=50, limit=0, replay=None, window=15 * 60, latency=0.0, streams=0):
+        super().__init__(address, FakeTwitterHandler)
+        self.data = data if data is not None else FakeTwitterData()
+        self.rate = rate
+        self.limit = limit
+        self.streams = streams
+        self.stream_connections = 0
+        self.statuses_sent = 0
+        self.streams_changed = threading.Condition()
+        self.idle_streams_closed = threading.Event()
+        self.window = window
+        self.latency = latency
+        self.replayed = None
+        if replay:
+            with open(replay, 'rb') as f:
+                self.replayed = [line.strip() for line in f if line.strip()]
+        self.windows = {}
+        self.windows_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def consume(self, endpoint, token):
+        """ Counts a request in the current window of (endpoint, token), returns [remaining requests, reset time] """
+        now = time.time()
+        with self.windows_lock:
+            [used, reset] = self.windows.get((endpoint, token), [0, now + self.window])
+            if now >= reset:
+                [used, reset] = [0, now + self.window]
+            used += 1
+            self.windows[(endpoint, token)] = [used, reset]
+        return [RATE_LIMITS[endpoint] - used, reset]
+
+    def stream_connected(self):
+        """ Counts a new stream connection, returns its number """
+        with self.streams_changed:
+            self.stream_connections += 1
+            self.streams_changed.notify_all()
+            return self.stream_connections
+
+    def wait_stream_connections(self, count, timeout=None):
+        """ Waits until count stream connections have been opened, returns False on timeout """
+        with self.streams_changed:
+            return self.streams_changed.wait_for(lambda: self.stream_connections >= count, timeout=timeout)
+
+    def close_idle_streams(self):
+        """ Ends the idle stream connections, and the ones opened from now on """
+        self.idle_streams_closed.set()
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def statuses(self, track):
+        if self.replayed:
+            return itertools.cycle(self.replayed)
+        return (json.dumps(self.data.new_status(track)).encode() for _ in itertools.count())
+
+    def start(self):
+        """ Serves requests from a daemon thread, returns the thread """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        logger.info('Fake Twitter API listening on %s' % self.url)
+        return thread
+
+
+class FakeServerAdapter(requests.adapters.HTTPAdapter):
+    """ Sends to the fake server all the requests made through the session it is mounted on """
+
+    def __init__(self, base_url, **kwargs):
+        self.base_url = base_url.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = '%s%s%s' % (self.base_url, url.path, '?%s' % url.query if url.query else '')
+        return super().send(request, **kwargs)
+
+
+def redirect_session(session, base_url, **kwargs):
+    session.mount('https://', FakeServerAdapter(base_url, **kwargs))
+    return session
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from twitter.fake_api import FakeTwitterData, FakeTwitterServer
+from twitter.models import Campaign, Entity, MyStreamListener, Streamer, TwitterUser
+from twitter.tasks import background_stream, get_users_followers, get_users_friends, get_tweets, hydrate_users
+
+# seconds waited for the streamer to connect again before checking it is still running
+STREAM_POLL_INTERVAL = 0.05
+
+
+class Command(BaseCommand):
+    help = ('Measures ingestion throughput against a local fake Twitter API. '
+            'It writes to the configured database: run it on a scratch one')
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaign', help='Slug of the campaign the data is linked to')
+        parser.add_argument('--streamer', type=int,
+                            help='Id of a streamer of the campaign (default: a new one tracking "benchmark")')
+        parser.add_argument('--statuses', type=int, default=1000, help='Statuses read from the stream')
+        parser.add_argument('--users', type=int, default=20, help='Users whose network and timeline are retrieved')
+        parser.add_argument('--rate', type=float, default=0, help='Statuses per second on the stream (0: no limit)')
+        parser.add_argument('--replay', help='File with one status json per line to stream instead of synthetic ones')
+        parser.add_argument('--window', type=int, default=15 * 60, help='Length of rate limit windows in seconds')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds waited before each REST response')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _report(self, phase, count, elapsed):
+        self.stdout.write('%-12s %8d items %9.2f s %10.1f items/s' % (
+            phase, count, elapsed, count / elapsed if elapsed else 0))
+
+    def _get_streamer(self, campaign, streamer_id):
+        if streamer_id:
+            try:
+                return Streamer.objects.get(pk=streamer_id, campaign=campaign)
+            except Streamer.DoesNotExist:
+                raise CommandError('Streamer %d of campaign %s does not exist' % (streamer_id, campaign.slug))
+        [entity, _] = Entity.objects.get_or_create(
+            entitytype=Entity.TEXT_OR, content='benchmark', defaults={'name': 'benchmark'})
+        streamer = Streamer.objects.create(campaign=campaign)
+        streamer.entities.add(entity)
+        return streamer
+
+    def _run_streamer(self, streamer):
+        try:
+            background_stream.now(streamer.id)
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        try:
+            campaign = Campaign.objects.get(slug=options['campaign'])
+        except Campaign.DoesNotExist:
+            raise CommandError('Campaign %s does not exist' % options['campaign'])
+
+        # the streamer connects again once it has processed all the statuses of the first connection
+        server = FakeTwitterServer(
+            ('127.0.0.1', 0), data=FakeTwitterData(seed=options['seed']), rate=options['rate'],
+            limit=options['statuses'], replay=options['replay'], window=options['window'], latency=options['latency'],
+            streams=1)
+        server.start()
+        settings.TWITTER_FAKE_API_URL = server.url
+        api = campaign.get_twitter_api()
+        if getattr(api, 'session', None) is None:
+            server.shutdown()
+            raise CommandError('The installed tweepy opens a new session for each call, requests cannot be sent to '
+                               'the fake server')
+        streamer = self._get_streamer(campaign, options['streamer'])
+
+        # statuses go through background_stream and MyStreamListener.on_status, replies are resolved as in production
+        thread = threading.Thread(target=self._run_streamer, args=(streamer,), daemon=True)
+        start = time.time()
+        thread.start()
+        processed = False
+        while thread.is_alive() and not processed:
+            processed = server.wait_stream_connections(2, timeout=STREAM_POLL_INTERVAL)
+        elapsed = time.time() - start
+        # the listener stops when its idle connection is closed
+        if streamer.id in MyStreamListener.tweepy_streams:
+            MyStreamListener.tweepy_streams[streamer.id].disconnect()
+        server.close_idle_streams()
+        thread.join()
+        Streamer.objects.get(pk=streamer.id).deactivate()
+        if not processed:
+            server.shutdown()
+            raise CommandError('The streamer stopped before processing the %d statuses sent, see the log' %
+                               server.statuses_sent)
+        self._report('stream', server.statuses_sent, elapsed)
+
+        users = sorted(str(uid) for uid in campaign.get_tweets().values_list(
+            'author_id', flat=True).distinct())[:options['users']]
+        for [phase, task, kwargs] in [
+                ['followers', get_users_followers, {'days_interval': 0}],
+                ['friends', get_users_friends, {'days_interval': 0}],
+                ['timelines', get_tweets, {'max_tweets': 200, 'days_interval': 0}]]:
+            start = time.time()
+            task.now(campaign.slug, users, **kwargs)
+            self._report(phase, len(users), time.time() - start)
+
+        stubs = list(TwitterUser.objects.filter(filled=False).values_list('id_str', flat=True)[:10000])
+        start = time.time()
+        hydrate_users.now(campaign.slug, stubs)
+        self._report('lookup', len(stubs), time.time() - start)
+        server.shutdown()
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# libraries only needed by the code drawing graphs, which must not be imported when the project is loaded
+HEAVY_MODULES = ('pylab', 'matplotlib', 'graph_tool', 'svglib', 'reportlab')
+
+SETUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import django
+django.setup()
+print(time.perf_counter() - start)
+print(' '.join(sorted({m.split('.')[0] for m in sys.modules} & set(sys.argv[1:]))))
+'''
+
+
+class Command(BaseCommand):
+    help = ('Measures the time taken by django.setup() (importing settings, apps and models) in a new interpreter, '
+            'and fails if it exceeds the budget or if it imports the graph drawing libraries')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=float, default=settings.STARTUP_TIME_BUDGET,
+                            help='Maximum number of seconds (default: STARTUP_TIME_BUDGET)')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs, the fastest one is reported')
+        parser.add_argument('--top', type=int, default=10, help='Slowest top level imports listed')
+
+    def _run(self):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', SETUP_SCRIPT] + list(HEAVY_MODULES),
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'tafferugli.settings')),
+            capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError('django.setup() failed:\n%s' % result.stderr[-2000:])
+        [elapsed, heavy] = result.stdout.splitlines()[-2:]
+        imports = []
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or '[us]' in line:
+                continue
+            [_, cumulative, name] = line.split('|')
+            # nested imports are indented by two spaces per level
+            if not name[1:].startswith(' '):
+                imports.append((int(cumulative), name.strip()))
+        return float(elapsed), heavy.split(), sorted(imports, reverse=True)
+
+    def handle(self, *args, **options):
+        runs = [self._run() for _ in range(max(options['repeat'], 1))]
+        [elapsed, heavy, imports] = min(runs, key=lambda r: r[0])
+        self.stdout.write('django.setup(): %.3f s (budget %.3f s, best of %d)' % (
+            elapsed, options['budget'], len(runs)))
+        for [cumulative, name] in imports[:options['top']]:
+            self.stdout.write('  %8.3f s  %s' % (cumulative / 1e6, name))
+        if heavy:
+            raise CommandError('Graph drawing libraries imported at startup: %s' % ', '.join(heavy))
+        if elapsed > options['budget']:
+            raise CommandError('django.setup() took %.3f s, over the budget of %.3f s' % (elapsed, options['budget']))
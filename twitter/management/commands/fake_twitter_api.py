@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from twitter.fake_api import FakeTwitterData, FakeTwitterServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a local fake Twitter API. Set TWITTER_FAKE_API_URL to its address to send requests to it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--rate', type=float, default=50, help='Statuses per second on each stream (0: no limit)')
+        parser.add_argument('--limit', type=int, default=0, help='Statuses sent on each stream before closing it')
+        parser.add_argument('--replay', help='File with one status json per line to stream instead of synthetic ones')
+        parser.add_argument('--window', type=int, default=15 * 60, help='Length of rate limit windows in seconds')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds waited before each REST response')
+        parser.add_argument('--population', type=int, default=100000, help='Number of synthetic users')
+        parser.add_argument('--followers', type=int, default=200, help='Average number of followers and friends')
+        parser.add_argument('--timeline', type=int, default=50, help='Average number of statuses per timeline')
+        parser.add_argument('--reply-ratio', type=float, default=0.3, help='Fraction of statuses that are replies')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        data = FakeTwitterData(
+            population=options['population'], followers=options['followers'], friends=options['followers'],
+            timeline=options['timeline'], reply_ratio=options['reply_ratio'], seed=options['seed'])
+        server = FakeTwitterServer(
+            (options['host'], options['port']), data=data, rate=options['rate'], limit=options['limit'],
+            replay=options['replay'], window=options['window'], latency=options['latency'])
+        self.stdout.write('Fake Twitter API listening on %s' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from twitter.models import Campaign, Entity, TweetRollup
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the tweet counters by minute, hour and day of campaigns and entities from the stored tweets, '
+            'e.g. for tweets collected before the counters existed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaigns', nargs='*', help='Slugs of the campaigns (default: all)')
+
+    def handle(self, *args, **options):
+        campaigns = Campaign.objects.all()
+        if options['campaigns']:
+            campaigns = campaigns.filter(slug__in=options['campaigns'])
+            if campaigns.count() != len(set(options['campaigns'])):
+                raise CommandError('Some of the campaigns do not exist')
+        for campaign in campaigns:
+            buckets = TweetRollup.rebuild(campaign=campaign)
+            self.stdout.write('Campaign %s: %d buckets' % (campaign.slug, buckets))
+            for entity in campaign.entities.all():
+                buckets = TweetRollup.rebuild(entity=entity)
+                self.stdout.write('  entity %s: %d buckets' % (entity.content, buckets))
@@ -0,0 +1,115 @@
+"""
+Near-duplicate detection for short texts with MinHash signatures and locality sensitive hashing.
+Texts are normalized (case, urls, mentions, punctuation and emoji are ignored) and split in character shingles;
+signatures are computed with numpy for batches of texts at once. Texts sharing a band of their signature become
+candidates, and candidates whose estimated Jaccard similarity is above the threshold are joined in clusters.
+Each text is compared to the first member of its buckets only, so the cost is linear in the number of texts.
+"""
+import re
+import zlib
+import numpy
+
+# Value of the signature of texts without shingles (hash functions return 32 bit values)
+EMPTY = numpy.uint64(1 << 32)
+SHIFT = numpy.uint64(32)
+# Texts whose shingles are hashed together: memory is about BATCH_SIZE * shingles per text * num_perm * 8 bytes
+BATCH_SIZE = 200
+
+_url_re = re.compile(r'https?://\S+')
+_mention_re = re.compile(r'@\w+')
+_non_word_re = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    text = _mention_re.sub(' ', _url_re.sub(' ', text.lower()))
+    return _non_word_re.sub(' ', text).strip()
+
+
+def shingles(text, k=5):
+    """ 32 bit hashes of the character k-shingles of the normalized text """
+    text = normalize(text)
+    if len(text) <= k:
+        grams = {text} if text else set()
+    else:
+        grams = {text[i:i + k] for i in range(len(text) - k + 1)}
+    return numpy.array([zlib.crc32(g.encode()) for g in grams], dtype=numpy.uint64)
+
+
+def get_lsh_params(num_perm, threshold):
+    """
+    Number of bands and rows per band such that pairs with a Jaccard similarity around the threshold become
+    candidates: the S-curve midpoint (1 / bands) ^ (1 / rows) is the closest one not above the threshold
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        midpoint = (1 / bands) ** (1 / rows)
+        if midpoint <= threshold and (best is None or midpoint > best[2]):
+            best = (bands, rows, midpoint)
+    return best[:2] if best else (num_perm, 1)
+
+
+class MinHashLSH(object):
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # multiply-shift hash functions: the high 32 bits of (a * x + b) mod 2^64, with a odd
+        generator = numpy.random.RandomState(seed)
+        self.a = generator.randint(0, 1 << 62, size=num_perm, dtype=numpy.uint64) * numpy.uint64(2) + numpy.uint64(1)
+        self.b = generator.randint(0, 1 << 62, size=num_perm, dtype=numpy.uint64)
+        [self.bands, self.rows] = get_lsh_params(num_perm, threshold)
+
+    def signatures(self, texts):
+        """ MinHash signatures (one row per text) of the texts; texts without shingles get a row of max values """
+        signatures = numpy.full((len(texts), self.num_perm), EMPTY, dtype=numpy.uint64)
+        for start in range(0, len(texts), BATCH_SIZE):
+            hashes = [shingles(t, self.shingle_size) for t in texts[start:start + BATCH_SIZE]]
+            lengths = numpy.array([len(h) for h in hashes])
+            non_empty = numpy.nonzero(lengths)[0]
+            if not len(non_empty):
+                continue
+            values = numpy.concatenate([hashes[i] for i in non_empty])
+            permuted = (values[:, None] * self.a[None, :] + self.b[None, :]) >> SHIFT
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths[non_empty])[:-1]])
+            signatures[start + non_empty] = numpy.minimum.reduceat(permuted, offsets, axis=0)
+        return signatures
+
+    def clusters(self, texts):
+        """ Lists of indexes of the texts that are near duplicates of each other (clusters of at least 2 texts) """
+        signatures = self.signatures(texts)
+        valid = signatures[:, 0] != EMPTY
+        parent = numpy.arange(len(texts))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(self.bands):
+            rows = signatures[:, band * self.rows:(band + 1) * self.rows]
+            [_, buckets] = numpy.unique(rows, axis=0, return_inverse=True)
+            buckets = buckets.ravel()
+            order = numpy.argsort(buckets, kind='stable')
+            boundaries = numpy.nonzero(numpy.diff(buckets[order]))[0] + 1
+            for members in numpy.split(order, boundaries):
+                members = members[valid[members]]
+                if len(members) < 2:
+                    continue
+                representative = members[0]
+                similarity = (signatures[members[1:]] == signatures[representative]).mean(axis=1)
+                root = find(representative)
+                for member in members[1:][similarity >= self.threshold]:
+                    member_root = find(member)
+                    if member_root != root:
+                        parent[member_root] = root
+
+        groups = {}
+        for i in range(len(texts)):
+            if valid[i]:
+                groups.setdefault(find(i), []).append(i)
+        return [g for g in groups.values() if len(g) > 1]
@@ -1,56 +1,126 @@
 import decimal
-import statistics
+import numpy
+import re
 import json as jsonpkg
 from datetime import timedelta
-import tempfile, os
-os.environ['MPLCONFIGDIR'] = tempfile.mkdtemp()
+import tempfile, os, shutil
 
-from pylab import *
-from graph_tool.all import *
-from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPM
-from difflib import SequenceMatcher
-
-from django.db.models import Avg, StdDev, Func, Q, F
-from django.db.models.functions import TruncDay, Coalesce, Extract
-from django.utils.safestring import mark_safe
+from django.db.models import Q
+from django.core.files import File
+from django.db.models.functions import TruncDate, Extract
 
 from .models import *
+from twitter import rules, stats
+from twitter.minhash import MinHashLSH
+from twitter.patterns import find_common_patterns
 from .operations import OperationConstructNetwork, OperationRetrieveTweets
 
 
-class MetricDefaultProfilePicture(Metric):
-    description = 'Find profiles that have a default profile picture'
+class UserRuleMetric(Metric):
+    """
+    Metrics tagging the target users that satisfy a rule (see twitter.rules), built by get_rule from the parameters
+    and reading the fields listed in user_columns. The value is the percentage of tagged users.
+    Rule metrics computed in the same MetricBatch are evaluated together by compute_rules
+    """
     target_type = Metric.TARGET_USERS
+    samplable = True
+
+    class Meta:
+        abstract = True
+
+    def get_rule(self):
+        raise NotImplementedError('Rule metric %s does not define its rule' % self.__class__.__name__)
+
+    def get_fact(self):
+        """ Text and description of the fact added to the tagged users """
+        raise NotImplementedError()
+
+    def get_campaign_fact(self, total, tagged):
+        """ Text and description of the fact added to the campaign by campaign wide metrics """
+        raise NotImplementedError()
+
+    @staticmethod
+    def compute_rules(metrics):
+        """
+        Computes rule metrics on the same target users: the columns read by all the rules are loaded once, each rule
+        is evaluated on all the users with numpy and the tagged users and facts of all the metrics are written in one
+        transaction, with the same bulk inserts. Returns False if there are no target users
+        """
+        fields = list(dict.fromkeys(f for m in metrics for f in ('id_int',) + tuple(m.user_columns)))
+        columns = dict(zip(fields, metrics[0].load_user_columns(*fields)))
+        ids = columns['id_int']
+        if len(ids) == 0:
+            logger.error('Cannot compute metrics %s without users' % ', '.join(str(m.id) for m in metrics))
+            return False
+        masks = [m.get_rule().evaluate(columns) for m in metrics]
+        tagged = [ids[mask].tolist() for mask in masks]
+
+        for [metric, mask, uids] in zip(metrics, masks, tagged):
+            metric.value = round(decimal.Decimal(len(uids)) / decimal.Decimal(len(ids)) * 100, 10)
+            if metric.sampling:
+                metric.set_sample_estimate(mask)
+
+        through = Metric.tagged_users.through
+        with transaction.atomic():
+            through.objects.filter(metric__in=[m.pk for m in metrics]).delete()
+            bulk_insert(through, (through(metric_id=m.pk, twitteruser_id=uid)
+                                  for [m, uids] in zip(metrics, tagged) for uid in uids), Metric.FACTS_BATCH_SIZE)
+            counter = bulk_insert(Fact, (
+                Fact(twitter_user_id=uid, metric=m, text=text, description=description, target_type=Fact.TWITTER_USER)
+                for [m, uids] in zip(metrics, tagged) for [text, description] in [m.get_fact()] for uid in uids),
+                Metric.FACTS_BATCH_SIZE)
+            for [metric, uids] in zip(metrics, tagged):
+                if metric.campaign_wide:
+                    metric.campaign.add_fact(metric, *metric.get_campaign_fact(len(ids), len(uids)))
+        logger.debug('Rule metrics %s tagged %s of %d users, added %d facts' % (
+            ', '.join(str(m.id) for m in metrics), ', '.join(str(len(uids)) for uids in tagged), len(ids), counter))
+        return True
+
+    def _computation(self):
+        return self.compute_rules([self])
+
+
+class MetricDefaultProfilePicture(UserRuleMetric):
+    description = 'Find profiles that have a default profile picture'
+    user_columns = ('id_int', 'profile_image_url_https')
+    DEFAULT_IMAGE = 'https://abs.twimg.com/sticky/default_profile_images/default_profile_normal.png'
 
     def get_user_tag(self):
         return 'Uses default profile picture'
 
-    def _computation(self):
-        tot_users = self.twitter_users.count()
-        if tot_users == 0:  # TODO move check into base class
-            logger.error('Cannot call metric without users')
-            return False
-        default_img_users = self.twitter_users.filter(
-            profile_image_url_https='https://abs.twimg.com/sticky/default_profile_images/default_profile_normal.png')
-        self.tagged_users.set(default_img_users)
-        def_image_users_count = default_img_users.count()
-        percentage = (decimal.Decimal(def_image_users_count) / decimal.Decimal(tot_users)) * 100
-        self.value = round(percentage, 10)
-        for t in self.tagged_users.all():
-            t.add_fact(self, 'Default Profile Picture', 'User has the default profile picture')
-        if self.campaign_wide:
-            self.campaign.add_fact(self, '%.2f %% default profile pictures' % self.value,
-                                   'On %d users, %d (%.4f) have a default profile picture' % (
-                                       tot_users,
-                                       def_image_users_count,
-                                       self.value))
-        return True
+    def get_rule(self):
+        return rules.equals('profile_image_url_https', self.DEFAULT_IMAGE)
+
+    def get_fact(self):
+        return 'Default Profile Picture', 'User has the default profile picture'
+
+    def get_campaign_fact(self, total, tagged):
+        return '%.2f %% default profile pictures' % self.value, \
+               'On %d users, %d (%.4f) have a default profile picture' % (total, tagged, self.value)
 
 
 class MetricDuplicateTweet(Metric):
     target_type = Metric.TARGET_TWEETS
-    description = 'Find tweets with the same text'
+    description = 'Find tweets with the same (or almost the same) text'
+    template_form = 'metrics/forms/MetricDuplicateTweet.html'
+    template_custom_fields = 'metrics/custom_fields/MetricDuplicateTweet.html'
+    near_duplicates = models.BooleanField(
+        default=False, help_text='Also find tweets differing by a few characters, mentions, links or emoji')
+    jaccard_threshold = models.FloatField(
+        default=0.8, help_text='Minimum similarity (Jaccard on character shingles) of near duplicate tweets')
+    tweets_counter = models.PositiveIntegerField(default=0, help_text='Number of analyzed tweets (not retweets)')
+    duplicates_counter = models.PositiveIntegerField(default=0, help_text='Number of texts published more than once')
+    incremental = True
+    samplable = True
+    result_fields = ('tweets_counter', 'duplicates_counter')
+
+    def set_params_from_req(self, post_dict):
+        self.name = post_dict['metric_name']
+        self.custom_description = post_dict['metric_description']
+        self.near_duplicates = post_dict.get('near_duplicates') == 'true'
+        if post_dict.get('jaccard_threshold'):
+            self.jaccard_threshold = min(max(float(post_dict['jaccard_threshold']), 0.1), 1)
+        self.save()
 
     def get_twitter_tag(self):
         return 'Is duplicate tweet'
@@ -58,53 +128,160 @@ class MetricDuplicateTweet(Metric):
     def get_user_tag(self):
         return 'Published duplicate tweet'
 
+    def is_incremental(self):
+        return super().is_incremental() and not self.near_duplicates
+
+    def get_sampling_methods(self):
+        # near duplicates of the sampled tweets can only be found among all the tweets
+        return [] if self.near_duplicates else super().get_sampling_methods()
+
+    def get_sampling_population(self, target):
+        return target.filter(retweeted_status__isnull=True)
+
     def _computation(self):
+        if self.near_duplicates:
+            return self._near_duplicates_computation()
+        if self.sampling:
+            return self._sample_computation()
         not_retweets = self.tweets.filter(retweeted_status__isnull=True).distinct()
         duplicates = not_retweets.values('text').annotate(Count('id_int')).order_by().filter(id_int__count__gt=1)
-        self.tagged_tweets.set(self.tweets.filter(text__in=[tweet['text'] for tweet in duplicates]))
-        percentage = decimal.Decimal(duplicates.count()) / decimal.Decimal(not_retweets.count()) * 100
+        set_relation(self.tagged_tweets, self.tweets.filter(text__in=duplicates.values('text')))
+        self.tweets_counter = not_retweets.count()
+        self.duplicates_counter = duplicates.count()
+        self._set_duplicates_value()
+        self.add_tweet_facts(
+            self.tagged_tweets.all(), 'Duplicate tweet', 'There is at least another tweet with the same text')
+        return True
+
+    def _incremental_computation(self, tweets, twitter_users):
+        new_tweets = tweets.filter(retweeted_status__isnull=True)
+        new_counts = dict(new_tweets.values('text').annotate(Count('id_int')).order_by().values_list(
+            'text', 'id_int__count'))
+        not_retweets = self.tweets.filter(retweeted_status__isnull=True)
+        duplicates = not_retweets.filter(text__in=new_tweets.values('text')).values('text').annotate(
+            Count('id_int')).order_by().filter(id_int__count__gt=1)
+        # texts that were published at most once before the new tweets
+        for [text, counter] in duplicates.values_list('text', 'id_int__count'):
+            if counter - new_counts.get(text, 0) <= 1:
+                self.duplicates_counter += 1
+        self.tweets_counter += new_tweets.count()
+
+        tagged = list(self.tweets.filter(text__in=duplicates.values('text')).exclude(
+            pk__in=self.tagged_tweets.values('pk')).values_list('pk', flat=True))
+        set_relation_ids(self.tagged_tweets, tagged, clear=False)
+        self._set_duplicates_value()
+        self.add_tweet_facts(tagged, 'Duplicate tweet', 'There is at least another tweet with the same text')
+        return True
+
+    def _sample_computation(self):
+        """
+        Tags the sampled tweets whose text was published more than once in the whole campaign, counting the tweets
+        of the campaign with the texts of the sample. Each of them adds 1 / (number of tweets with its text) to the
+        number of duplicate texts, from which the share of duplicate texts is estimated
+        """
+        [ids, texts] = self.load_tweet_columns('id_int', 'text')
+        if len(ids) == 0:
+            logger.error('Cannot look for duplicates without tweets')
+            return False
+        population = self.get_sampling_population(self.get_campaign_targets()[1])
+        distinct = list({t for t in texts if t is not None})
+        counts = {}
+        for start in range(0, len(distinct), self.FACTS_BATCH_SIZE):
+            counts.update(population.filter(text__in=distinct[start:start + self.FACTS_BATCH_SIZE]).values(
+                'text').annotate(Count('id_int')).order_by().values_list('text', 'id_int__count'))
+        counters = numpy.array([counts.get(t, 1) for t in texts], dtype=float)
+        duplicate = counters > 1
+        duplicates = ids[duplicate].tolist()
+        set_relation_ids(self.tagged_tweets, duplicates)
+        self.set_sample_estimate(numpy.where(duplicate, 1 / counters, 0))
+        self.tweets_counter = self.population_size
+        self.duplicates_counter = int(round(self.value * self.tweets_counter / 100))
+        self.add_tweet_facts(duplicates, 'Duplicate tweet', 'There is at least another tweet with the same text')
+        if self.campaign_wide:
+            self.campaign.add_fact(self, '%.2f%% of tweets is duplicate' % self.value,
+                                   'Estimated on %d out of %d tweets (that are not retweets): between %.2f%% and '
+                                   '%.2f%% with confidence %.2f' % (
+                                       len(ids), self.tweets_counter, self.value_lower, self.value_upper,
+                                       self.confidence))
+        return True
+
+    def _set_duplicates_value(self):
+        percentage = decimal.Decimal(self.duplicates_counter) / decimal.Decimal(max(self.tweets_counter, 1)) * 100
         self.value = round(percentage, 10)
-        for t in self.tagged_tweets.all():
-            t.add_fact(self, 'Duplicate tweet', 'There is at least another tweet with the same text')
         if self.campaign_wide:
+            self.campaign.facts.filter(metric=self).delete()
             self.campaign.add_fact(self, '%.2f%% of tweets is duplicate' % self.value,
                                    'On %d tweets (that are not retweets), %d (%.4f) are duplicates' % (
-                                       not_retweets.count(),
-                                       duplicates.count(),
+                                       self.tweets_counter,
+                                       self.duplicates_counter,
                                        self.value))
+
+    def _near_duplicates_computation(self):
+        columns = self.load_tweet_columns('id_int', 'author_id', 'text', 'retweeted_status_id')
+        original = numpy.array([t is not None and r is None for [t, r] in zip(columns[2], columns[3])], dtype=bool)
+        [ids, authors, texts] = [c[original] for c in columns[:3]]
+        if len(ids) == 0:
+            logger.error('Cannot look for duplicates without tweets')
+            return False
+        clusters = MinHashLSH(threshold=self.jaccard_threshold).clusters(texts)
+        logger.debug('Found %d clusters of near duplicate tweets' % len(clusters))
+
+        duplicates = [int(ids[i]) for cluster in clusters for i in cluster]
+        set_relation_ids(self.tagged_tweets, duplicates)
+        self.add_tweet_facts(duplicates, 'Near duplicate tweet',
+                             'There is at least another tweet with a similar text (similarity >= %.2f)' %
+                             self.jaccard_threshold)
+        self.value = round(decimal.Decimal(len(duplicates)) / decimal.Decimal(len(ids)) * 100, 10)
+
+        # users publishing the same content are a community
+        memberships = []
+        for cluster in clusters:
+            cluster_authors = set(int(authors[i]) for i in cluster if authors[i] is not None)
+            if len(cluster_authors) < 2:
+                continue
+            community = Community.objects.create(
+                metric=self, campaign=self.campaign, name='Near duplicate tweets (%d users)' % len(cluster_authors),
+                description='Users who published %d tweets similar to "%s"' % (len(cluster), texts[cluster[0]]))
+            community.add_fact(self, 'Published near duplicate tweets',
+                               '%d users published %d tweets with a similarity of at least %.2f' % (
+                                   len(cluster_authors), len(cluster), self.jaccard_threshold))
+            memberships.extend(Community.twitter_users.through(community_id=community.id, twitteruser_id=author)
+                               for author in cluster_authors)
+        Community.twitter_users.through.objects.bulk_create(memberships, batch_size=self.FACTS_BATCH_SIZE)
+
+        if self.campaign_wide:
+            self.campaign.add_fact(self, '%.2f%% of tweets is a near duplicate' % self.value,
+                                   'On %d tweets (that are not retweets), %d (%.4f) are near duplicates, '
+                                   'in %d clusters' % (len(ids), len(duplicates), self.value, len(clusters)))
         return True
 
 
-class MetricDefaultTwitterProfile(Metric):
-    target_type = Metric.TARGET_USERS
+class MetricDefaultTwitterProfile(UserRuleMetric):
     default = 'Find users that did not customize their profile colors nor cover image'
+    user_columns = ('id_int', 'default_profile')
 
     def get_user_tag(self):
         return 'Did not customize profile'
 
-    def _computation(self):
-        default_profile_users = self.twitter_users.filter(default_profile=True)
-        self.tagged_users.set(default_profile_users)
-        percentage = decimal.Decimal(default_profile_users.count()) / decimal.Decimal(self.twitter_users.count()) * 100
-        self.value = round(percentage, 10)
-        for t in self.tagged_users.all():
-            t.add_fact(self, 'Default Profile', 'User did not customize profile colors nor cover image')
-        if self.campaign_wide:
-            self.campaign.add_fact(self, '%.2f %% default profiles' % self.value,
-                                   'On %d users, %d (%.4f) did not customise their profile (cover image and color)' % (
-                                       self.twitter_users.count(),
-                                       default_profile_users.count(),
-                                       self.value))
-        return True
+    def get_rule(self):
+        return rules.is_true('default_profile')
+
+    def get_fact(self):
+        return 'Default Profile', 'User did not customize profile colors nor cover image'
+
+    def get_campaign_fact(self, total, tagged):
+        return '%.2f %% default profiles' % self.value, \
+               'On %d users, %d (%.4f) did not customise their profile (cover image and color)' % (
+                   total, tagged, self.value)
 
 
-class MetricRecentCreationDate(Metric):
+class MetricRecentCreationDate(UserRuleMetric):
     template_form = 'metrics/forms/MetricRecentCreationDate.html'
     template_custom_fields = 'metrics/custom_fields/MetricRecentCreationDate.html'
-    target_type = Metric.TARGET_USERS
     days_interval = models.PositiveSmallIntegerField(default=30)
     since_today = models.BooleanField(default=False, help_text='Use today as a reference instead of the insertion date')
     description = 'Create communities of users created on the same date'
+    user_columns = ('id_int', 'created_at', 'inserted_at')
 
     def set_params_from_req(self, post_dict):
         self.name = post_dict['metric_name']
@@ -118,29 +295,63 @@ class MetricRecentCreationDate(Metric):
     def get_user_tag(self):
         return 'Created recently (%d)' % self.days_interval
 
-    def _computation(self):
-        if self.since_today:
-            recently_created = self.twitter_users.filter(
-                created_at__gte=timezone.now() - timedelta(days=self.days_interval))
+    def get_rule(self):
+        reference = stats.datetimes64([timezone.now()])[0] if self.since_today else 'inserted_at'
+        return rules.within_days('created_at', self.days_interval, reference)
+
+    def get_fact(self):
+        return 'Recently created', \
+               'User created within %d days of the day it was inserted in the database' % self.days_interval
+
+    def get_campaign_fact(self, total, tagged):
+        return '%.2f %% recently created users' % self.value, \
+               'On %d users, %d (%.4f) was created within %d days of their insertion date' % (
+                   total, tagged, self.value, self.days_interval)
+
+
+def _count_by(queryset, **expression):
+    """ Dictionary value -> number of objects of the queryset, for the values of a single annotation """
+    [[name, function]] = expression.items()
+    return dict(queryset.annotate(**{name: function}).values(name).annotate(
+        counter=Count('pk')).order_by().values_list(name, 'counter'))
+
+
+def _merge_counters(model, distribution, key_field, counters):
+    """ Adds counters (key -> count) to the data points of a distribution, creating the missing ones """
+    points = {getattr(p, key_field): p for p in model.objects.filter(distribution=distribution)}
+    new_points = []
+    for [key, counter] in counters.items():
+        if key in points:
+            points[key].counter += counter
         else:
-            recently_created = self.twitter_users.filter(
-                created_at__gte=F('inserted_at') - timedelta(days=self.days_interval))
-        percentage = decimal.Decimal(recently_created.count()) / decimal.Decimal(self.twitter_users.count()) * 100
-        self.tagged_users.set(recently_created)
-        self.value = round(percentage, 10)
-        # add facts
-        for t in self.tagged_users.all():
-            t.add_fact(self, 'Recently created',
-                       'User created within %d days of the day it was inserted in the database' % self.days_interval)
-        if self.campaign_wide:
-            self.campaign.add_fact(self,
-                                   '%.2f %% recently created users' % self.value,
-                                   'On %d users, %d (%.4f) was created within %d days of their insertion date' % (
-                                       self.twitter_users.count(),
-                                       recently_created.count(),
-                                       self.value,
-                                       self.days_interval))
-        return True
+            new_points.append(model(distribution=distribution, counter=counter, **{key_field: key}))
+    model.objects.bulk_update(list(points.values()), ['counter'])
+    model.objects.bulk_create(new_points)
+
+
+def _save_columns(file_field, name, rows, columns):
+    """
+    Saves the rows (tuples starting with a datetime) in the file field as a json object with an array for each of
+    the columns, the datetimes as seconds since the epoch. Rows are streamed, one column per temporary file
+    """
+    parts = [tempfile.TemporaryFile() for _ in columns]
+    try:
+        for n, row in enumerate(rows):
+            separator = ',' if n else ''
+            parts[0].write(('%s%d' % (separator, row[0].timestamp())).encode())
+            for [part, value] in zip(parts[1:], row[1:]):
+                part.write((separator + jsonpkg.dumps(value)).encode())
+        with tempfile.TemporaryFile() as out:
+            for n, [column, part] in enumerate(zip(columns, parts)):
+                out.write(('%s%s: [' % ('{' if n == 0 else ', ', jsonpkg.dumps(column))).encode())
+                part.seek(0)
+                shutil.copyfileobj(part, out)
+                out.write(b']')
+            out.write(b'}')
+            file_field.save(name, File(out), save=True)
+    finally:
+        for part in parts:
+            part.close()
 
 
 class UserCreationDateDistribution(models.Model):
@@ -173,111 +384,189 @@ class MetricCreationDateDistribution(Metric):
     template_file = 'metrics/MetricCreationDateDistribution.html'
     number_of_communities = models.PositiveSmallIntegerField(default=10)
     description = 'Compute the distribution of twitter user by their date creation'
-    distribution_json = models.TextField()
-
-    def get_json(self):
-        # returns the javascript dictionary used in d3 histograms
-        if self.distribution_json:
-            return mark_safe(self.distribution_json)
-        items = [{'date': 'new Date(\'%s\')' % u.created_at.strftime('%Y-%m-%d'),
-                  'id_str': u.id_str, 'screen_name': u.screen_name,
-                  'filled': u.filled} for u in self.twitter_users.all()]
-        # remove double quotes around "new Date(...)"
-        self.distribution_json = jsonpkg.dumps(items).replace('"new Date(', 'new Date(').replace(')"', ')')
-        self.save()
-        return mark_safe(self.distribution_json)
+    incremental = True
+    result_fields = ('distribution_file',)
+    # columns of the users loaded by the d3 histogram
+    distribution_file = models.FileField(null=True)
+
+    def get_json_url(self):
+        if not self.distribution_file:
+            columns = ('date', 'id_str', 'screen_name', 'filled')
+            rows = self.iterate(self.twitter_users.filter(created_at__isnull=False).order_by(),
+                                'created_at', 'id_str', 'screen_name', 'filled', chunk_size=stats.FETCH_SIZE)
+            _save_columns(self.distribution_file, 'distribution-%d.json' % self.id, rows, columns)
+        return self.distribution_file.url
 
     def _computation(self):
-        annotated = self.twitter_users.annotate(day=TruncDay('created_at'))
-        grouped_by = annotated.values('day').annotate(dcount=Count('id_int'))
-        ordered_by_freq = grouped_by.order_by('-dcount')
-        ordered_by_date = grouped_by.order_by('day')
-        dated_distribution = UserCreationDateDistribution.objects.create(metric=self, frequency='d')
-        UserDistributionDate.objects.bulk_create([UserDistributionDate(
-            counter=i['dcount'], date=i['day'], distribution=dated_distribution) for i in ordered_by_date])
-
-        for e in ordered_by_freq[:self.number_of_communities]:
-            relevant = annotated.filter(day__date=e['day'])
-            community = Community(metric=self)
-            community.campaign = self.campaign
-            community.description = 'Users of %s created on %s' % (self.campaign.name, e['day'].strftime('%Y-%m-%d'))
-            community.name = 'Created on %s' % e['day'].strftime('%Y-%m-%d')
-            community.save()
-            community.twitter_users.set(relevant)
-            text = 'Created on %s as %d others' % (e['day'].strftime('%Y-%m-%d'), e['dcount'])
-            description = 'Part of the group of %d users created on %s for campaign %s' % (
-                e['dcount'], e['day'].strftime('%Y-%m-%d'), self.campaign.name)
-            community.add_fact(self, text, description)
-            logger.debug('Created community %d with %d users for date %s' % (community.id, e['dcount'], e['day']))
+        distribution = UserCreationDateDistribution.objects.create(metric=self, frequency='d')
+        _merge_counters(UserDistributionDate, distribution, 'date', _count_by(
+            self.twitter_users.filter(created_at__isnull=False), date=TruncDate('created_at')))
+        self._set_communities(distribution)
+        return True
 
+    def _incremental_computation(self, tweets, twitter_users):
+        distribution = self.dated_distributions.filter(frequency='d').first()
+        if distribution is None:
+            distribution = UserCreationDateDistribution.objects.create(metric=self, frequency='d')
+        _merge_counters(UserDistributionDate, distribution, 'date', _count_by(
+            twitter_users.filter(created_at__isnull=False), date=TruncDate('created_at')))
+        self._set_communities(distribution)
+        self.distribution_file.delete(save=False)
         return True
 
+    def _set_communities(self, distribution):
+        """ Keeps a community for each of the number_of_communities dates with most users created """
+        communities = {c.name: c for c in self.communities.all()}
+        for e in distribution.dated_data_points.order_by('-counter', 'date')[:self.number_of_communities]:
+            name = 'Created on %s' % e.date.strftime('%Y-%m-%d')
+            community = communities.pop(name, None)
+            if community is None:
+                community = Community.objects.create(
+                    metric=self, campaign=self.campaign, name=name,
+                    description='Users of %s created on %s' % (self.campaign.name, e.date.strftime('%Y-%m-%d')))
+            set_relation(community.twitter_users, self.twitter_users.filter(created_at__date=e.date))
+            community.facts.filter(metric=self).delete()
+            text = 'Created on %s as %d others' % (e.date.strftime('%Y-%m-%d'), e.counter)
+            description = 'Part of the group of %d users created on %s for campaign %s' % (
+                e.counter, e.date.strftime('%Y-%m-%d'), self.campaign.name)
+            community.add_fact(self, text, description)
+            logger.debug('Set community %d with %d users for date %s' % (community.id, e.counter, e.date))
+        # dates no longer among the most frequent ones
+        for community in communities.values():
+            community.delete()
+
 
-class MetricTweetRatio(Metric):
+class OutlierMetric(Metric):
+    """
+    Metrics tagging the target users whose value is an outlier, either farther than how_many_standard_deviations
+    standard deviations from the mean or with a modified z-score (median and median absolute deviation, less
+    sensitive to the outliers themselves) higher than mad_threshold
+    """
+    METHOD_STD = 'std'
+    METHOD_MAD = 'mad'
+    METHOD_CHOICES = [
+        (METHOD_STD, 'Standard deviations from the mean'),
+        (METHOD_MAD, 'Modified z-score (median absolute deviation)'),
+    ]
+    template_form = 'metrics/forms/OutlierMetric.html'
     target_type = Metric.TARGET_USERS
+    how_many_standard_deviations = models.PositiveSmallIntegerField(default=3)
+    outlier_method = models.CharField(max_length=3, choices=METHOD_CHOICES, default=METHOD_STD)
+    mad_threshold = models.FloatField(default=3.5)
+
+    class Meta:
+        abstract = True
+
+    def set_params_from_req(self, post_dict):
+        self.name = post_dict['metric_name']
+        self.custom_description = post_dict['metric_description']
+        if post_dict.get('metric_outlier_method') in dict(self.METHOD_CHOICES):
+            self.outlier_method = post_dict['metric_outlier_method']
+        if post_dict.get('metric_how_many_standard_deviations'):
+            self.how_many_standard_deviations = max(int(post_dict['metric_how_many_standard_deviations']), 1)
+        if post_dict.get('metric_mad_threshold'):
+            self.mad_threshold = max(float(post_dict['metric_mad_threshold']), 0)
+        self.save()
+
+    def get_outliers(self, values, ddof=0):
+        """ Mask of the outliers among values, their statistics and the distance from the center of the outliers """
+        if self.outlier_method == self.METHOD_MAD:
+            [outliers, values_stats] = stats.mad_outliers(values, self.mad_threshold)
+            return outliers, values_stats, values_stats['mad'] * self.mad_threshold / stats.MAD_SCALE
+        [outliers, values_stats] = stats.zscore_outliers(values, self.how_many_standard_deviations, ddof=ddof)
+        return outliers, values_stats, values_stats['std'] * self.how_many_standard_deviations
+
+
+class MetricTweetRatio(OutlierMetric):
     how_many_standard_deviations = models.PositiveSmallIntegerField(default=2)
     description = 'Find users with an outlier average daily tweet ratio'
+    user_columns = ('id_int', 'created_at', 'updated_at', 'statuses_count')
 
     def _computation(self):
-        ratios = []
-        twitter_users_ratios = {}
-
-        for u in self.twitter_users.all():
-            days = (u.updated_at.date() - u.created_at.date()).days + 1
-            ratio = decimal.Decimal(u.statuses_count) / decimal.Decimal(days)
-            ratios.append(ratio)
-            twitter_users_ratios[u.id_int] = ratio
-            u.add_fact(self,'Tweets per day %.2f' % ratio,
-                       'User has an average of %f tweets per day as of %s' % (ratio,timezone.now()))
-
-        average = statistics.mean(ratios)
-        std = statistics.stdev(ratios)
-        ratios.sort(reverse=True)
-        cutoff_value = std * self.how_many_standard_deviations
-        outliers_ids = dict(filter(lambda elem: abs(elem[1] - average) > cutoff_value, twitter_users_ratios.items()))
-        outliers_ids = outliers_ids.keys()
-        self.tagged_users.set(self.twitter_users.filter(pk__in=outliers_ids))
-
-        for t in self.tagged_users.all():
-            t.add_fact(self,
-                       'Prolific account', 'User has a ratio of daily tweets since its creation higher than other'
-                       + ' accounts in the campaign (> %.2f)' % cutoff_value)
+        columns = self.load_user_columns(*self.user_columns)
+        dated = ~numpy.isnat(columns[1]) & ~numpy.isnat(columns[2])
+        [ids, created_at, updated_at, statuses_count] = [c[dated] for c in columns]
+        if len(ids) < 2:
+            logger.error('Cannot compute tweet ratio on less than 2 users')
+            return False
+        # days from creation to the last update of the profile, both included
+        days = (updated_at.astype('datetime64[D]') - created_at.astype('datetime64[D]')).astype(int) + 1
+        ratios = numpy.array(statuses_count, dtype=float) / numpy.maximum(days, 1)
+        now = timezone.now()
+        self.add_facts(Fact.TWITTER_USER, (
+            (int(uid), 'Tweets per day %.2f' % ratio, 'User has an average of %f tweets per day as of %s' % (
+                ratio, now)) for uid, ratio in zip(ids, ratios)))
+
+        [outliers, ratio_stats, cutoff_value] = self.get_outliers(ratios, ddof=1)
+        logger.debug('Tweet ratios: %s' % ratio_stats)
+        set_relation_ids(self.tagged_users, ids[outliers].tolist())
+
+        self.add_user_facts(
+            ids[outliers].tolist(),
+            'Prolific account', 'User has a ratio of daily tweets since its creation higher than other'
+            + ' accounts in the campaign (> %.2f)' % cutoff_value)
         return True
 
 
-class MetricFriendsFollowersRatio(Metric):
-    target_type = Metric.TARGET_USERS
-    how_many_standard_deviations = models.PositiveSmallIntegerField(default=3)
+class MetricFriendsFollowersRatio(OutlierMetric):
     description = 'Find users with an outlier friends/followers ratio'
+    user_columns = ('id_int', 'friends_count', 'followers_count')
 
     def _computation(self):
-        target = self.twitter_users.all().annotate(
-            ratio=Coalesce(F('friends_count') / (F('followers_count') + 0.00001), 0)).order_by('-ratio')
-        average = target.aggregate(Avg('ratio'))['ratio__avg']
-        try:
-            std = target.aggregate(StdDev('ratio'))['ratio__stddev']
-        except:
-            ratios = [decimal.Decimal(i) for i in target.values_list('ratio', flat=True)]
-            std = statistics.stdev(ratios)
+        [ids, friends, followers] = self.load_user_columns(*self.user_columns)
+        ratios = numpy.array(friends, dtype=float) / (numpy.array(followers, dtype=float) + 0.00001)
+        ratios = numpy.nan_to_num(ratios, nan=0.0)
+        [outliers, ratio_stats, cutoff_value] = self.get_outliers(ratios)
+        logger.debug('Friends/followers ratios: %s' % ratio_stats)
+        set_relation_ids(self.tagged_users, ids[outliers].tolist())
+
+        self.add_user_facts(
+            ids[outliers].tolist(),
+            'Outlier friend/followers ration', 'User has a ratio of following/followers that is an outlier'
+            + ' in respect to other accounts in the campaign')
 
-        exp_dev = self.how_many_standard_deviations * std
-        outliers = target.annotate(dev=Func(F('ratio') - average, function='ABS')).filter(dev__gt=exp_dev)
-        self.tagged_users.set(outliers)
+        return True
 
-        for t in self.tagged_users.all():
-            t.add_fact(self,
-                       'Outlier friend/followers ration', 'User has a ratio of following/followers that is an outlier'
-                       + ' in respect to other accounts in the campaign')
 
-        return True
+class MetricFriendsFollowersThreshold(UserRuleMetric):
+    template_form = 'metrics/forms/MetricFriendsFollowersThreshold.html'
+    description = 'Find users following many more accounts than the ones following them'
+    threshold = models.FloatField(default=10, help_text='Minimum friends/followers ratio of the tagged users')
+    min_friends = models.PositiveIntegerField(default=100, help_text='Minimum number of friends of the tagged users')
+    user_columns = ('id_int', 'friends_count', 'followers_count')
+
+    def set_params_from_req(self, post_dict):
+        self.name = post_dict['metric_name']
+        self.custom_description = post_dict['metric_description']
+        if post_dict.get('metric_threshold'):
+            self.threshold = max(float(post_dict['metric_threshold']), 0)
+        if post_dict.get('metric_min_friends'):
+            self.min_friends = max(int(post_dict['metric_min_friends']), 0)
+        self.save()
+
+    def get_user_tag(self):
+        return 'Follows %g times its followers' % self.threshold
+
+    def get_rule(self):
+        return rules.ratio_at_least('friends_count', 'followers_count', self.threshold) & rules.at_least(
+            'friends_count', self.min_friends)
+
+    def get_fact(self):
+        return 'High friends/followers ratio', \
+               'User follows at least %g times as many accounts as the ones following it' % self.threshold
+
+    def get_campaign_fact(self, total, tagged):
+        return '%.2f %% users following %g times their followers' % (self.value, self.threshold), \
+               'On %d users, %d (%.4f) follow at least %d accounts and %g times as many as their followers' % (
+                   total, tagged, self.value, self.min_friends, self.threshold)
 
 
-class MetricUsernameWithRegex(Metric):
+class MetricUsernameWithRegex(UserRuleMetric):
     template_form = 'metrics/forms/MetricUsernameWithRegex.html'
     template_custom_fields = 'metrics/custom_fields/MetricUsernameWithRegex.html'
-    target_type = Metric.TARGET_USERS
     regex = models.CharField(max_length=1000, default="^([A-Za-z]+[-A-Za-z0-9_]+[0-9]{8})")
     description = 'Find users whose screen names satisfy a given regex'
+    user_columns = ('id_int', 'screen_name')
 
     def set_params_from_req(self, post_dict):
         self.name = post_dict['metric_name']
@@ -290,20 +579,16 @@ class MetricUsernameWithRegex(Metric):
             self.description += '\nAn invalid regex was provided. Default one was used instead'
         self.save()
 
-    def _computation(self):
-        target = self.twitter_users.filter(screen_name__regex=self.regex)
-        self.tagged_users.set(target)
-        percentage = decimal.Decimal(self.tagged_users.count()) / decimal.Decimal(self.twitter_users.count()) * 100
-        self.value = round(percentage, 10)
+    def get_rule(self):
+        return rules.matches('screen_name', self.regex)
 
-        for t in self.tagged_users.all():
-            t.add_fact(self, 'Standard username',
-                       'User displays a username that ends with 8 digits, as default usernames assigned by Twitter')
-        if self.campaign_wide:
-            self.campaign.add_fact(self, '%.2f%% usernames with 8 digits' % self.value,
-                                   'On %d users, %d (%.4f) have a username ending with 8 digits' % (
-                                       self.twitter_users.count(), self.tagged_users.count(), self.value))
-        return True
+    def get_fact(self):
+        return 'Standard username', \
+               'User displays a username that ends with 8 digits, as default usernames assigned by Twitter'
+
+    def get_campaign_fact(self, total, tagged):
+        return '%.2f%% usernames with 8 digits' % self.value, \
+               'On %d users, %d (%.4f) have a username ending with 8 digits' % (total, tagged, self.value)
 
 
 class TweetDistributionPoint(models.Model):
@@ -352,111 +637,159 @@ class MetricTweetTimeDistribution(Metric):
     template_file = 'metrics/MetricTweetTimeDistribution.html'
     target_type = Metric.TARGET_TWEETS
     description = 'Compute the distribution of tweets over time'
-    distribution_json = models.TextField()
-
-    def get_json(self):
-        if self.distribution_json:
-            return mark_safe(self.distribution_json)
-        # returns the javascript dictionary used in d3 histograms
-        items = [{'date': 'new Date(\'%s\')' % u.inserted_at.strftime('%Y-%m-%d %H:%M:%S'), 'id_str': u.id_str,
-                  'screen_name': u.author.screen_name, 'author_id_str': u.author.id_str} for u in self.tweets.all()]
-        # remove double quotes around "new Date(...)"
-        self.distribution_json = jsonpkg.dumps(items).replace('"new Date(', 'new Date(').replace(')"', ')')
-        self.save()
-        return mark_safe(self.distribution_json)
+    incremental = True
+    result_fields = ('distribution_file',)
+    # columns of the tweets loaded by the d3 histogram
+    distribution_file = models.FileField(null=True)
+
+    def get_json_url(self):
+        if not self.distribution_file:
+            columns = ('date', 'id_str', 'screen_name', 'author_id_str')
+            rows = self.iterate(self.tweets.order_by(), 'inserted_at', 'id_str', 'author__screen_name',
+                                'author__id_str', chunk_size=stats.FETCH_SIZE)
+            _save_columns(self.distribution_file, 'distribution-%d.json' % self.id, rows, columns)
+        return self.distribution_file.url
 
     def _computation(self):
-        ordered_tweets = self.tweets.all().annotate(
-            created_hour=Extract('created_at', 'hour'), created_weekday=Extract('created_at', 'week_day'),
-            created_date=TruncDay('created_at'))
-        tweets_per_weekday = ordered_tweets.values('created_weekday').annotate(
-            c_wday=Count('created_weekday')).order_by('c_wday')
-        tweets_per_hour = ordered_tweets.values('created_hour').annotate(
-            c_hour=Count('created_hour')).order_by('c_hour')
-        tweets_per_date = ordered_tweets.values('created_date').annotate(
-            c_date=Count('created_date')).order_by('c_date')
-
-        dated_distribution = TweetDatedDistribution.objects.create(metric=self, frequency='d')
-        weekly_distribution = TweetLabeledDistribution.objects.create(metric=self, frequency='w')
-        hourly_distribution = TweetLabeledDistribution.objects.create(metric=self, frequency='h')
-
-        TweetDistributionDate.objects.bulk_create([TweetDistributionDate(
-            counter=i['c_date'], date=i['created_date'], distribution=dated_distribution) for i in tweets_per_date])
-        TweetDistributionPoint.objects.bulk_create([TweetDistributionPoint(
-            counter=i['c_hour'], label=i['created_hour'], distribution=hourly_distribution) for i in tweets_per_hour])
-        TweetDistributionPoint.objects.bulk_create([TweetDistributionPoint(
-            counter=i['c_wday'], label=i['created_weekday'],
-            distribution=weekly_distribution) for i in tweets_per_weekday])
-
+        self.dated_distributions.all().delete()
+        self.labeled_distributions.all().delete()
+        return self._incremental_computation(self.tweets.all(), None)
+
+    def _incremental_computation(self, tweets, twitter_users):
+        dated_distribution = self.dated_distributions.filter(frequency='d').first() or \
+            TweetDatedDistribution.objects.create(metric=self, frequency='d')
+        weekly_distribution = self.labeled_distributions.filter(frequency='w').first() or \
+            TweetLabeledDistribution.objects.create(metric=self, frequency='w')
+        hourly_distribution = self.labeled_distributions.filter(frequency='h').first() or \
+            TweetLabeledDistribution.objects.create(metric=self, frequency='h')
+
+        tweets = tweets.filter(created_at__isnull=False)
+        _merge_counters(TweetDistributionDate, dated_distribution, 'date',
+                        _count_by(tweets, date=TruncDate('created_at')))
+        _merge_counters(TweetDistributionPoint, hourly_distribution, 'label',
+                        _count_by(tweets, label=Extract('created_at', 'hour')))
+        _merge_counters(TweetDistributionPoint, weekly_distribution, 'label',
+                        _count_by(tweets, label=Extract('created_at', 'week_day')))
+        self.distribution_file.delete(save=False)
         return True
 
 
+@receiver(pre_delete, sender=MetricCreationDateDistribution)
+@receiver(pre_delete, sender=MetricTweetTimeDistribution)
+def delete_distribution_file(sender, instance, **kwargs):
+    try:
+        instance.distribution_file.delete(save=False)
+    except Exception as ex:
+        logger.error('Cannot remove distribution file: %s' % ex)
+
+
 def _generate_js_graph(nodes, edges, pos, blocks, user_attributes, out_degrees, weights, min_degree=-1):
-    """ Generates a json with nodes and links that can be read by d3.js force
+    """ Generates the nodes and the links of a json that can be read by d3.js force, see _write_js_graph
     :param nodes:
     :param edges:
     :param pos: provides initial coordinates. Currently not used
     :param blocks: provides the identified community for colors
     :param user_attributes:
-    :param out_degrees:
+    :param out_degrees: array with the out degree of each node
     :param weights:
     :param min_degree: only consider nodes that have at least this out_degree
     """
 
     # node with highest degree is x time bigger - for SVG image
     MAX_SCALE = 6
-    logger.debug("[*] Starting to generate d3.js compatible graph...")
-
-    data = {'nodes': [], 'links': []}
-    max_degree = max(out_degrees.values())
-
-    logger.debug("[*] Adding nodes...")
-    for n in nodes:
-        if out_degrees[n] >= min_degree:
-            n = int(n)
-            id_str = user_attributes[n][0]
-            size = round(int(out_degrees[n]) * MAX_SCALE / max_degree, 2)
-            size = size if size == size else round(1 * MAX_SCALE / max_degree, 2)
-            # you think I am crazy, but NaN != NaN : )
-            data['nodes'].append({
-                "id": n,
-                "id_str": id_str,
-                "screen_name": 'ID: %s' % id_str if user_attributes[n][1] is None else user_attributes[n][1],
-                "name": user_attributes[n][2],
-                # "x": pos[n][0],
-                # "y": pos[n][1],
-                "degree": int(out_degrees[n]),
-                # "size": size,
-                "group": blocks[n],
-                # "color": colors[n]
-            })
-
-    logger.debug("[*] Adding edges json...")
-    # Edges
-    c = 0
-    for e in edges:
-        n = int(e[0])
-        m = int(e[1])
-        if out_degrees[n] >= min_degree and out_degrees[m] >= min_degree:
-            c += 1
-            if n <= m:
-                edge_id = '%d-%d' % (n, m)
-            else:
-                edge_id = '%d-%d' % (m, n)
-
-            data['links'].append({
-                "id": 'e%d' % c,
-                # "label": txids[i],
-                "source": n,
-                "target": m,
-                # "color": "rgba(190,190,190,0.4)", # Last digit is transparency
-                # "type": 'arrow',
-                "weight": weights[edge_id]
-                # "size": weights[i]
-            })
-
+    max_degree = out_degrees.max() if len(out_degrees) else 0
+
+    def generate_nodes():
+        logger.debug("[*] Adding nodes...")
+        for n in nodes:
+            if out_degrees[n] >= min_degree:
+                n = int(n)
+                id_str = user_attributes[n][0]
+                size = round(int(out_degrees[n]) * MAX_SCALE / max_degree, 2)
+                size = size if size == size else round(1 * MAX_SCALE / max_degree, 2)
+                # you think I am crazy, but NaN != NaN : )
+                yield {
+                    "id": n,
+                    "id_str": id_str,
+                    "screen_name": 'ID: %s' % id_str if user_attributes[n][1] is None else user_attributes[n][1],
+                    "name": user_attributes[n][2],
+                    # "x": pos[n][0],
+                    # "y": pos[n][1],
+                    "degree": int(out_degrees[n]),
+                    # "size": size,
+                    "group": int(blocks[n]),
+                    # "color": colors[n]
+                }
+
+    def generate_links():
+        logger.debug("[*] Adding edges json...")
+        # Edges
+        c = 0
+        for e in edges:
+            n = int(e[0])
+            m = int(e[1])
+            if out_degrees[n] >= min_degree and out_degrees[m] >= min_degree:
+                c += 1
+                if n <= m:
+                    edge_id = '%d-%d' % (n, m)
+                else:
+                    edge_id = '%d-%d' % (m, n)
+
+                yield {
+                    "id": 'e%d' % c,
+                    # "label": txids[i],
+                    "source": n,
+                    "target": m,
+                    # "color": "rgba(190,190,190,0.4)", # Last digit is transparency
+                    # "type": 'arrow',
+                    "weight": weights[edge_id]
+                    # "size": weights[i]
+                }
+
+    return {'nodes': generate_nodes(), 'links': generate_links()}
+
+
+def _write_js_graph(path, data):
+    """ Writes the json with the nodes and links generated by _generate_js_graph one element at a time """
+    with open(path, 'w') as j:
+        for [n, key] in enumerate(['nodes', 'links']):
+            j.write('%s%s: [' % (', ' if n else '{', jsonpkg.dumps(key)))
+            for [i, element] in enumerate(data[key]):
+                if i:
+                    j.write(', ')
+                jsonpkg.dump(element, j)
+            j.write(']')
+        j.write('}')
     logger.debug("Graph json created")
-    return data
+
+
+def _create_communities(metric, vertices, user_attributes, blocks):
+    """ Creates a community for each block of the graph, adding its users with bulk inserts """
+    logger.debug('Creating new communities')
+    communities = {}
+    for v in vertices:
+        # the primary key of the user is the last attribute
+        communities.setdefault(int(blocks[v]), []).append(user_attributes[int(v)][-1])
+    memberships = []
+    for c in communities:
+        community = Community.objects.create(
+            metric=metric, name='Network community %d' % c, block_id=c,
+            description='Automatically computed community with elements from block %d' % c)
+        memberships.extend(Community.twitter_users.through(community_id=community.id, twitteruser_id=pk)
+                           for pk in communities[c])
+        if len(memberships) >= metric.FACTS_BATCH_SIZE:
+            Community.twitter_users.through.objects.bulk_create(memberships)
+            memberships = []
+    Community.twitter_users.through.objects.bulk_create(memberships)
+
+
+def _set_matplotlib_config_dir():
+    """
+    Graph drawing libraries are imported by the graph metrics when they are computed, not by every process loading
+    the models: matplotlib (used by graph_tool) needs a writable configuration directory
+    """
+    if 'MPLCONFIGDIR' not in os.environ:
+        os.environ['MPLCONFIGDIR'] = tempfile.mkdtemp()
 
 
 def _add_edge(graph, n, m, weights, interaction_type=0):
@@ -490,43 +823,63 @@ class MetricGraphTweetNetwork(Metric):
         super().set_target(twitter_users, tweets)
         if twitter_users is not None:
             tweets = Tweet.objects.filter(author__in=twitter_users).distinct()
-            self.tweets.set(tweets)
+            set_relation(self.tweets, tweets)
         else:
-            self.tweets.set(Tweet.objects.filter(pk__in=tweets).distinct())
-        self.all_tweets.set(Tweet.objects.filter(
+            set_relation(self.tweets, Tweet.objects.filter(pk__in=tweets))
+        set_relation(self.all_tweets, Tweet.objects.filter(
             Q(pk__in=tweets) | Q(retweeted_status__in=tweets) | Q(in_reply_to_tweet__in=tweets) | Q(
                 quoted_status__in=tweets) | Q(original_retweeted__in=tweets) | Q(original_quoted__in=tweets) | Q(
-                replies__in=tweets)).distinct())
-        self.all_twitter_users.set(TwitterUser.objects.filter(tweets_authored__in=self.all_tweets.all()).distinct())
+                replies__in=tweets)))
+        set_relation(self.all_twitter_users, TwitterUser.objects.filter(tweets_authored__in=self.all_tweets.all()))
         self.target_set = True
+        # the target tweets of users are known only now
+        self.set_fingerprints()
         self.save()
 
     def create_communities(self, vertices, user_attributes, blocks):
-        logger.debug('Creating new communities')
-        communities = {}
-        for v in vertices:
-            com_index = blocks[v]
-            if com_index in communities.keys():
-                communities[com_index].append(user_attributes[int(v)][0])
-            else:
-                communities[com_index] = [user_attributes[int(v)][0]]
-        for c in communities:
-            community = Community.objects.create(metric=self)
-            for u in communities[c]:
-                community.twitter_users.add(TwitterUser.objects.get(id_str=u))
-            community.name = 'Network community %d' % c
-            community.description = 'Automatically computed community with elements from block %d' % c
-            community.block_id = c
-            community.save()
+        _create_communities(self, vertices, user_attributes, blocks)
+
+    def get_interactions(self):
+        """
+        Yields (source, destination, interaction type) for the interactions between users in the target tweets,
+        reading chunks of tweets with the ids of the users involved and the mentions of each chunk at once
+        """
+        mentions = Tweet.twitter_user_mentioned.through.objects
+        for chunk in self.iterate_chunks(self.tweets.all(), 'pk', 'author_id', 'in_reply_to_tweet__author_id',
+                                         'retweeted_status__author_id', 'quoted_status__author_id'):
+            mentioned = {}
+            for [tweet_id, user_id] in mentions.filter(tweet_id__in=[t[0] for t in chunk]).values_list(
+                    'tweet_id', 'twitteruser_id'):
+                mentioned.setdefault(tweet_id, []).append(user_id)
+            for [tweet_id, author, replied, retweeted, quoted] in chunk:
+                # Reply: when user a replies to user b, add edge from a to b
+                if replied is not None:
+                    yield author, replied, 1
+                # Mention: when user a mentions b, add  edge from a to b
+                for user_id in mentioned.get(tweet_id, ()):
+                    yield author, user_id, 2
+                # Retweet: when user a retweets user b, add edge from b to a
+                if retweeted is not None:
+                    yield retweeted, author, 3
+                # Quote: when user a quotes user b, add edge from b to a.
+                if quoted is not None:
+                    yield quoted, author, 4
 
     def _computation(self):
+        _set_matplotlib_config_dir()
+        from graph_tool.all import Graph, minimize_blockmodel_dl, prop_to_size, sfdp_layout
+        from svglib.svglib import svg2rlg
+        from reportlab.graphics import renderPM
+
         # create output files
         json_file = ContentFile('', '%d.json' % self.id)
         svg_file = ContentFile('', '%d.svg' % self.id)
         png_file = ContentFile('', '%d.png' % self.id)
         xml_file = ContentFile('', '%d.graphml' % self.id)
         community_graph = CommunityGraph(metric=self, svg=svg_file, png=png_file, json=json_file, xml=xml_file)
-        user_attributes = self.all_twitter_users.values_list('id_str', 'screen_name', 'name', 'created_at')
+        # the position in the list is the vertex index, the primary key is last
+        user_attributes = list(self.iterate(
+            self.all_twitter_users.all(), 'id_str', 'screen_name', 'name', 'created_at', 'pk'))
 
         # create a graph
         g = Graph(directed=True)
@@ -535,17 +888,17 @@ class MetricGraphTweetNetwork(Metric):
         v_name = g.new_vertex_property("string")
         v_created_at = g.new_vertex_property("string")
 
-        # dictionary to keep track of vertex index and its related id_str
+        # dictionary to keep track of vertex index and its related user
         indexes = {}
 
         logger.debug("[*] Adding nodes")
-        for i in range(len(user_attributes)):
-            indexes[user_attributes[i][0]] = i
+        for [i, [id_str, screen_name, name, created_at, pk]] in enumerate(user_attributes):
+            indexes[pk] = i
             v = g.add_vertex()
-            v_id_str[v] = user_attributes[i][0]
-            v_screen_name[v] = user_attributes[i][1]
-            v_name[v] = user_attributes[i][2]
-            v_created_at[v] = user_attributes[i][3].strftime('%Y-%m-%d %H:%M')
+            v_id_str[v] = id_str
+            v_screen_name[v] = screen_name
+            v_name[v] = name
+            v_created_at[v] = created_at.strftime('%Y-%m-%d %H:%M')
 
         # save properties as internal in graph
         g.vertex_properties['id_str'] = v_id_str
@@ -563,34 +916,11 @@ class MetricGraphTweetNetwork(Metric):
         g.edge_properties['interaction_type'] = eprop2
 
         logger.debug("[*] Adding edges")
-        for t in self.tweets.all():
-            # Reply: when user a replies to user b, add edge from a to b
-            if t.in_reply_to_tweet:
-                try:
-                    [weights, g] = _add_edge(
-                        g, indexes[t.author.id_str], indexes[t.in_reply_to_tweet.author.id_str], weights, 1)
-                except Exception as ex:
-                    logger.warning(ex)
-            # Mention: when user a mentions b, add  edge from a to b
-            for u in t.twitter_user_mentioned.all():
-                try:
-                    [weights, g] = _add_edge(g, indexes[t.author.id_str], indexes[u.id_str], weights, 2)
-                except Exception as ex:
-                    logger.warning(ex)
-            # Retweet: when user a retweets user b, add edge from b to a
-            if t.retweeted_status:
-                try:
-                    [weights, g] = _add_edge(
-                        g, indexes[t.retweeted_status.author.id_str], indexes[t.author.id_str], weights, 3)
-                except Exception as ex:
-                    logger.warning(ex)
-            # Quote: when user a quotes user b, add edge from b to a.
-            if t.quoted_status:
-                try:
-                    [weights, g] = _add_edge(g, indexes[t.quoted_status.author.id_str], indexes[t.author.id_str],
-                                             weights, 4)
-                except Exception as ex:
-                    logger.warning(ex)
+        for [source, destination, interaction_type] in self.get_interactions():
+            try:
+                [weights, g] = _add_edge(g, indexes[source], indexes[destination], weights, interaction_type)
+            except Exception as ex:
+                logger.warning(ex)
 
         community_graph.save()
 
@@ -599,7 +929,7 @@ class MetricGraphTweetNetwork(Metric):
 
         logger.debug('[*] Computing graph degree')
         vertices = g.get_vertices()
-        out_degrees = {i: g.get_out_degrees([i])[0] for i in range(len(vertices))}
+        out_degrees = g.get_out_degrees(vertices)
 
         logger.debug('[*] Computing graph position')
         pos = sfdp_layout(g)
@@ -623,8 +953,7 @@ class MetricGraphTweetNetwork(Metric):
         logger.debug('[*] Getting json data')
         data = _generate_js_graph(vertices, edges, pos, blocks, user_attributes, out_degrees, weights, self.min_degree)
         logger.debug('[*] Writing json data %s' % community_graph.json.path)
-        with open(community_graph.json.path, 'w') as j:
-            jsonpkg.dump(data, j)
+        _write_js_graph(community_graph.json.path, data)
 
         return True
 
@@ -658,26 +987,7 @@ class MetricGraphCommunityNetwork(Metric):
         self.save()
 
     def create_communities(self, vertices, user_attributes, blocks):
-        logger.debug('Creating new communities')
-        communities = {}
-        for v in vertices:
-            com_index = blocks[v]
-            if com_index in communities.keys():
-                communities[com_index].append(user_attributes[int(v)][0])
-            else:
-                communities[com_index] = [user_attributes[int(v)][0]]
-        for c in communities:
-            community = Community.objects.create(metric=self)
-            for u in communities[c]:
-                try:
-                    community.twitter_users.add(TwitterUser.objects.get(id_str=u))
-                except Exception as ex:
-                    logger.error('Error while adding user %s to community' % u)
-                    logger.error(ex)
-            community.name = 'Network community %d' % c
-            community.description = 'Automatically computed community with elements from block %d' % c
-            community.block_id = c
-            community.save()
+        _create_communities(self, vertices, user_attributes, blocks)
 
     def _computation(self):
         if self.twitter_users.count() > self.max_twitter_users:
@@ -693,17 +1003,15 @@ class MetricGraphCommunityNetwork(Metric):
                 operation.max_followers = self.max_followers
                 operation.save()
                 operation.run()
-            # If we are still retrieving the community graph, reschedule metric
-            sleeptime = 10
-            logger.debug('Sleeping %d seconds' % sleeptime)
-            time.sleep(sleeptime)
-            with transaction.atomic():
-                op = OperationConstructNetwork.objects.select_for_update().get(pk=operation.id)
-                if op and not op.is_finished():
-                    logger.debug('Still getting followers and friends')
-                    backoff = timedelta(minutes=15)
-                    self.compute(schedule=backoff, start=False)
-                    return False
+            # If we are still retrieving the community graph, the operation will resume the metric when done
+            if not operation.add_dependent_metric(self):
+                logger.debug('Still getting followers and friends')
+                return False
+        _set_matplotlib_config_dir()
+        from graph_tool.all import Graph, minimize_blockmodel_dl, prop_to_size, sfdp_layout
+        from svglib.svglib import svg2rlg
+        from reportlab.graphics import renderPM
+
         # create output files
         json_file = ContentFile('', 'community-%d.json' % self.id)
         svg_file = ContentFile('', 'community-%d.svg' % self.id)
@@ -717,7 +1025,8 @@ class MetricGraphCommunityNetwork(Metric):
             Q(pk__in=self.twitter_users.all())
             | Q(followed_by__in=self.twitter_users.all())
             | Q(friended_by__in=self.twitter_users.all())).distinct()
-        user_attributes = all_users.values_list('id_str', 'screen_name', 'name', 'created_at')
+        # the position in the list is the vertex index, the primary key is last
+        user_attributes = list(self.iterate(all_users, 'id_str', 'screen_name', 'name', 'created_at', 'pk'))
 
         g = Graph(directed=True)
         v_id_str = g.new_vertex_property("string")
@@ -725,21 +1034,20 @@ class MetricGraphCommunityNetwork(Metric):
         v_name = g.new_vertex_property("string")
         v_created_at = g.new_vertex_property("string")
 
-        # dictionary to keep track of vertex index and its related id_str
+        # dictionary to keep track of vertex index and its related user
         indexes = {}
         logger.debug("[*] Adding nodes")
-        for i in range(len(user_attributes)):
-            indexes[user_attributes[i][0]] = i
+        for [i, [id_str, screen_name, name, created_at, pk]] in enumerate(user_attributes):
+            indexes[pk] = i
             v = g.add_vertex()
-            if not user_attributes[i][0]:
-                logger.error('Empty user!')
-                print(user_attributes[i])
+            if not id_str:
+                logger.error('Empty user %s!' % pk)
             else:
-                v_id_str[v] = user_attributes[i][0]
-                v_screen_name[v] = user_attributes[i][1]
-                v_name[v] = user_attributes[i][2]
+                v_id_str[v] = id_str
+                v_screen_name[v] = screen_name
+                v_name[v] = name
                 try:
-                    v_created_at[v] = user_attributes[i][3].strftime('%Y-%m-%d %H:%M')
+                    v_created_at[v] = created_at.strftime('%Y-%m-%d %H:%M')
                 except:
                     v_created_at[v] = ''
 
@@ -758,18 +1066,14 @@ class MetricGraphCommunityNetwork(Metric):
         g.edge_properties['interaction_type'] = eprop2
 
         logger.debug("[*] Adding edges")
-        for u in self.twitter_users.all():
-            for f in u.followers.all():
-                try:
-                    [weights, g] = _add_edge(g, indexes[f.id_str], indexes[u.id_str], weights)
-                except Exception as ex:
-                    logger.warning('Could not add follower edge from %s to %s' % (u.id_str, f.id_str))
-                    logger.warning(ex)
-            for f in u.friends.all():
+        # followers and friends f of each user u, read from the tables of the relations
+        for relation in [TwitterUser.followers, TwitterUser.friends]:
+            links = relation.through.objects.filter(from_twitteruser__in=self.twitter_users.all())
+            for [u, f] in self.iterate(links, 'from_twitteruser_id', 'to_twitteruser_id'):
                 try:
-                    [weights, g] = _add_edge(g, indexes[f.id_str], indexes[u.id_str], weights)
+                    [weights, g] = _add_edge(g, indexes[f], indexes[u], weights)
                 except Exception as ex:
-                    logger.warning('Could not add friend edge from %s to %s' % (f.id_str, u.id_str))
+                    logger.warning('Could not add edge from %s to %s' % (f, u))
                     logger.warning(ex)
 
         community_graph.save()
@@ -779,7 +1083,7 @@ class MetricGraphCommunityNetwork(Metric):
 
         print('[*] Computing graph degree')
         vertices = g.get_vertices()
-        out_degrees = {i: g.get_out_degrees([i])[0] for i in range(len(vertices))}
+        out_degrees = g.get_out_degrees(vertices)
 
         print('[*] Computing graph position')
         pos = sfdp_layout(g)
@@ -803,8 +1107,7 @@ class MetricGraphCommunityNetwork(Metric):
         logger.debug('[*] Getting json data')
         data = _generate_js_graph(vertices, edges, pos, blocks, user_attributes, out_degrees, weights, self.min_degree)
         logger.debug('[*] Writing json data %s' % community_graph.json.path)
-        with open(community_graph.json.path, 'w') as j:
-            jsonpkg.dump(data, j)
+        _write_js_graph(community_graph.json.path, data)
 
         return True
 
@@ -849,56 +1152,30 @@ class MetricActivityPattern(Metric):
                 operation.days_interval = self.days_interval
                 operation.save()
                 operation.run()
-            # If we are still retrieving tweets, reschedule metric
-            sleeptime = 10
-            logger.debug('Sleeping %d seconds' % sleeptime)
-            time.sleep(sleeptime)
-            with transaction.atomic():
-                op = OperationRetrieveTweets.objects.select_for_update().get(pk=operation.id)
-                if op and not op.is_finished():
-                    logger.debug('Still getting tweets...')
-                    backoff = timedelta(minutes=15)
-                    self.compute(schedule=backoff, start=False)
-                    return False
-
-        sequences = []
-        uids = []
-        for user in self.twitter_users.all():
-            sequences.append(user.get_sequence_string())
-            uids.append(user.id_int)
-            logger.debug(user.get_sequence_string())
-
-        # will store all matches longer than threshold and relative users
-        patterns = {}
-        for i in range(0,len(sequences)-1):
-            for j in range(i+1, len(sequences)):
-                logger.debug('Computing similarity between %d and %d' % (uids[i], uids[j]))
-                match = SequenceMatcher(None, sequences[i], sequences[j], autojunk=False).find_longest_match(0, len(sequences[i]), 0, len(sequences[j]))
-                if match.size >= self.similarity_threshold:
-                    u_i = self.twitter_users.get(pk=uids[i])
-                    u_j = self.twitter_users.get(pk=uids[j])
-                    pattern = sequences[i][match.a: match.a + match.size]
-                    if pattern in patterns.keys():
-                        patterns[pattern].append(u_j)
-                        patterns[pattern].append(u_i)
-                    else:
-                        patterns[pattern] = [u_j, u_i]
-                    self.tagged_users.add(u_i)
-                    self.tagged_users.add(u_j)
-                    logger.debug('Found similar activity between %s and %s: %s' % (
-                        u_i.screen_name, u_j.screen_name, pattern))
+            # If we are still retrieving tweets, the operation will resume the metric when done
+            if not operation.add_dependent_metric(self):
+                logger.debug('Still getting tweets...')
+                return False
+
+        user_sequences = TwitterUser.get_sequences(self.twitter_users.all())
+        uids = sorted(user_sequences.keys())
+        sequences = [user_sequences[uid].decode() for uid in uids]
+
+        # pattern -> positions in uids of the users sharing it
+        patterns = find_common_patterns(
+            sequences, self.similarity_threshold, processes=settings.ACTIVITY_PATTERN_PROCESSES)
+        logger.debug('Found %d activity patterns' % len(patterns))
+        set_relation_ids(self.tagged_users, [uids[i] for users in patterns.values() for i in users])
 
         logger.debug('Creating communities')
+        memberships = []
         for p in patterns:
-            community = Community(metric=self)
-            community.campaign = self.campaign
-            community.description = 'Users with activity pattern %s' % (p)
-            community.name = 'Activity pattern community of length %d' % len(p)
-            users = set(patterns[p])
-            logger.debug('adding users to community %s' % p)
-            logger.debug(users)
-            community.save()
-            community.twitter_users.set(users)
+            community = Community.objects.create(
+                metric=self, campaign=self.campaign, description='Users with activity pattern %s' % p,
+                name='Activity pattern community of length %d' % len(p))
+            memberships.extend(Community.twitter_users.through(community_id=community.id, twitteruser_id=uids[i])
+                               for i in patterns[p])
+        Community.twitter_users.through.objects.bulk_create(memberships, batch_size=self.FACTS_BATCH_SIZE)
 
         return True
 
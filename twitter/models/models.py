@@ -1,13 +1,20 @@
 import atexit
+import collections
+import decimal
 import enum
+import hashlib
+import itertools
 import os
 import pytz
 import tweepy
 import requests
 import logging
+import numpy
 import uuid
+import json as jsonpkg
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 from autoslug import AutoSlugField
 from taggit.managers import TaggableManager
@@ -15,14 +22,17 @@ from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
 from model_utils.managers import InheritanceManager
-from django.db import models, transaction
-from django.db.models import Count
+from django.db import connection, models, transaction
+from django.db.models import Count, Max, Sum, F
 from django.core.files.base import ContentFile
-from django.db.models.signals import pre_delete
+from django.db.models.signals import m2m_changed, pre_delete, post_save, post_delete
 from django.dispatch import receiver
 
-from twitter.tasks import background_stream, background_metric
+from twitter import api_cache, registry, scheduler, snapshots, stats
+from twitter.executors import record_peak_memory
+from twitter.tasks import background_stream, background_metric, background_metric_batch, get_cached_twitter_api, forget_twitter_api
 from background_task.models import Task
+from background_task.signals import task_successful, task_failed
 
 if settings.FUZZY_COUNT:
     from fuzzycount import FuzzyCountManager
@@ -30,6 +40,70 @@ if settings.FUZZY_COUNT:
 logger = logging.getLogger(__name__)
 
 
+def set_relation(manager, queryset, clear=True):
+    """
+    Replacement for manager.set(queryset) on many to many relations: the through table rows are written with a
+    single INSERT ... SELECT built from the queryset, without loading the related ids in Python.
+    The queryset must not read from the through table being replaced. With clear=False the rows are added to the
+    existing ones, and the queryset must not contain objects already related. Returns the number of rows inserted
+    """
+    through = manager.through
+    source_column = through._meta.get_field(manager.source_field_name).column
+    target_column = through._meta.get_field(manager.target_field_name).column
+    [select, params] = queryset.order_by().values('pk').distinct().query.sql_with_params()
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s, %s) SELECT %%s, sub.%s FROM (%s) sub' % (
+        qn(through._meta.db_table), qn(source_column), qn(target_column), qn(queryset.model._meta.pk.column), select)
+    with transaction.atomic():
+        if clear:
+            through.objects.filter(**{manager.source_field_name: manager.instance.pk}).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [manager.instance.pk] + list(params))
+            return cursor.rowcount
+
+
+def set_relation_ids(manager, ids, batch_size=1000, clear=True):
+    """ Like set_relation, for related objects given as a list of primary keys (e.g. computed in Python) """
+    through = manager.through
+    source_field = '%s_id' % manager.source_field_name
+    target_field = '%s_id' % manager.target_field_name
+    with transaction.atomic():
+        if clear:
+            through.objects.filter(**{manager.source_field_name: manager.instance.pk}).delete()
+        through.objects.bulk_create(
+            [through(**{source_field: manager.instance.pk, target_field: pk}) for pk in set(ids)],
+            batch_size=batch_size)
+
+
+def bulk_insert(model, objects, batch_size=1000):
+    """ Saves the objects (any iterable, e.g. a generator) with bulk inserts of batch_size rows, returns how many """
+    objects = iter(objects)
+    counter = 0
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if not batch:
+            return counter
+        model.objects.bulk_create(batch)
+        counter += len(batch)
+
+
+def get_target_fingerprint(campaign_id, tweet_ids, twitter_user_ids):
+    """ Hash identifying a target (sorted iterables of the tweet and user ids) within a campaign """
+    digest = hashlib.sha256(b'%d' % (campaign_id or 0))
+    for ids in [tweet_ids, twitter_user_ids]:
+        digest.update(b'|')
+        for pk in ids:
+            digest.update(b'%d,' % pk)
+    return digest.hexdigest()
+
+
+def _has_targets(targets):
+    """ Tells whether a list or queryset of targets is not empty, without evaluating querysets """
+    if isinstance(targets, models.QuerySet):
+        return targets.exists()
+    return bool(targets)
+
+
 class MyStreamListener(tweepy.Stream):
     streamer = None
     entities = None
@@ -76,11 +150,13 @@ class MyStreamListener(tweepy.Stream):
             statuses.append(status.retweeted_status)
         if hasattr(status, 'quoted_status'):
             statuses.append(status.quoted_status)
+        api = None
         while (self.streamer.max_nested_level < 0 or (
                 nested_level <= self.streamer.max_nested_level and status.in_reply_to_status_id_str)):
-            api = self.streamer.get_twitter_api()
+            if api is None:
+                api = self.streamer.get_twitter_api()
             try:
-                replied_to_status = api.get_status(status.in_reply_to_status_id_str)
+                replied_to_status = api_cache.get_status(api, status.in_reply_to_status_id_str)
                 statuses.append(replied_to_status)
             except tweepy.RateLimitError:
                 logger.warning('Tweepy rate limit reached in get status. Skipping')
@@ -163,15 +239,17 @@ class TwitterAccount(models.Model):
             'access_token_secret': self.access_token_secret}
 
     def get_twitter_api(self):
-        api_keys = self.get_api_keys()
-        auth = tweepy.OAuthHandler(api_keys['consumer_key'], api_keys['consumer_secret'])
-        auth.set_access_token(api_keys['access_token'], api_keys['access_token_secret'])
-        return tweepy.API(auth, wait_on_rate_limit=True)
+        return get_cached_twitter_api(self.get_api_keys(), account_id=self.pk)
 
     def __str__(self):
         return self.name
 
 
+@receiver([post_save, post_delete], sender=TwitterAccount)
+def forget_account_api(sender, instance, **kwargs):
+    forget_twitter_api(instance.pk)
+
+
 class Entity(models.Model):
     HASHTAG = 'HH'
     TEXT_OR = 'TO'
@@ -512,6 +590,24 @@ class Campaign(models.Model):
     def get_twitter_users_count(self):
         return self.get_tweets().values('author').distinct().count()
 
+    def get_stubs_by_degree(self):
+        """ Returns the ids of the stub users (not filled) linked to the campaign through replies, mentions,
+        followers and friends, sorted by the number of links (the most referenced first) """
+        tweets = self.get_tweets()
+        twitter_users = self.get_twitter_users()
+        degrees = collections.Counter()
+        degrees.update(tweets.filter(
+            in_reply_to_twitteruser__filled=False, in_reply_to_twitteruser__unresolvable=False).values_list(
+            'in_reply_to_twitteruser', flat=True))
+        degrees.update(Tweet.twitter_user_mentioned.through.objects.filter(
+            tweet__in=tweets, twitteruser__filled=False, twitteruser__unresolvable=False).values_list(
+            'twitteruser', flat=True))
+        for relation in [TwitterUser.followers, TwitterUser.friends]:
+            degrees.update(relation.through.objects.filter(
+                from_twitteruser__in=twitter_users, to_twitteruser__filled=False,
+                to_twitteruser__unresolvable=False).values_list('to_twitteruser', flat=True))
+        return [uid for uid, _ in degrees.most_common()]
+
     def get_metrics(self):
         return self.metrics
 
@@ -552,11 +648,184 @@ class Operation(models.Model):
     description = models.TextField(default='')
     computation_start = models.DateTimeField(null=True, blank=True)
     computation_end = models.DateTimeField(null=True, blank=True)
+    dependent_metrics = models.ManyToManyField(
+        'Metric', blank=True, related_name='waiting_operations',
+        help_text='Metrics whose computation is resumed as soon as the operation is finished')
+    chunk_size = models.PositiveIntegerField(default=50, help_text='Number of users processed by each background task')
+    spread_accounts = models.BooleanField(
+        default=True, help_text='Spread chunks across the campaign account and the global accounts')
+
+    def is_finished(self):
+        return False
+
+    def get_accounts(self):
+        """ Returns the Twitter accounts the chunks of the operation are distributed across """
+        campaign = getattr(self, 'campaign', None)
+        accounts = [campaign.account] if campaign and campaign.account else []
+        if self.spread_accounts or not accounts:
+            accounts.extend(TwitterAccount.objects.filter(global_account=True).exclude(pk__in=[a.pk for a in accounts]))
+        return accounts
+
+    def create_chunks(self, kind, twitter_users_ids):
+        """ Splits the target users in chunks of chunk_size users, each to be run as an independent task """
+        if not twitter_users_ids:
+            self.set_kind_finished(kind)
+            self.computation_end = timezone.now()
+            self.save()
+            return []
+        accounts = self.get_accounts()
+        chunks = []
+        for index, start in enumerate(range(0, len(twitter_users_ids), self.chunk_size)):
+            ids = twitter_users_ids[start:start + self.chunk_size]
+            chunks.append(OperationChunk.objects.create(
+                operation_id=self.pk,
+                kind=kind,
+                index=index,
+                twitter_users_ids=jsonpkg.dumps(ids),
+                users_total=len(ids),
+                account=accounts[index % len(accounts)] if accounts else None))
+        logger.debug('Created %d chunks of kind %s for operation %d' % (len(chunks), kind, self.pk))
+        return chunks
+
+    def set_kind_finished(self, kind):
+        """ Called (with the operation row locked) when all chunks of a kind are done """
+        pass
+
+    def chunk_finished(self, chunk_id):
+        """ Marks a chunk as done. The operation is notified when all the chunks of the same kind are done """
+        with transaction.atomic():
+            exclusive_self = type(self).objects.select_for_update().get(pk=self.pk)
+            chunk = OperationChunk.objects.select_for_update().get(pk=chunk_id)
+            chunk.status = OperationChunk.DONE
+            chunk.finished_at = timezone.now()
+            chunk.save()
+            if OperationChunk.objects.filter(operation_id=self.pk, kind=chunk.kind).exclude(
+                    status=OperationChunk.DONE).exists():
+                return
+            logger.debug('All %s chunks of operation %d are done' % (chunk.kind, self.pk))
+            exclusive_self.set_kind_finished(chunk.kind)
+            exclusive_self.computation_end = timezone.now()
+            exclusive_self.save()
+            if exclusive_self.is_finished():
+                exclusive_self.trigger_dependent_metrics()
+
+    def get_progress(self):
+        """ Returns users done, users total and the estimated time of completion """
+        totals = OperationChunk.objects.filter(operation_id=self.pk).aggregate(
+            done=Sum('users_done'), total=Sum('users_total'))
+        done = totals['done'] or 0
+        total = totals['total'] or 0
+        eta = None
+        if done and done < total and self.computation_start:
+            now = timezone.now()
+            eta = now + (now - self.computation_start) * ((total - done) / done)
+        return {'done': done, 'total': total, 'eta': eta}
+
+    def add_dependent_metric(self, metric):
+        """ Registers a metric to be computed as soon as the operation finishes.
+        Returns True if the operation is already finished, in which case the metric is not registered
+        and the caller can go on with its computation """
+        with transaction.atomic():
+            exclusive_self = type(self).objects.select_for_update().get(pk=self.pk)
+            if exclusive_self.is_finished():
+                return True
+            exclusive_self.dependent_metrics.add(metric)
+            logger.debug('Metric %d will be resumed when operation %d finishes' % (metric.id, self.pk))
+            return False
+
+    def trigger_dependent_metrics(self):
+        """ Enqueues the computation of all metrics waiting for the operation.
+        Must be called while holding the lock on the operation row """
+        for metric in self.dependent_metrics.all():
+            logger.debug('Operation %d finished, resuming metric %d' % (self.pk, metric.id))
+            metric.compute(start=False)
+        self.dependent_metrics.clear()
 
     def run(self):
         pass
 
 
+class OperationChunk(models.Model):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done')
+    ]
+    operation = models.ForeignKey('Operation', on_delete=models.CASCADE, related_name='chunks')
+    kind = models.CharField(max_length=30, help_text='Part of the operation the chunk belongs to (followers, tweets...)')
+    index = models.PositiveIntegerField(default=0)
+    twitter_users_ids = models.TextField(default='[]', help_text='JSON list with the id_str of the users in the chunk')
+    account = models.ForeignKey('TwitterAccount', on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=PENDING)
+    users_total = models.PositiveIntegerField(default=0)
+    users_done = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['kind', 'index']
+
+    def get_twitter_users_ids(self):
+        return jsonpkg.loads(self.twitter_users_ids)
+
+    def start(self):
+        # a retried task processes the whole chunk again
+        self.status = OperationChunk.RUNNING
+        self.started_at = timezone.now()
+        self.users_done = 0
+        self.save()
+
+    def inc_done(self, users=1):
+        OperationChunk.objects.filter(pk=self.pk).update(users_done=F('users_done') + users)
+
+    def __str__(self):
+        return 'Chunk %s-%d of operation %d' % (self.kind, self.index, self.operation_id)
+
+
+class ScheduledTask(models.Model):
+    """ Background task scheduled through twitter.scheduler, with the campaign it works for and its wait time """
+    task_id = models.PositiveIntegerField(db_index=True, help_text='Id of the background_task Task')
+    task_name = models.CharField(max_length=255)
+    queue = models.CharField(max_length=255, null=True)
+    task_type = models.CharField(max_length=30)
+    campaign = models.ForeignKey('Campaign', null=True, on_delete=models.CASCADE, related_name='scheduled_tasks')
+    priority = models.IntegerField()
+    scheduled_at = models.DateTimeField(auto_now_add=True)
+    run_at = models.DateTimeField(null=True, help_text='When the task was allowed to run')
+    started_at = models.DateTimeField(null=True, help_text='When a task runner picked the task')
+    running_since = models.DateTimeField(null=True, help_text='When the task took a slot of its type, while it runs')
+    finished_at = models.DateTimeField(null=True)
+    succeeded = models.BooleanField(null=True)
+
+    class Meta:
+        index_together = [['task_type', 'campaign', 'finished_at'], ['task_type', 'running_since']]
+
+    @classmethod
+    def get_wait_stats(cls, **filters):
+        """ Average and max seconds spent in queue by the completed tasks, by task type """
+        stats = {}
+        for task in cls.objects.filter(started_at__isnull=False, **filters).only('task_type', 'run_at', 'started_at'):
+            stats.setdefault(task.task_type, []).append(task.get_wait_seconds())
+        return {k: {'count': len(v), 'avg': sum(v) / len(v), 'max': max(v)} for k, v in stats.items()}
+
+    def get_wait_seconds(self):
+        if self.started_at is None or self.run_at is None:
+            return None
+        return max((self.started_at - self.run_at).total_seconds(), 0)
+
+    def __str__(self):
+        return '%s task %s' % (self.task_type, self.task_name)
+
+
+@receiver([task_successful, task_failed])
+def record_task_completion(sender, task_id, completed_task, signal, **kwargs):
+    ScheduledTask.objects.filter(task_id=task_id, finished_at__isnull=True).update(
+        started_at=completed_task.locked_at, finished_at=timezone.now(), succeeded=signal is task_successful)
+
+
 class Fact(models.Model):
     UNSET = -1
     CAMPAIGN = 0
@@ -623,8 +892,29 @@ class Metric(models.Model):
     TARGET_ANY = 4
     TARGET_BOTH = 5
 
+    SAMPLING_UNIFORM = 'uniform'
+    SAMPLING_DAY = 'day'
+    SAMPLING_AUTHOR = 'author'
+    SAMPLING_CHOICES = [
+        (SAMPLING_UNIFORM, 'Uniform'),
+        (SAMPLING_DAY, 'Stratified by day of creation'),
+        (SAMPLING_AUTHOR, 'Stratified by author'),
+    ]
+    # Parameters of the sampling, part of the fingerprint of metrics computed on a sample
+    SAMPLING_FIELDS = ('sampling', 'sample_size', 'sample_seed', 'confidence')
+
     description = 'Generic description for metric'
     target_type = TARGET_UNDEF
+    # Whether the metric implements _incremental_computation, merging new tweets and users in its results
+    incremental = False
+    # Fields of the subclass holding results rather than parameters, ignored by the fingerprint
+    result_fields = ()
+    # Fields of the target users read by _computation with load_user_columns, loaded once by a MetricBatch
+    user_columns = ()
+    # Columns shared by the metrics of a MetricBatch, field name -> array
+    shared_columns = None
+    # Whether value can be estimated on a sample of a campaign, see set_sample_estimate
+    samplable = False
     template_file = 'metric.html'
     template_form = 'metric_form.html'
     template_custom_fields = None
@@ -653,30 +943,42 @@ class Metric(models.Model):
                                  help_text='Name assigned to the background process carrying out the computation')
     campaign_wide = models.BooleanField(default=False,
                                         help_text='If it refers to the whole campaign or only a selected subset of elements')
+    watermark = models.DateTimeField(null=True, blank=True,
+                                     help_text='Insertion date of the newest campaign tweet included in the target')
+    target_fingerprint = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                                          help_text='Hash of the campaign and of the target tweets and users')
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                                   help_text='Hash of the metric type, its parameters and the target fingerprint')
+    peak_memory = models.PositiveBigIntegerField(
+        null=True, blank=True, help_text='Peak resident memory (bytes) of the process computing the metric')
+    sampling = models.CharField(max_length=16, null=True, blank=True, choices=SAMPLING_CHOICES,
+                                help_text='Compute the metric on a sample of the campaign drawn with this method')
+    sample_size = models.PositiveIntegerField(default=10000, help_text='Number of sampled tweets or users')
+    sample_seed = models.PositiveIntegerField(default=0, help_text='Seed of the random sample, to reproduce it')
+    confidence = models.FloatField(default=0.95, help_text='Confidence level of the interval of the estimate')
+    population_size = models.PositiveIntegerField(null=True, blank=True,
+                                                  help_text='Number of tweets or users the sample was drawn from')
+    population_strata = models.TextField(null=True, blank=True,
+                                         help_text='Json object with the number of elements of each stratum')
+    value_lower = models.DecimalField(null=True, blank=True, max_digits=13, decimal_places=10,
+                                      help_text='Lower bound of the confidence interval of the estimated value')
+    value_upper = models.DecimalField(null=True, blank=True, max_digits=13, decimal_places=10,
+                                      help_text='Upper bound of the confidence interval of the estimated value')
 
     @classmethod
     def get_available_metrics(cls, limit_target=None):
-        metrics = list(filter(lambda x: x.__name__.startswith('Metric'), cls.__subclasses__()))
-        if limit_target == 'twitter_users':
-            metrics = [m for m in metrics if m.target_type in [Metric.TARGET_ANY, Metric.TARGET_USERS]]
-        elif limit_target == 'tweets':
-            metrics = [m for m in metrics if m.target_type in [Metric.TARGET_ANY, Metric.TARGET_TWEETS]]
-        return metrics
+        return registry.get_metrics(limit_target)
 
     @classmethod
     def get_available_metrics_meta(cls, limit_target=None):
-        metrics = cls.get_available_metrics(limit_target)
-        metrics = [{'name': m.__name__, 'description': m.description, 'target_type': m.target_type} for m in metrics]
-        return metrics
+        return registry.get_metrics_meta(limit_target)
 
     @classmethod
     def instantiate(cls, name):
-        metrics = cls.get_available_metrics()
-        metric = list(filter(lambda x: x.__name__ == name, metrics))
-        if len(metric) == 1:
-            return metric[0]
-        else:
+        metric = registry.get_metric(name)
+        if metric is None:
             logger.error('Trying to instantiate metric %s' % name)
+        return metric
 
     def get_absolute_url(self):
         return reverse('metric_detail', args=[self.id])
@@ -705,17 +1007,206 @@ class Metric(models.Model):
         self.campaign = Campaign.objects.get(pk=campaign)
 
     def set_target(self, twitter_users=None, tweets=None):
-        if tweets and self.target_type in [Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_TWEETS]:
-            self.tweets.set(Tweet.objects.filter(pk__in=tweets))
+        if _has_targets(tweets) and self.target_type in [
+                Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_TWEETS]:
+            set_relation(self.tweets, Tweet.objects.filter(pk__in=tweets))
             self.target_set = True
-        if twitter_users and self.target_type in [Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_USERS]:
-            self.twitter_users.set(TwitterUser.objects.filter(pk__in=twitter_users, filled=True))
+        if _has_targets(twitter_users) and self.target_type in [
+                Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_USERS]:
+            set_relation(self.twitter_users, TwitterUser.objects.filter(pk__in=twitter_users, filled=True))
             self.target_set = True
-        if self.target_type == Metric.TARGET_BOTH and not (self.twitter_users and self.tweets):
+        if self.target_type == Metric.TARGET_BOTH and not (self.twitter_users.exists() and self.tweets.exists()):
             logger.error('For a metric of type TARGET_BOTH both tweets and users must be set')
             self.target_set = False
+        self.set_fingerprints()
         self.save()
 
+    def get_params(self):
+        """
+        Values of the parameters of the metric: the fields added by the subclass, apart from the results, and the
+        parameters of the sampling if the metric is computed on a sample
+        """
+        params = {f.name: f.value_from_object(self) for f in self._meta.local_concrete_fields
+                  if f.model is not Metric and not f.primary_key and f.name not in self.result_fields}
+        if self.sampling:
+            params.update({f: getattr(self, f) for f in self.SAMPLING_FIELDS})
+        return params
+
+    @classmethod
+    def get_fingerprint(cls, target_fingerprint, params):
+        digest = hashlib.sha256(cls.__name__.encode())
+        digest.update(jsonpkg.dumps(params, sort_keys=True, default=str).encode())
+        digest.update(target_fingerprint.encode())
+        return digest.hexdigest()
+
+    def set_fingerprints(self):
+        """ Computes the fingerprints of the current target, streaming the sorted ids (call save() afterwards) """
+        self.target_fingerprint = get_target_fingerprint(
+            self.campaign_id,
+            self.tweets.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=stats.FETCH_SIZE),
+            self.twitter_users.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=stats.FETCH_SIZE))
+        self.fingerprint = self.get_fingerprint(self.target_fingerprint, self.get_params())
+
+    def get_computed_duplicate(self):
+        """ Another completed metric of the same type, with the same parameters and target, if any """
+        return Metric.objects.filter(
+            fingerprint=self.fingerprint, computing=False, computation_end__isnull=False).exclude(
+            pk=self.pk).order_by('-computation_end').select_subclasses().first()
+
+    @classmethod
+    def get_computed(cls, campaign, tweet_ids=(), twitter_user_ids=()):
+        """ The last completed metric of this type computed on exactly these tweets and users (ids), if any """
+        target_fingerprint = get_target_fingerprint(
+            campaign.id, sorted(int(i) for i in tweet_ids), sorted(int(i) for i in twitter_user_ids))
+        return cls.objects.filter(target_fingerprint=target_fingerprint, computation_end__isnull=False).order_by(
+            '-computation_end').first()
+
+    def get_campaign_targets(self):
+        """
+        Querysets of the users and of the tweets of the campaign (up to the watermark) targeted by a campaign wide
+        metric, None for the kind of target the metric does not use
+        """
+        tweets = self.campaign.get_tweets()
+        if self.watermark is not None:
+            tweets = tweets.filter(inserted_at__lte=self.watermark)
+        target_users = None
+        target_tweets = None
+        if self.target_type in [Metric.TARGET_USERS, Metric.TARGET_BOTH]:
+            target_users = TwitterUser.objects.filter(
+                tweets_authored__in=tweets, filled=True, screen_name__isnull=False).distinct()
+        if self.target_type in [Metric.TARGET_TWEETS, Metric.TARGET_BOTH, Metric.TARGET_ANY]:
+            target_tweets = tweets
+        return target_users, target_tweets
+
+    def set_campaign_target(self):
+        """
+        Targets the tweets and users of the whole campaign, up to the newest tweet collected so far, or a sample of
+        them if sampling is set
+        """
+        self.watermark = self.campaign.get_tweets().aggregate(Max('inserted_at'))['inserted_at__max']
+        self.campaign_wide = True
+        [target_users, target_tweets] = self.get_sampled_campaign_targets()
+        self.set_target(twitter_users=target_users, tweets=target_tweets)
+
+    def get_sampled_campaign_targets(self):
+        """ Same as get_campaign_targets, with the ids of a sample of them if sampling is set (see get_sample) """
+        [target_users, target_tweets] = self.get_campaign_targets()
+        if self.sampling:
+            if target_users is not None:
+                target_users = self.get_sample(self.get_sampling_population(target_users))
+            if target_tweets is not None:
+                target_tweets = self.get_sample(self.get_sampling_population(target_tweets))
+        return target_users, target_tweets
+
+    def get_sampling_key(self):
+        """ Metrics with the same key draw the same sample of the same campaign target """
+        return (type(self).get_sampling_population, self.target_type, self.sampling, self.sample_size,
+                self.sample_seed)
+
+    def get_sampling_methods(self):
+        """ Sampling methods that can be used by the metric, none if its value cannot be estimated on a sample """
+        if not self.samplable:
+            return []
+        if self.target_type == Metric.TARGET_TWEETS:
+            return [Metric.SAMPLING_UNIFORM, Metric.SAMPLING_DAY, Metric.SAMPLING_AUTHOR]
+        if self.target_type == Metric.TARGET_USERS:
+            return [Metric.SAMPLING_UNIFORM, Metric.SAMPLING_DAY]
+        return []
+
+    def get_sampling_population(self, target):
+        """ Elements of the campaign target (a queryset) the sample is drawn from, the value refers to them """
+        return target
+
+    def _load_strata(self, target):
+        """ Ids of the elements of the target ordered by id, and their strata (strings) for the sampling method """
+        pk = target.model._meta.pk.name
+        if self.sampling == Metric.SAMPLING_DAY:
+            [ids, created_at] = stats.load_target_columns(target, pk, 'created_at')
+            return ids, created_at.astype('datetime64[D]').astype(str)
+        if self.sampling == Metric.SAMPLING_AUTHOR:
+            [ids, authors] = stats.load_target_columns(target, pk, 'author_id')
+            return ids, authors.astype(str)
+        [ids] = stats.load_target_columns(target, pk)
+        return ids, numpy.full(len(ids), '')
+
+    def get_sample(self, population):
+        """
+        Ids of a reproducible sample of sample_size elements of the population (a queryset) drawn with the sampling
+        method, see stats.stratified_sample. The sizes of the population and of its strata are kept for the estimate
+        """
+        [ids, strata] = self._load_strata(population)
+        [indexes, sizes] = stats.stratified_sample(strata, self.sample_size, self.sample_seed)
+        self.population_size = len(ids)
+        self.population_strata = jsonpkg.dumps(sizes)
+        logger.debug('Sampled %d elements out of %d in %d strata' % (len(indexes), len(ids), len(sizes)))
+        return ids[indexes].tolist()
+
+    def set_sample_estimate(self, values=None):
+        """
+        Sets value to the estimate for the whole population of a metric computed on a sample, with the bounds of its
+        confidence interval (percentages, see stats.stratified_estimate). values are those of the sampled elements
+        ordered by id, between 0 and 1: by default 1 for the tagged elements and 0 for the others
+        """
+        if self.target_type == Metric.TARGET_USERS:
+            [target, tagged] = [self.twitter_users.all(), self.tagged_users.all()]
+        else:
+            [target, tagged] = [self.tweets.all(), self.tagged_tweets.all()]
+        [ids, strata] = self._load_strata(target)
+        if values is None:
+            values = numpy.isin(ids, list(tagged.values_list('pk', flat=True)))
+        [estimate, lower, upper] = stats.stratified_estimate(
+            values, strata, jsonpkg.loads(self.population_strata or '{}'), self.confidence)
+        [self.value, self.value_lower, self.value_upper] = [
+            round(decimal.Decimal(v) * 100, 10) for v in [estimate, lower, upper]]
+        logger.debug('Metric %d estimated %.4f%% (%.4f%% - %.4f%%) on %d sampled elements' % (
+            self.id, self.value, self.value_lower, self.value_upper, len(ids)))
+
+    def is_incremental(self):
+        # the sample would not be representative of the tweets added since
+        return self.incremental and not self.sampling
+
+    def refresh(self):
+        """
+        Schedules the computation of a campaign wide metric on the tweets (and their authors) collected since the
+        previous computation, which are merged into the existing results. Returns False if there is nothing new
+        """
+        if not self.campaign_wide or not self.is_incremental() or self.watermark is None:
+            logger.error('Metric %d cannot be refreshed' % self.id)
+            raise Exception('Only campaign wide metrics supporting incremental computation can be refreshed')
+        since = self.watermark
+        watermark = self.campaign.get_tweets().aggregate(Max('inserted_at'))['inserted_at__max']
+        if watermark is None or watermark <= since:
+            return False
+        self.watermark = watermark
+        self.save()
+        return self.compute(since=since)
+
+    def _refresh_computation(self, since):
+        """
+        Adds to the target the campaign tweets inserted after since (up to the watermark) and their authors not
+        analyzed yet, then calls _incremental_computation with them
+        """
+        tweets = self.campaign.get_tweets().filter(inserted_at__gt=since, inserted_at__lte=self.watermark)
+        new_tweets = Tweet.objects.none()
+        new_users = TwitterUser.objects.none()
+        if self.target_type in [Metric.TARGET_USERS, Metric.TARGET_BOTH]:
+            user_ids = list(TwitterUser.objects.filter(
+                tweets_authored__in=tweets, filled=True, screen_name__isnull=False).exclude(
+                pk__in=self.twitter_users.values('pk')).values_list('pk', flat=True).distinct())
+            set_relation_ids(self.twitter_users, user_ids, clear=False)
+            new_users = TwitterUser.objects.filter(pk__in=user_ids)
+        if self.target_type in [Metric.TARGET_TWEETS, Metric.TARGET_BOTH, Metric.TARGET_ANY]:
+            set_relation(self.tweets, tweets, clear=False)
+            new_tweets = self.tweets.filter(inserted_at__gt=since)
+        logger.debug('Refreshing metric %d with %d tweets and %d users' % (
+            self.id, new_tweets.count(), new_users.count()))
+        self.set_fingerprints()
+        return self._incremental_computation(new_tweets, new_users)
+
+    def _incremental_computation(self, tweets, twitter_users):
+        """ Merges the new tweets and users, already added to the target, in the results (incremental metrics) """
+        raise NotImplementedError('Metric %s does not support incremental computation' % self.__class__.__name__)
+
     def start(self):
         if not self.target_set:
             logger.error('Trying to compute metric %(class)s before target is set')
@@ -732,6 +1223,89 @@ class Metric(models.Model):
     def _computation(self):
         logger.warning('Triggering base "Metric" model computation, probably wrong.')
 
+    def get_snapshot_key(self, target):
+        """ Key of the columnar snapshot of the target tweets or twitter_users, see twitter.snapshots """
+        return '%s-%s' % (self.target_fingerprint, target) if self.target_fingerprint else None
+
+    def load_user_columns(self, *fields):
+        """
+        Arrays with the values of the fields for the target users ordered by id (datetimes as datetime64), taken
+        from the columns shared by a MetricBatch or from the snapshot of the target
+        """
+        if self.shared_columns is not None and all(f in self.shared_columns for f in fields):
+            return [self.shared_columns[f] for f in fields]
+        return snapshots.get_columns(self.get_snapshot_key('twitter_users'), self.twitter_users.all(), fields)
+
+    def load_tweet_columns(self, *fields):
+        """ Like load_user_columns, for the target tweets """
+        return snapshots.get_columns(self.get_snapshot_key('tweets'), self.tweets.all(), fields)
+
+    # rows fetched at once by the iteration helpers
+    ITERATION_CHUNK_SIZE = 2000
+
+    @classmethod
+    def iterate(cls, queryset, *fields, chunk_size=None):
+        """
+        Iterates over the queryset fetching chunk_size rows at a time (ITERATION_CHUNK_SIZE by default) without
+        caching them: yields tuples with the values of the fields or, without fields, model instances
+        """
+        if fields:
+            queryset = queryset.values_list(*fields)
+        return queryset.iterator(chunk_size=chunk_size or cls.ITERATION_CHUNK_SIZE)
+
+    @classmethod
+    def iterate_chunks(cls, queryset, *fields, chunk_size=None):
+        """ Like iterate, yielding lists of up to chunk_size rows """
+        chunk_size = chunk_size or cls.ITERATION_CHUNK_SIZE
+        rows = cls.iterate(queryset, *fields, chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def iterate_tweets(self, *fields, chunk_size=None):
+        """ Iterates over the target tweets, see iterate """
+        return self.iterate(self.tweets.all(), *fields, chunk_size=chunk_size)
+
+    def iterate_twitter_users(self, *fields, chunk_size=None):
+        """ Iterates over the target users, see iterate """
+        return self.iterate(self.twitter_users.all(), *fields, chunk_size=chunk_size)
+
+    FACTS_BATCH_SIZE = 1000
+    FACT_TARGET_FIELDS = {
+        Fact.TWITTER_USER: 'twitter_user_id',
+        Fact.TWEET: 'tweet_id',
+        Fact.COMMUNITY: 'community_id',
+        Fact.CAMPAIGN: 'campaign_id',
+    }
+
+    def add_facts(self, target_type, facts):
+        """
+        Adds facts generated by the metric with bulk inserts of FACTS_BATCH_SIZE rows.
+        facts is an iterable of (target id, text, description) tuples
+        """
+        target_field = self.FACT_TARGET_FIELDS[target_type]
+        counter = bulk_insert(Fact, (
+            Fact(**{target_field: target_id}, metric=self, text=text, description=description, target_type=target_type)
+            for [target_id, text, description] in facts), self.FACTS_BATCH_SIZE)
+        logger.debug('Metric %d added %d facts' % (self.id, counter))
+        return counter
+
+    def _get_ids(self, targets):
+        if isinstance(targets, models.QuerySet):
+            return targets.values_list('pk', flat=True).iterator(chunk_size=self.FACTS_BATCH_SIZE)
+        return targets
+
+    def add_user_facts(self, twitter_users, text, description=None):
+        """ Adds the same fact to all the users, given as a queryset or as a list of ids """
+        return self.add_facts(
+            Fact.TWITTER_USER, ((uid, text, description) for uid in self._get_ids(twitter_users)))
+
+    def add_tweet_facts(self, tweets, text, description=None):
+        """ Adds the same fact to all the tweets, given as a queryset or as a list of ids """
+        return self.add_facts(Fact.TWEET, ((tid, text, description) for tid in self._get_ids(tweets)))
+
     def results(self):
         return {
             'impact': self.impact,
@@ -739,13 +1313,25 @@ class Metric(models.Model):
             'attendibility': self.attendibility,
             'computation_start': self.computation_start,
             'computation_end': self.computation_end,
-            'computing': self.computing
+            'computing': self.computing,
+            'peak_memory': self.peak_memory,
+            'value_lower': self.value_lower,
+            'value_upper': self.value_upper
         }
 
-    def compute(self, schedule=0, start=True):
+    def get_task_type(self):
+        """ Metrics on large targets are scheduled after the interactive ones """
+        if self.twitter_users.count() + self.tweets.count() > settings.SCHEDULER_BULK_METRIC_TARGET:
+            return scheduler.TASK_METRIC_BULK
+        return scheduler.TASK_METRIC
+
+    def compute(self, schedule=0, start=True, since=None):
+        """ Schedules the computation; with since, only the campaign tweets inserted after it are processed """
         process_name = self.process_name()
         logger.debug("Created task %s" % process_name)
-        background_metric(self.id, start=start, creator=self, verbose_name=process_name, schedule=schedule)
+        scheduler.schedule(
+            background_metric, self.get_task_type(), self.campaign, self.id, start=start,
+            since=since.isoformat() if since else None, creator=self, verbose_name=process_name, schedule=schedule)
         logger.debug('task created?')
         return {'started': True}
 
@@ -753,6 +1339,203 @@ class Metric(models.Model):
         return 'Metric: ' + self.name
 
 
+class MetricBatch(object):
+    """
+    Metrics of a campaign computed on the same target. The target is resolved once: the relations of the other
+    metrics are copied from the first one in the database, and the fingerprints are computed once. The columns of
+    the target users read by the computations (Metric.user_columns) are loaded with a single query and shared by
+    the metrics, whose computations run in METRIC_BATCH_THREADS threads when the database supports concurrent writes
+    """
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        if not self.metrics:
+            raise ValueError('A batch needs at least a metric')
+        self.campaign = self.metrics[0].campaign
+
+    @classmethod
+    def get(cls, metric_ids):
+        metrics = {m.pk: m for m in Metric.objects.filter(pk__in=metric_ids).select_subclasses()}
+        return cls([metrics[pk] for pk in metric_ids if pk in metrics])
+
+    def _set_relations(self, relation, metrics, targets):
+        """ Sets the relation of the first metric from targets and copies it to the others, returns the first """
+        if not metrics:
+            return None
+        [first, *others] = metrics
+        set_relation(getattr(first, relation), targets)
+        for metric in others:
+            set_relation(getattr(metric, relation), getattr(first, relation).all())
+        return first
+
+    def _get_custom_target_metrics(self):
+        """ Metrics overriding set_target (e.g. to add related tweets), whose targets cannot be copied """
+        return [m for m in self.metrics if type(m).set_target is not Metric.set_target]
+
+    def set_target(self, twitter_users=None, tweets=None):
+        """ Same as Metric.set_target on all the metrics """
+        custom = self._get_custom_target_metrics()
+        for metric in custom:
+            metric.set_target(twitter_users, tweets)
+        self._set_target(twitter_users, tweets, [Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_USERS],
+                         [m for m in self.metrics if m not in custom])
+
+    def _set_target(self, twitter_users, tweets, user_target_types, metrics):
+        tweet_metrics = []
+        user_metrics = []
+        if _has_targets(tweets):
+            tweet_metrics = [m for m in metrics if m.target_type in [
+                Metric.TARGET_ANY, Metric.TARGET_BOTH, Metric.TARGET_TWEETS]]
+        if _has_targets(twitter_users):
+            user_metrics = [m for m in metrics if m.target_type in user_target_types]
+        first_tweets = self._set_relations(
+            'tweets', tweet_metrics, Tweet.objects.filter(pk__in=tweets)) if tweet_metrics else None
+        first_users = self._set_relations(
+            'twitter_users', user_metrics,
+            TwitterUser.objects.filter(pk__in=twitter_users, filled=True)) if user_metrics else None
+
+        tweet_ids = first_tweets.tweets.order_by('pk').values_list('pk', flat=True) if first_tweets else []
+        user_ids = first_users.twitter_users.order_by('pk').values_list('pk', flat=True) if first_users else []
+        target_fingerprints = {}
+        for metric in metrics:
+            has_tweets = metric in tweet_metrics
+            has_users = metric in user_metrics
+            metric.target_set = has_tweets or has_users
+            if metric.target_type == Metric.TARGET_BOTH and not (
+                    has_tweets and has_users and tweet_ids.exists() and user_ids.exists()):
+                logger.error('For a metric of type TARGET_BOTH both tweets and users must be set')
+                metric.target_set = False
+            if (has_tweets, has_users) not in target_fingerprints:
+                target_fingerprints[(has_tweets, has_users)] = get_target_fingerprint(
+                    self.campaign.id if self.campaign else None,
+                    tweet_ids.iterator(chunk_size=stats.FETCH_SIZE) if has_tweets else [],
+                    user_ids.iterator(chunk_size=stats.FETCH_SIZE) if has_users else [])
+            metric.target_fingerprint = target_fingerprints[(has_tweets, has_users)]
+            metric.fingerprint = metric.get_fingerprint(metric.target_fingerprint, metric.get_params())
+            metric.save()
+
+    def set_campaign_target(self):
+        """ Same as Metric.set_campaign_target on all the metrics """
+        tweets = self.campaign.get_tweets()
+        watermark = tweets.aggregate(Max('inserted_at'))['inserted_at__max']
+        if watermark is not None:
+            tweets = tweets.filter(inserted_at__lte=watermark)
+        for metric in self.metrics:
+            metric.campaign_wide = True
+            metric.watermark = watermark
+        custom = self._get_custom_target_metrics()
+        for metric in custom:
+            [target_users, target_tweets] = metric.get_sampled_campaign_targets()
+            metric.set_target(twitter_users=target_users, tweets=target_tweets)
+        # the sample is drawn once for the metrics sampling the same population in the same way
+        samples = {}
+        for metric in self.metrics:
+            if metric.sampling and metric not in custom:
+                samples.setdefault(metric.get_sampling_key(), []).append(metric)
+        for sampled in samples.values():
+            [first, *others] = sampled
+            [target_users, target_tweets] = first.get_sampled_campaign_targets()
+            for metric in others:
+                metric.population_size = first.population_size
+                metric.population_strata = first.population_strata
+            self._set_target(target_users, target_tweets, [Metric.TARGET_USERS, Metric.TARGET_BOTH], sampled)
+        metrics = [m for m in self.metrics if m not in custom and not m.sampling]
+        target_users = None
+        if any(m.target_type in [Metric.TARGET_USERS, Metric.TARGET_BOTH] for m in metrics):
+            target_users = TwitterUser.objects.filter(
+                tweets_authored__in=tweets, filled=True, screen_name__isnull=False).distinct()
+        self._set_target(target_users, tweets, [Metric.TARGET_USERS, Metric.TARGET_BOTH], metrics)
+
+    def load_user_columns(self):
+        """ Loads the columns read by the metrics once for each target, and shares them among the metrics """
+        metrics_by_target = {}
+        for metric in self.metrics:
+            if metric.user_columns:
+                metrics_by_target.setdefault(metric.target_fingerprint, []).append(metric)
+        for metrics in metrics_by_target.values():
+            fields = sorted({f for m in metrics for f in m.user_columns})
+            columns = dict(zip(fields, snapshots.get_columns(
+                metrics[0].get_snapshot_key('twitter_users'), metrics[0].twitter_users.all(), fields)))
+            logger.debug('Loaded %d columns of %d users for %d metrics' % (
+                len(fields), len(columns[fields[0]]), len(metrics)))
+            for metric in metrics:
+                metric.shared_columns = columns
+
+    def _compute_metric(self, metric, in_thread=False):
+        try:
+            if in_thread:
+                computed = metric._computation()
+            else:
+                with record_peak_memory(metric):
+                    computed = metric._computation()
+            # computations may leave their results on the instance, relying on the caller to save it
+            metric.save()
+            return computed
+        except Exception as ex:
+            logger.exception('Computation of metric %d in batch failed: %s' % (metric.id, ex))
+            return False
+        finally:
+            if in_thread:
+                connection.close()
+
+    def _compute_rules(self, metrics):
+        """ Evaluates the rules of the rule metrics on the same target together, see UserRuleMetric.compute_rules """
+        results = {}
+        metrics_by_target = {}
+        for metric in metrics:
+            metrics_by_target.setdefault(metric.target_fingerprint, []).append(metric)
+        for metrics in metrics_by_target.values():
+            try:
+                with record_peak_memory(*metrics):
+                    computed = metrics[0].compute_rules(metrics)
+                for metric in metrics:
+                    metric.save()
+            except Exception as ex:
+                logger.exception('Computation of rule metrics %s in batch failed: %s' % (
+                    ', '.join(str(m.id) for m in metrics), ex))
+                computed = False
+            results.update((m.id, computed) for m in metrics)
+        return results
+
+    def _computation(self):
+        """ Computes all the metrics, returns a dictionary metric id -> result of its _computation """
+        from .metrics import UserRuleMetric
+        self.load_user_columns()
+        rule_metrics = [m for m in self.metrics if isinstance(m, UserRuleMetric)]
+        metrics = [m for m in self.metrics if not isinstance(m, UserRuleMetric)]
+        results = self._compute_rules(rule_metrics)
+        threads = min(settings.METRIC_BATCH_THREADS, len(metrics))
+        if threads > 1 and connection.vendor != 'sqlite':
+            # the peak of the metrics computed at the same time cannot be told apart
+            with record_peak_memory(*metrics), ThreadPoolExecutor(max_workers=threads) as pool:
+                computed = list(pool.map(lambda m: self._compute_metric(m, in_thread=True), metrics))
+            for metric in metrics:
+                metric.save(update_fields=['peak_memory'])
+        else:
+            computed = [self._compute_metric(m) for m in metrics]
+        results.update(zip([m.id for m in metrics], computed))
+        return results
+
+    def start(self):
+        for metric in self.metrics:
+            metric.start()
+
+    def get_task_type(self):
+        task_types = {m.get_task_type() for m in self.metrics}
+        return scheduler.TASK_METRIC_BULK if scheduler.TASK_METRIC_BULK in task_types else scheduler.TASK_METRIC
+
+    def compute(self, schedule=0, start=True):
+        """ Schedules the computation of all the metrics in a single task """
+        for metric in self.metrics:
+            metric.process_name()
+        process_name = 'task-campaign-%s-metric-batch-%s' % (
+            self.campaign.slug, '-'.join(str(m.id) for m in self.metrics))
+        scheduler.schedule(
+            background_metric_batch, self.get_task_type(), self.campaign, [m.id for m in self.metrics],
+            start=start, verbose_name=process_name, schedule=schedule)
+        return {'started': True}
+
+
 class Community(models.Model):
     tags = TaggableManager()
     inserted_at = models.DateTimeField(auto_now_add=True)
@@ -845,6 +1628,8 @@ class TwitterUser(models.Model):
     directly_linked_to_campaign = models.BooleanField(default=False)
     profile_picture = models.ImageField(upload_to='pp/', null=True)
     notes = models.TextField(default='')
+    unresolvable = models.BooleanField(
+        default=False, help_text='Profile could not be retrieved from Twitter (suspended, removed or protected)')
     tweets = None
 
     if settings.FUZZY_COUNT:
@@ -901,6 +1686,34 @@ class TwitterUser(models.Model):
 
         return sequence
 
+    @classmethod
+    def get_sequences(cls, users, with_times=False):
+        """
+        Activity sequences of many users with a single query: returns a dictionary user id -> bytes with a digit
+        per tweet type (as in get_sequence_string), in chronological order. With with_times, the values are
+        tuples (bytes, numpy array of the tweet timestamps)
+        """
+        sequences = {pk: bytearray() for pk in users.values_list('pk', flat=True)} \
+            if isinstance(users, models.QuerySet) else {pk: bytearray() for pk in users}
+        times = {pk: [] for pk in sequences} if with_times else None
+        events = Tweet.objects.filter(author__in=users).order_by('author', 'created_at').values_list(
+            'author', 'created_at', 'in_reply_to_tweet', 'retweeted_status', 'quoted_status')
+        for [author, created_at, reply, retweet, quote] in events.iterator(chunk_size=stats.FETCH_SIZE):
+            if reply is not None:
+                tweet_type = TweetType.Reply
+            elif retweet is not None:
+                tweet_type = TweetType.Retweet
+            elif quote is not None:
+                tweet_type = TweetType.Quote
+            else:
+                tweet_type = TweetType.Text
+            sequences[author].append(ord('0') + tweet_type.value)
+            if with_times:
+                times[author].append(created_at.timestamp())
+        if with_times:
+            return {pk: (bytes(sequence), numpy.array(times[pk], dtype=float)) for pk, sequence in sequences.items()}
+        return {pk: bytes(sequence) for pk, sequence in sequences.items()}
+
     def get_sequence_string(self):
         """ Similar to get_sequence, returns only a string indicating the type of tweet """
         if self.tweets:
@@ -1010,6 +1823,16 @@ class TwitterUser(models.Model):
         if self.location and self.location != status_user.location:
             self.add_fact(None, 'user changed location', 'user changed location from %s to %s' % (
                 self.location, status_user.location))
+        self.set_profile_from_status(status_user)
+        self.save()
+
+    PROFILE_FIELDS = [
+        'name', 'screen_name', 'location', 'url', 'description', 'protected', 'verified', 'followers_count',
+        'friends_count', 'listed_count', 'favourites_count', 'statuses_count', 'created_at', 'profile_banner_url',
+        'profile_image_url_https', 'default_profile', 'default_profile_image', 'updated_at', 'filled', 'unresolvable']
+
+    def set_profile_from_status(self, status_user):
+        """ Sets the PROFILE_FIELDS from a tweepy User object, without saving """
         self.name = status_user.name
         self.screen_name = status_user.screen_name
         self.location = status_user.location
@@ -1031,7 +1854,22 @@ class TwitterUser(models.Model):
         self.default_profile_image = status_user.default_profile_image
         self.updated_at = timezone.now()
         self.filled = True
-        self.save()
+        self.unresolvable = False
+
+    @classmethod
+    def bulk_from_statuses(cls, status_users):
+        """ Fills the profiles of existing (stub) users from a list of tweepy User objects,
+        as returned by the users/lookup endpoint, with a single bulk UPDATE """
+        users = cls.objects.in_bulk([u.id for u in status_users])
+        updated = []
+        for status_user in status_users:
+            u = users.get(status_user.id)
+            if u is None:
+                continue
+            u.set_profile_from_status(status_user)
+            updated.append(u)
+        cls.objects.bulk_update(updated, cls.PROFILE_FIELDS, batch_size=100)
+        return updated
 
     @classmethod
     def from_status(cls, status_user, triggering_campaign, directly_linked_to_campaign=False):
@@ -1216,7 +2054,7 @@ class Tweet(models.Model):
                 if triggering_campaign:
                     api = triggering_campaign.get_twitter_api()
                     try:
-                        status = api.get_status(in_reply_to_status_id_str)
+                        status = api_cache.get_status(api, in_reply_to_status_id_str)
                         t = Tweet.from_status(
                             status, streamer=streamer, triggering_campaign=triggering_campaign,
                             nested_level=nested_level)
@@ -1241,6 +2079,7 @@ class Tweet(models.Model):
     @classmethod
     def from_status(cls, status, triggering_campaign=None, streamer=None, nested_level=0,
                     directly_linked_to_campaign=False):
+        api_cache.remember_status(status)
         with transaction.atomic():
             try:
                 t = cls.objects.select_for_update().get(pk=status.id)
@@ -1331,6 +2170,165 @@ class Tweet(models.Model):
         super(Tweet, self).save(*args, **kwargs)
 
 
+class TweetRollup(models.Model):
+    """
+    Number of tweets of a campaign or of an entity created in a time bucket, kept up to date while tweets are
+    stored. Minute and hour buckets start at UTC boundaries, day buckets at local (TIME_ZONE) midnight.
+    Concurrent writers may create more than one row for the same bucket: readers sum them
+    """
+    RESOLUTIONS = {
+        'm': timedelta(minutes=1),
+        'h': timedelta(hours=1),
+        'd': timedelta(days=1),
+    }
+    RESOLUTION_CHOICES = [
+        ('m', 'minute'),
+        ('h', 'hour'),
+        ('d', 'day'),
+    ]
+    campaign = models.ForeignKey('Campaign', null=True, on_delete=models.CASCADE, related_name='rollups')
+    entity = models.ForeignKey('Entity', null=True, on_delete=models.CASCADE, related_name='rollups')
+    resolution = models.CharField(max_length=1, choices=RESOLUTION_CHOICES)
+    bucket = models.DateTimeField()
+    counter = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        index_together = [['campaign', 'resolution', 'bucket'], ['entity', 'resolution', 'bucket']]
+
+    @staticmethod
+    def _midnight(date):
+        return timezone.make_aware(datetime.combine(date, datetime.min.time()), is_dst=False)
+
+    @classmethod
+    def get_bucket(cls, moment, resolution):
+        if resolution == 'd':
+            return cls._midnight(timezone.localtime(moment).date())
+        seconds = int(cls.RESOLUTIONS[resolution].total_seconds())
+        timestamp = int(moment.timestamp())
+        return datetime.fromtimestamp(timestamp - timestamp % seconds, tz=pytz.utc)
+
+    @classmethod
+    def _count(cls, moments):
+        counters = collections.Counter()
+        for moment in moments:
+            for resolution in cls.RESOLUTIONS:
+                counters[(resolution, cls.get_bucket(moment, resolution))] += 1
+        return counters
+
+    @classmethod
+    def add(cls, moments, campaign_id=None, entity_id=None):
+        """ Counts tweets created at the given datetimes in the buckets of a campaign or of an entity """
+        for [[resolution, bucket], counter] in cls._count(moments).items():
+            updated = cls.objects.filter(
+                campaign_id=campaign_id, entity_id=entity_id, resolution=resolution, bucket=bucket).update(
+                counter=F('counter') + counter)
+            if not updated:
+                cls.objects.create(campaign_id=campaign_id, entity_id=entity_id, resolution=resolution,
+                                   bucket=bucket, counter=counter)
+
+    @classmethod
+    def rebuild(cls, campaign=None, entity=None):
+        """ Recomputes the buckets of a campaign or of an entity from the stored tweets """
+        tweets = campaign.get_tweets() if campaign is not None else entity.get_tweets()
+        moments = tweets.filter(created_at__isnull=False).order_by().values_list(
+            'created_at', flat=True).iterator(chunk_size=stats.FETCH_SIZE)
+        rollups = [cls(campaign=campaign, entity=entity, resolution=resolution, bucket=bucket, counter=counter)
+                   for [[resolution, bucket], counter] in cls._count(moments).items()]
+        with transaction.atomic():
+            cls.objects.filter(campaign=campaign, entity=entity).delete()
+            cls.objects.bulk_create(rollups, batch_size=stats.FETCH_SIZE)
+        return len(rollups)
+
+    @classmethod
+    def _filter(cls, resolution, campaign=None, entity=None, start=None, end=None):
+        rollups = cls.objects.filter(resolution=resolution, campaign=campaign, entity=entity)
+        if start is not None:
+            rollups = rollups.filter(bucket__gte=cls.get_bucket(start, resolution))
+        if end is not None:
+            rollups = rollups.filter(bucket__lt=end)
+        return rollups.values('bucket').annotate(total=Sum('counter')).order_by('bucket').values_list(
+            'bucket', 'total')
+
+    @classmethod
+    def get_counts(cls, campaign=None, entity=None, start=None, end=None, step=timedelta(hours=1)):
+        """
+        List of (start of the interval, number of tweets) between start and end, in intervals of length step
+        (a multiple of a minute). Empty intervals are omitted
+        """
+        if step % cls.RESOLUTIONS['d'] == timedelta(0):
+            resolution = 'd'
+        elif step % cls.RESOLUTIONS['h'] == timedelta(0):
+            resolution = 'h'
+        elif step % cls.RESOLUTIONS['m'] == timedelta(0):
+            resolution = 'm'
+        else:
+            raise ValueError('The step must be a multiple of a minute')
+        rows = cls._filter(resolution, campaign, entity, start, end)
+        if step == cls.RESOLUTIONS[resolution]:
+            return list(rows)
+        counts = collections.OrderedDict()
+        origin = None
+        for [bucket, total] in rows:
+            if origin is None:
+                origin = cls.get_bucket(start, resolution) if start is not None else bucket
+            if resolution == 'd':
+                # days are not all 24 hours long where daylight saving time applies
+                origin_date = timezone.localtime(origin).date()
+                days = (timezone.localtime(bucket).date() - origin_date).days
+                interval = cls._midnight(origin_date + timedelta(days=days - days % step.days))
+            else:
+                interval = origin + ((bucket - origin) // step) * step
+            counts[interval] = counts.get(interval, 0) + total
+        return list(counts.items())
+
+    @classmethod
+    def get_weekly_matrix(cls, campaign=None, entity=None, start=None, end=None):
+        """ Number of tweets by local weekday (0 is Monday) and hour: a list of 7 lists of 24 counters """
+        matrix = [[0] * 24 for _ in range(7)]
+        for [bucket, total] in cls._filter('h', campaign, entity, start, end):
+            local = timezone.localtime(bucket)
+            matrix[local.weekday()][local.hour] += total
+        return matrix
+
+    @classmethod
+    def get_distributions(cls, campaign=None, entity=None):
+        """ Daily counters, hourly and weekday distributions, as shown in the dashboards (None if no data) """
+        daily = cls.get_counts(campaign=campaign, entity=entity, step=cls.RESOLUTIONS['d'])
+        if not daily:
+            return None
+        matrix = cls.get_weekly_matrix(campaign=campaign, entity=entity)
+        return {
+            'daily': [(timezone.localtime(bucket).date(), total) for [bucket, total] in daily],
+            'hourly': [sum(matrix[day][hour] for day in range(7)) for hour in range(24)],
+            'weekly': [sum(hours) for hours in matrix],
+        }
+
+
+@receiver(m2m_changed, sender=Tweet.triggering_campaigns.through)
+def rollup_campaign_tweets(sender, instance, action, reverse, pk_set, **kwargs):
+    # pk_set only holds the newly linked objects
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        TweetRollup.add(Tweet.objects.filter(pk__in=pk_set, created_at__isnull=False).values_list(
+            'created_at', flat=True), campaign_id=instance.pk)
+    elif instance.created_at is not None:
+        for campaign_id in pk_set:
+            TweetRollup.add([instance.created_at], campaign_id=campaign_id)
+
+
+@receiver(m2m_changed, sender=Entity.tweets.through)
+def rollup_entity_tweets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if not reverse:
+        TweetRollup.add(Tweet.objects.filter(pk__in=pk_set, created_at__isnull=False).values_list(
+            'created_at', flat=True), entity_id=instance.pk)
+    elif instance.created_at is not None:
+        for entity_id in pk_set:
+            TweetRollup.add([instance.created_at], entity_id=entity_id)
+
+
 class Location(models.Model):
     tags = TaggableManager()
     lat = models.FloatField(null=True)
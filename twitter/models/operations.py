@@ -1,7 +1,8 @@
 from django.db.models import QuerySet
 
 from .models import *
-from twitter.tasks import get_users_followers, get_users_friends, get_tweets
+from twitter import scheduler
+from twitter.tasks import get_users_followers, get_users_friends, get_tweets, hydrate_users, USERS_LOOKUP_SIZE
 
 
 class OperationRetrieveTweets(Operation):
@@ -21,9 +22,9 @@ class OperationRetrieveTweets(Operation):
 
     def set_target(self, twitter_users):
         if isinstance(twitter_users, QuerySet):
-            self.twitter_users.set(twitter_users)
+            set_relation(self.twitter_users, twitter_users)
         else:
-            self.twitter_users.set(TwitterUser.objects.filter(pk__in=twitter_users.all()))
+            set_relation(self.twitter_users, TwitterUser.objects.filter(pk__in=twitter_users.all()))
         self.twitter_users_ids = list(self.twitter_users.values_list('id_str', flat=True))
         logger.debug('Set target for operation: %d users' % len(self.twitter_users_ids))
         self.save()
@@ -34,18 +35,26 @@ class OperationRetrieveTweets(Operation):
         else:
             return 'operation-get_tweets'
 
+    def set_kind_finished(self, kind):
+        if kind == 'tweets':
+            self.finished = True
+
     def run(self):
         if not self.twitter_users:
             raise Exception('Target not set')
         if self.twitter_users.count() > self.max_twitter_users:
             raise Exception('Too many users %d (max %d)' % (self.twitter_users.count(), self.max_twitter_users))
         self.computation_start = timezone.now()
+        self.save()
         logger.debug('Started operation %s at %s' % (__name__, self.computation_start))
 
-        get_tweets(
-            self.campaign.slug, self.twitter_users_ids, max_tweets=self.max_tweets,
-            operation_id=self.id, verbose_name=self.process_name())
-        self.save()
+        twitter_users_ids = list(self.twitter_users.values_list('id_str', flat=True))
+        for chunk in self.create_chunks('tweets', twitter_users_ids):
+            scheduler.schedule(
+                get_tweets, scheduler.TASK_OPERATION, self.campaign,
+                self.campaign.slug, chunk.get_twitter_users_ids(), max_tweets=self.max_tweets,
+                operation_id=self.id, days_interval=self.days_interval, chunk_id=chunk.id,
+                verbose_name='%s-%d' % (self.process_name(), chunk.index))
 
 
 class OperationConstructNetwork(Operation):
@@ -88,27 +97,76 @@ class OperationConstructNetwork(Operation):
         self.save()
         """
         if isinstance(twitter_users, QuerySet):
-            self.twitter_users.set(twitter_users)
+            set_relation(self.twitter_users, twitter_users)
         else:
-            self.twitter_users.set(TwitterUser.objects.filter(pk__in=twitter_users.all()))
+            set_relation(self.twitter_users, TwitterUser.objects.filter(pk__in=twitter_users.all()))
         self.twitter_users_ids = list(self.twitter_users.values_list('id_str', flat=True))
         logger.debug('Set target for operation: %d users' % len(self.twitter_users_ids))
         self.save()
 
+    def set_kind_finished(self, kind):
+        if kind == 'followers':
+            self.followers_filled = True
+        elif kind == 'friends':
+            self.friends_filled = True
+
     def run(self):
         if not self.twitter_users:
             raise Exception('Target not set')
         if self.twitter_users.count() > self.max_twitter_users:
             raise Exception('Too many users %d (max %d)' % (self.twitter_users.count(), self.max_twitter_users))
         self.computation_start = timezone.now()
+        self.save()
         logger.debug('Started operation %s at %s' % (__name__, self.computation_start))
         process_names = self.process_names()
-        get_users_followers(
-            self.campaign.slug, self.twitter_users_ids, max_users=self.max_twitter_users,
-            days_interval=self.days_interval, operation_id=self.id, verbose_name=process_names['followers'],
-            max_followers=self.max_followers)
-        get_users_friends(
-            self.campaign.slug, self.twitter_users_ids, max_users=self.max_twitter_users,
-            days_interval=self.days_interval, operation_id=self.id, verbose_name=process_names['friends'],
-            max_friends=self.max_friends)
+        twitter_users_ids = list(self.twitter_users.values_list('id_str', flat=True))
+        for chunk in self.create_chunks('followers', twitter_users_ids):
+            scheduler.schedule(
+                get_users_followers, scheduler.TASK_OPERATION, self.campaign,
+                self.campaign.slug, chunk.get_twitter_users_ids(), max_users=self.max_twitter_users,
+                days_interval=self.days_interval, operation_id=self.id, max_followers=self.max_followers,
+                chunk_id=chunk.id, verbose_name='%s-%d' % (process_names['followers'], chunk.index))
+        for chunk in self.create_chunks('friends', twitter_users_ids):
+            scheduler.schedule(
+                get_users_friends, scheduler.TASK_OPERATION, self.campaign,
+                self.campaign.slug, chunk.get_twitter_users_ids(), max_users=self.max_twitter_users,
+                days_interval=self.days_interval, operation_id=self.id, max_friends=self.max_friends,
+                chunk_id=chunk.id, verbose_name='%s-%d' % (process_names['friends'], chunk.index))
+
+
+class OperationHydrateUsers(Operation):
+    campaign = models.ForeignKey('Campaign', on_delete=models.CASCADE)
+    metric = models.ForeignKey('Metric', on_delete=models.CASCADE, null=True)
+    finished = models.BooleanField(default=False)
+    max_twitter_users = models.PositiveIntegerField(
+        default=100 * 900, help_text='Hydrate at most this number of stubs (the most referenced ones)')
+
+    def is_finished(self):
+        with transaction.atomic():
+            return self.finished
+
+    def process_name(self):
+        if self.metric:
+            return '%s-hydrate_users' % (self.metric.process_name())
+        else:
+            return 'operation-%d-hydrate_users' % self.id
+
+    def set_kind_finished(self, kind):
+        if kind == 'lookup':
+            self.finished = True
+
+    def run(self):
+        self.computation_start = timezone.now()
         self.save()
+        twitter_users_ids = [str(uid) for uid in self.campaign.get_stubs_by_degree()[:self.max_twitter_users]]
+        logger.debug('Started operation %s at %s: %d stubs to hydrate' % (
+            __name__, self.computation_start, len(twitter_users_ids)))
+        # each task should make full use of the 100 ids allowed in a lookup request
+        self.chunk_size = max(1, -(-self.chunk_size // USERS_LOOKUP_SIZE)) * USERS_LOOKUP_SIZE
+        # chunks are created and scheduled in order of priority
+        for chunk in self.create_chunks('lookup', twitter_users_ids):
+            scheduler.schedule(
+                hydrate_users, scheduler.TASK_OPERATION, self.campaign,
+                self.campaign.slug, chunk.get_twitter_users_ids(), operation_id=self.id, chunk_id=chunk.id,
+                verbose_name='%s-%d' % (self.process_name(), chunk.index))
+        return len(twitter_users_ids)
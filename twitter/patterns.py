@@ -0,0 +1,147 @@
+"""
+Search of common substrings among many activity sequences (see TwitterUser.get_sequence_string).
+Identical sequences are compared once, and only pairs of sequences sharing at least a substring of min_length
+characters (found through an inverted index of their min_length-grams) are compared at all. Each comparison scans
+one sequence over the suffix automaton of the other, in linear time.
+The index only prunes when a min_length-gram is rare: over the four activity types almost every pair shares a short
+gram, so the number of comparisons stays quadratic in the number of sequences (every such pair has a match to report).
+The result is the same as comparing all pairs with SequenceMatcher.find_longest_match: for every pair of sequences
+the pattern is their longest common substring that starts earliest in the first one.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+
+class SuffixAutomaton(object):
+    """ Suffix automaton of a string, with the end position of the first occurrence of each state """
+
+    def __init__(self, text):
+        self.next = [{}]
+        self.link = [-1]
+        self.length = [0]
+        self.first_end = [-1]
+        last = 0
+        for position, c in enumerate(text):
+            current = self._add_state(self.length[last] + 1, position)
+            p = last
+            while p != -1 and c not in self.next[p]:
+                self.next[p][c] = current
+                p = self.link[p]
+            if p == -1:
+                self.link[current] = 0
+            else:
+                q = self.next[p][c]
+                if self.length[p] + 1 == self.length[q]:
+                    self.link[current] = q
+                else:
+                    clone = self._add_state(self.length[p] + 1, self.first_end[q])
+                    self.next[clone] = dict(self.next[q])
+                    self.link[clone] = self.link[q]
+                    while p != -1 and self.next[p].get(c) == q:
+                        self.next[p][c] = clone
+                        p = self.link[p]
+                    self.link[q] = clone
+                    self.link[current] = clone
+            last = current
+
+    def _add_state(self, length, first_end):
+        self.next.append({})
+        self.link.append(-1)
+        self.length.append(length)
+        self.first_end.append(first_end)
+        return len(self.length) - 1
+
+    def longest_common_substring(self, other):
+        """
+        Length of the longest common substrings of the text and other, with the start of the one occurring first
+        in the text and the start of the one occurring first in other
+        """
+        state = 0
+        matched = 0
+        best = 0
+        start_text = start_other = 0
+        for position, c in enumerate(other):
+            while state and c not in self.next[state]:
+                state = self.link[state]
+                matched = self.length[state]
+            if c in self.next[state]:
+                state = self.next[state][c]
+                matched += 1
+            if matched == 0:
+                continue
+            start = self.first_end[state] - matched + 1
+            if matched > best:
+                best = matched
+                start_text = start
+                start_other = position - matched + 1
+            elif matched == best and start < start_text:
+                start_text = start
+        return best, start_text, start_other
+
+
+def _grams(sequence, length):
+    return {sequence[i:i + length] for i in range(len(sequence) - length + 1)}
+
+
+def _match_rows(sequences, min_length, rows):
+    """ Compares each sequence in rows with the following ones sharing a gram, returns the matches """
+    index = {}
+    for i, sequence in enumerate(sequences):
+        for gram in _grams(sequence, min_length):
+            index.setdefault(gram, []).append(i)
+    matches = []
+    for a in rows:
+        candidates = set()
+        for gram in _grams(sequences[a], min_length):
+            candidates.update(index[gram])
+        candidates = sorted(b for b in candidates if b > a)
+        if not candidates:
+            continue
+        automaton = SuffixAutomaton(sequences[a])
+        for b in candidates:
+            [size, start_a, start_b] = automaton.longest_common_substring(sequences[b])
+            if size >= min_length:
+                matches.append((a, b, sequences[a][start_a:start_a + size], sequences[b][start_b:start_b + size]))
+    return matches
+
+
+def find_common_patterns(sequences, min_length, processes=1):
+    """
+    Returns a dictionary pattern -> set of indexes of the sequences: for every pair of sequences (in the given
+    order) whose longest common substring is at least min_length long, both are added to the earliest (in the
+    first sequence of the pair) of such substrings. With processes > 1 the comparisons are split among processes
+    """
+    min_length = max(min_length, 1)
+    distinct = {}
+    for i, sequence in enumerate(sequences):
+        distinct.setdefault(sequence, []).append(i)
+    uniques = list(distinct.keys())
+    members = list(distinct.values())
+
+    patterns = {}
+    # users with the same sequence share all of it
+    for sequence, indexes in distinct.items():
+        if len(indexes) > 1 and len(sequence) >= min_length:
+            patterns.setdefault(sequence, set()).update(indexes)
+
+    rows = [a for a, sequence in enumerate(uniques) if len(sequence) >= min_length]
+    if processes > 1 and len(rows) > processes:
+        # rows are interleaved, as the first ones are compared with more sequences
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(_match_rows, uniques, min_length, rows[k::processes]) for k in range(processes)]
+            matches = [m for f in futures for m in f.result()]
+    else:
+        matches = _match_rows(uniques, min_length, rows)
+
+    for [a, b, pattern_a, pattern_b] in matches:
+        users_a = members[a]
+        users_b = members[b]
+        # pairs where a user with sequence a comes first: the pattern is the earliest in sequence a
+        if users_a[0] < users_b[-1]:
+            patterns.setdefault(pattern_a, set()).update(
+                [u for u in users_a if u < users_b[-1]] + [u for u in users_b if u > users_a[0]])
+        # and vice versa
+        if users_b[0] < users_a[-1]:
+            patterns.setdefault(pattern_b, set()).update(
+                [u for u in users_b if u < users_a[-1]] + [u for u in users_a if u > users_b[0]])
+    return patterns
@@ -0,0 +1,104 @@
+"""
+Registry of the metric classes that can be computed, built once when the app is ready (see TwitterConfig.ready).
+Besides the subclasses of Metric defined in twitter.models, metrics are loaded from the modules listed in the
+METRIC_MODULES setting and from the packages declaring entry points in the ENTRY_POINT_GROUP group: an entry point
+can reference a metric class or a module defining them. Metric classes are Django models, so external ones must be
+defined in an installed app.
+The descriptions shown in the dashboards are precomputed for each kind of target (limit_target).
+"""
+import importlib
+import logging
+
+from importlib import metadata
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'tafferugli.metrics'
+
+_metrics = {}
+_meta = {}
+
+
+def register(metric_class):
+    """ Adds a metric class to the registry, can be used as a class decorator """
+    if metric_class.__name__ in _metrics and _metrics[metric_class.__name__] is not metric_class:
+        logger.warning('Metric %s registered twice, replacing %s' % (
+            metric_class.__name__, _metrics[metric_class.__name__].__module__))
+    _metrics[metric_class.__name__] = metric_class
+    _build_meta()
+    return metric_class
+
+
+def _build_meta():
+    from twitter.models import Metric
+    # limit_target -> target types of the metrics that can be computed on it
+    limit_targets = {
+        None: None,
+        'twitter_users': (Metric.TARGET_ANY, Metric.TARGET_USERS),
+        'tweets': (Metric.TARGET_ANY, Metric.TARGET_TWEETS),
+    }
+    _meta.clear()
+    for [limit_target, target_types] in limit_targets.items():
+        _meta[limit_target] = [{
+            'name': name,
+            'description': m.description,
+            'target_type': m.target_type,
+            'template_form': m.template_form,
+            'template_file': m.template_file,
+        } for [name, m] in _metrics.items() if target_types is None or m.target_type in target_types]
+
+
+def _get_subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _get_subclasses(subclass)
+
+
+def _get_entry_points():
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=ENTRY_POINT_GROUP)
+    return entry_points.get(ENTRY_POINT_GROUP, [])
+
+
+def load():
+    """ Imports the external metric modules and entry points and registers all the metric classes """
+    from twitter.models import Metric
+    for module in getattr(settings, 'METRIC_MODULES', []):
+        try:
+            importlib.import_module(module)
+        except Exception as ex:
+            logger.error('Cannot import metrics from module %s: %s' % (module, ex))
+    entry_point_metrics = []
+    for entry_point in _get_entry_points():
+        try:
+            loaded = entry_point.load()
+        except Exception as ex:
+            logger.error('Cannot load metrics from entry point %s: %s' % (entry_point.name, ex))
+            continue
+        if isinstance(loaded, type) and issubclass(loaded, Metric):
+            entry_point_metrics.append(loaded)
+    # in order of definition, built-in metrics first
+    for metric_class in _get_subclasses(Metric):
+        if metric_class.__name__.startswith('Metric') and not metric_class._meta.abstract:
+            _metrics.setdefault(metric_class.__name__, metric_class)
+    for metric_class in entry_point_metrics:
+        _metrics.setdefault(metric_class.__name__, metric_class)
+    _build_meta()
+    logger.debug('Registered %d metrics' % len(_metrics))
+
+
+def get_metrics(limit_target=None):
+    """ Metric classes that can be computed on the kind of target """
+    return [_metrics[m['name']] for m in _meta.get(limit_target, _meta.get(None, []))]
+
+
+def get_metrics_meta(limit_target=None):
+    """ Name, description, target type and templates of the metrics that can be computed on the kind of target """
+    return list(_meta.get(limit_target, _meta.get(None, [])))
+
+
+def get_metric(name):
+    """ Metric class with the name, or None """
+    return _metrics.get(name)
@@ -0,0 +1,84 @@
+"""
+Declarative boolean predicates on the attributes of users (see UserRuleMetric). A rule lists the fields it reads and
+is evaluated on the columns of all the target users at once (numpy arrays ordered by id, as returned by
+Metric.load_user_columns), so that the rules of many metrics are checked on a single scan of the users.
+Rules can be combined with & (and), | (or) and ~ (not).
+"""
+import re
+import numpy
+
+
+class Rule(object):
+    """ Predicate on the fields: predicate(*columns) returns a boolean array with an element per user """
+
+    def __init__(self, fields, predicate):
+        self.fields = tuple(fields)
+        self.predicate = predicate
+
+    def evaluate(self, columns):
+        """ Boolean array telling which users satisfy the rule, columns is a dictionary field -> array """
+        return numpy.asarray(self.predicate(*[columns[f] for f in self.fields]), dtype=bool)
+
+    def _combine(self, other, operator):
+        fields = tuple(dict.fromkeys(self.fields + other.fields))
+
+        def predicate(*values):
+            columns = dict(zip(fields, values))
+            return operator(self.evaluate(columns), other.evaluate(columns))
+        return Rule(fields, predicate)
+
+    def __and__(self, other):
+        return self._combine(other, numpy.logical_and)
+
+    def __or__(self, other):
+        return self._combine(other, numpy.logical_or)
+
+    def __invert__(self):
+        return Rule(self.fields, lambda *values: ~self.predicate(*values))
+
+
+def equals(field, value):
+    """ Users whose field is equal to value (null fields are equal only to None) """
+    return Rule([field], lambda column: numpy.array([v == value for v in column], dtype=bool))
+
+
+def is_true(field):
+    """ Users whose boolean field is True (not False nor null) """
+    return equals(field, True)
+
+
+def matches(field, pattern):
+    """ Users whose text field matches the regular expression anywhere, as the regex lookup of the database """
+    compiled = re.compile(pattern)
+    return Rule([field], lambda column: numpy.fromiter(
+        (v is not None and compiled.search(v) is not None for v in column), dtype=bool, count=len(column)))
+
+
+def within_days(field, days, reference):
+    """
+    Users whose datetime field (datetime64 column) is at most days before the reference: the name of another
+    datetime field, or a datetime64. Null datetimes do not satisfy the rule
+    """
+    window = numpy.timedelta64(days, 'D')
+    if isinstance(reference, str):
+        return Rule([field, reference], lambda column, references: ~numpy.isnat(column) & (
+            column >= references - window))
+    return Rule([field], lambda column: ~numpy.isnat(column) & (column >= reference - window))
+
+
+def at_least(field, value):
+    """ Users whose numeric field is at least value (null fields do not satisfy the rule) """
+    return Rule([field], lambda column: numpy.array(column, dtype=float) >= value)
+
+
+def ratio_at_least(numerator, denominator, threshold):
+    """
+    Users whose numerator / denominator fields ratio is at least threshold; with a denominator of 0 the ratio is
+    infinite if the numerator is positive. Null values do not satisfy the rule
+    """
+    def predicate(numerators, denominators):
+        numerators = numpy.array(numerators, dtype=float)
+        denominators = numpy.array(denominators, dtype=float)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numerators / denominators >= threshold
+    return Rule([numerator, denominator], predicate)
@@ -0,0 +1,139 @@
+"""
+Scheduling layer over the background task queues.
+Each task type has a base priority (SCHEDULER_PRIORITIES), lowered by the number of tasks of the same type that the
+same campaign has still pending: a campaign enqueuing hundreds of tasks does not delay the first task of the others.
+SCHEDULER_CONCURRENCY caps the tasks of each type running at once across all the task runner processes: running tasks
+are counted from their ScheduledTask rows, and a task finding no free slot is enqueued again SCHEDULER_CAPPED_DELAY
+seconds later instead of holding a task runner thread while it waits. Capped tasks hitting a finer cap while running
+(e.g. the metrics queues of twitter.executors) raise CapReached to be enqueued again in the same way.
+Queue wait times are recorded in ScheduledTask when tasks complete.
+"""
+import logging
+import threading
+
+from datetime import timedelta
+from functools import wraps
+from background_task.models import Task
+from background_task.settings import app_settings
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+TASK_METRIC = 'metric'
+TASK_METRIC_BULK = 'metric-bulk'
+TASK_OPERATION = 'operation'
+
+# priorities of a type never fall into the band of the type below
+MAX_PRIORITY_PENALTY = 999
+
+# ScheduledTask of the capped task running in the thread, if any
+_running = threading.local()
+
+
+class CapReached(Exception):
+    """ Raised by a capped task that cannot go on for lack of a free slot, so that it is enqueued again """
+    pass
+
+
+def can_reschedule():
+    """ Whether the task running in the thread is enqueued again on CapReached (otherwise it has to wait) """
+    return getattr(_running, 'scheduled_task', None) is not None
+
+
+def get_priority(task_type, campaign):
+    from twitter.models import ScheduledTask
+    pending = ScheduledTask.objects.filter(
+        task_type=task_type, campaign=campaign, finished_at__isnull=True).count() if campaign else 0
+    return settings.SCHEDULER_PRIORITIES[task_type] - min(pending, MAX_PRIORITY_PENALTY)
+
+
+def schedule(task, task_type, campaign, *args, **kwargs):
+    """
+    Schedules the background task with the fair priority of the campaign for the type, returns the Task.
+    The task receives the id of its ScheduledTask, consumed by capped
+    """
+    from twitter.models import ScheduledTask
+    priority = get_priority(task_type, campaign)
+    with transaction.atomic():
+        scheduled_task = ScheduledTask.objects.create(
+            task_id=0, task_name='', task_type=task_type, campaign=campaign, priority=priority)
+        background_task = task(*args, priority=priority, scheduled_task_id=scheduled_task.id, **kwargs)
+        scheduled_task.task_id = background_task.id
+        scheduled_task.task_name = background_task.verbose_name or background_task.task_name
+        scheduled_task.queue = background_task.queue
+        scheduled_task.run_at = background_task.run_at
+        scheduled_task.save()
+    logger.debug('Scheduled %s task %s with priority %d' % (task_type, background_task.task_name, priority))
+    return background_task
+
+
+def _get_running(task_type):
+    from twitter.models import ScheduledTask
+    # tasks of runners that died are not counted once their lock expires
+    since = timezone.now() - timedelta(seconds=app_settings.BACKGROUND_TASK_MAX_RUN_TIME)
+    return ScheduledTask.objects.filter(task_type=task_type, running_since__gt=since)
+
+
+def acquire(scheduled_task):
+    """
+    Marks the task as running if fewer than SCHEDULER_CONCURRENCY tasks of its type are: all the tasks mark themselves
+    first, then the ones coming after the first SCHEDULER_CONCURRENCY unmark themselves, so that no lock is needed
+    """
+    running_since = timezone.now()
+    type(scheduled_task).objects.filter(pk=scheduled_task.pk).update(running_since=running_since)
+    ahead = _get_running(scheduled_task.task_type).filter(
+        Q(running_since__lt=running_since) | Q(running_since=running_since, pk__lt=scheduled_task.pk)).count()
+    if ahead < settings.SCHEDULER_CONCURRENCY[scheduled_task.task_type]:
+        return True
+    release(scheduled_task)
+    return False
+
+
+def release(scheduled_task):
+    type(scheduled_task).objects.filter(pk=scheduled_task.pk).update(running_since=None)
+
+
+def reschedule(scheduled_task, task_name, args, kwargs):
+    """ Enqueues the task again SCHEDULER_CAPPED_DELAY seconds from now, keeping its ScheduledTask """
+    task = Task.objects.new_task(
+        task_name, args, dict(kwargs, scheduled_task_id=scheduled_task.pk),
+        run_at=timezone.now() + timedelta(seconds=settings.SCHEDULER_CAPPED_DELAY), priority=scheduled_task.priority,
+        queue=scheduled_task.queue, verbose_name=scheduled_task.task_name)
+    task.save()
+    # the wait since the first run_at is still recorded
+    type(scheduled_task).objects.filter(pk=scheduled_task.pk).update(task_id=task.id)
+    return task
+
+
+def capped(f):
+    """
+    Decorator of the background tasks run within the concurrency cap of their type: the task is enqueued again if no
+    slot is free, or if it raises CapReached. Tasks not scheduled through schedule (e.g. run with .now()) are not capped
+    """
+    task_name = '%s.%s' % (f.__module__, f.__name__)
+
+    @wraps(f)
+    def wrapper(*args, scheduled_task_id=None, **kwargs):
+        from twitter.models import ScheduledTask
+        scheduled_task = ScheduledTask.objects.filter(pk=scheduled_task_id).first() if scheduled_task_id else None
+        if scheduled_task is None:
+            return f(*args, **kwargs)
+        if not acquire(scheduled_task):
+            logger.debug('Concurrency cap reached for %s tasks, rescheduling %s' % (
+                scheduled_task.task_type, scheduled_task.task_name))
+            reschedule(scheduled_task, task_name, args, kwargs)
+            return None
+        _running.scheduled_task = scheduled_task
+        try:
+            return f(*args, **kwargs)
+        except CapReached as ex:
+            logger.debug('%s, rescheduling %s' % (ex, scheduled_task.task_name))
+            reschedule(scheduled_task, task_name, args, kwargs)
+            return None
+        finally:
+            _running.scheduled_task = None
+            release(scheduled_task)
+    return wrapper
@@ -0,0 +1,175 @@
+"""
+On disk columnar snapshots of the targets of the metrics.
+The columns read by a metric (see Metric.load_user_columns) are saved in a directory named after the target
+fingerprint, one file per column with the rows ordered by primary key, so that later metrics on the same target
+read them without querying the database. Numeric, boolean and datetime columns are memory mapped .npy files; columns
+of Python objects (values with nulls) are saved without pickling in .npz files, as UTF-8 bytes and offsets for texts
+or as values and a null mask for numbers and booleans, and are loaded in memory.
+Snapshots taken more than TARGET_SNAPSHOT_MAX_AGE seconds ago are taken again when read and removed by evict(), as
+well as the least recently used ones when all the snapshots take more than TARGET_SNAPSHOT_MAX_SIZE bytes. Values
+changed after a snapshot was taken (e.g. the counters of users hydrated again) are seen by the metrics only after it
+expires.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+from django.conf import settings
+
+from twitter import stats
+
+logger = logging.getLogger(__name__)
+
+# suffix of the files holding columns of Python objects, which cannot be memory mapped
+OBJECT_SUFFIX = '.object.npz'
+
+
+def _get_path(key):
+    return os.path.join(settings.TARGET_SNAPSHOT_DIR, key)
+
+
+def _encode(column):
+    """ Arrays (without Python objects) holding a column of texts, numbers or booleans with null values """
+    nulls = numpy.fromiter((v is None for v in column), dtype=bool, count=len(column))
+    values = [v for v in column if v is not None]
+    if all(isinstance(v, str) for v in values):
+        data = [b'' if v is None else v.encode('utf-8') for v in column]
+        offsets = numpy.zeros(len(data) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(d) for d in data], out=offsets[1:])
+        return {'nulls': nulls, 'offsets': offsets, 'data': numpy.frombuffer(b''.join(data), dtype=numpy.uint8)}
+    for value_type in (bool, int, float):
+        if all(type(v) is value_type for v in values):
+            return {'nulls': nulls, 'values': numpy.array([value_type() if v is None else v for v in column],
+                                                          dtype=value_type)}
+    raise ValueError('Column values of types %s cannot be saved' % ', '.join(sorted({type(v).__name__ for v in values})))
+
+
+def _decode(arrays):
+    if 'offsets' in arrays:
+        data = arrays['data'].tobytes()
+        offsets = arrays['offsets']
+        column = numpy.empty(len(offsets) - 1, dtype=object)
+        column[:] = [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(column))]
+    else:
+        column = arrays['values'].astype(object)
+    column[arrays['nulls']] = None
+    return column
+
+
+def _load(directory, field):
+    path = os.path.join(directory, field)
+    if os.path.exists(path + '.npy'):
+        return numpy.load(path + '.npy', mmap_mode='r')
+    with numpy.load(path + OBJECT_SUFFIX, allow_pickle=False) as arrays:
+        return _decode(arrays)
+
+
+def _save(directory, field, column):
+    arrays = _encode(column) if column.dtype.hasobject else None
+    [fd, tmp] = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if arrays is None:
+                numpy.save(f, column, allow_pickle=False)
+            else:
+                numpy.savez(f, **arrays)
+        os.replace(tmp, os.path.join(directory, field) + ('.npy' if arrays is None else OBJECT_SUFFIX))
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def _expire(directory):
+    """ Removes the snapshot if it was taken more than TARGET_SNAPSHOT_MAX_AGE seconds ago """
+    try:
+        created = _get_stats(directory)[0]
+    except OSError:
+        return
+    if time.time() - created > settings.TARGET_SNAPSHOT_MAX_AGE:
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.debug('Snapshot %s expired' % os.path.basename(directory))
+
+
+def get_columns(key, queryset, fields):
+    """
+    Arrays with the values of the fields for the rows of the queryset (see stats.load_target_columns), taken from
+    the snapshot identified by key when available. Columns missing from the snapshot are loaded with a single query
+    and added to it. Without a key, or if TARGET_SNAPSHOT_DIR is not set, columns are read from the database
+    """
+    if not key or not settings.TARGET_SNAPSHOT_DIR:
+        return stats.load_target_columns(queryset, *fields)
+    directory = _get_path(key)
+    _expire(directory)
+    columns = {}
+    for field in fields:
+        try:
+            columns[field] = _load(directory, field)
+        except (OSError, ValueError):
+            continue
+    missing = [f for f in fields if f not in columns]
+    if missing:
+        loaded = stats.load_target_columns(queryset, *missing)
+        columns.update(zip(missing, loaded))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for [field, column] in zip(missing, loaded):
+                try:
+                    _save(directory, field, column)
+                except ValueError as ex:
+                    logger.debug('Column %s not saved in snapshot %s: %s' % (field, key, ex))
+            logger.debug('Saved columns %s in snapshot %s' % (', '.join(missing), key))
+        except OSError as ex:
+            logger.error('Cannot save snapshot %s: %s' % (key, ex))
+        evict()
+    else:
+        logger.debug('Columns %s read from snapshot %s' % (', '.join(fields), key))
+    try:
+        # the modification time of the directory is the last use of the snapshot
+        os.utime(directory)
+    except OSError:
+        pass
+    return [columns[f] for f in fields]
+
+
+def _get_stats(directory):
+    """ Time the oldest column was saved and total size of the files of a snapshot """
+    created = time.time()
+    size = 0
+    for name in os.listdir(directory):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        created = min(created, stat.st_mtime)
+        size += stat.st_size
+    return created, size
+
+
+def evict():
+    """ Removes the expired snapshots, then the least recently used ones until they fit in TARGET_SNAPSHOT_MAX_SIZE """
+    root = settings.TARGET_SNAPSHOT_DIR
+    if not root or not os.path.isdir(root):
+        return 0
+    snapshots = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            snapshots.append((os.path.getmtime(path), *_get_stats(path), path))
+        except OSError:
+            continue
+    now = time.time()
+    total = 0
+    removed = 0
+    for [last_use, created, size, path] in sorted(snapshots, reverse=True):
+        total += size
+        if now - created > settings.TARGET_SNAPSHOT_MAX_AGE or total > settings.TARGET_SNAPSHOT_MAX_SIZE:
+            # processes still reading the memory mapped files keep them until they are done
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    if removed:
+        logger.debug('Removed %d target snapshots' % removed)
+    return removed
@@ -0,0 +1,132 @@
+"""
+Vectorized statistics for the metrics looking for outliers among users, and sampling of the targets of the metrics
+estimating their value on a sample.
+Columns are read once with values_list into numpy arrays, so computations do not depend on the aggregates
+supported by the database backend and do not instantiate a model object per user.
+"""
+import math
+import numpy
+
+from datetime import timezone
+from statistics import NormalDist
+from django.db import models
+
+# rows fetched at once from the database cursor
+FETCH_SIZE = 10000
+# 0.75 quantile of the standard normal distribution, relating the median absolute deviation to the standard one
+MAD_SCALE = 0.6745
+
+
+def load_columns(queryset, *fields, order_by=()):
+    """ Returns a numpy array for each field, holding its values for all the rows of the queryset """
+    rows = queryset.order_by(*order_by).values_list(*fields).iterator(chunk_size=FETCH_SIZE)
+    columns = list(zip(*rows))
+    if not columns:
+        return [numpy.array([]) for _ in fields]
+    return [numpy.array(column) for column in columns]
+
+
+def load_target_columns(queryset, *fields):
+    """
+    Like load_columns, with the rows ordered by primary key (so that columns loaded separately are aligned) and the
+    values of datetime fields in datetime64 arrays
+    """
+    columns = load_columns(queryset, *fields, order_by=('pk',))
+    return [datetimes64(column) if isinstance(queryset.model._meta.get_field(field), models.DateTimeField)
+            else column for [field, column] in zip(fields, columns)]
+
+
+def datetimes64(datetimes):
+    """ Array of datetime64 (UTC, microseconds) of aware datetimes, NaT for None """
+    return numpy.array([None if d is None else d.astimezone(timezone.utc).replace(tzinfo=None) for d in datetimes],
+                       dtype='datetime64[us]')
+
+
+def describe(values, ddof=0):
+    """ Mean, standard deviation (ddof=1 for the sample one), median and median absolute deviation """
+    if len(values) == 0:
+        return {'count': 0, 'mean': 0, 'std': 0, 'median': 0, 'mad': 0}
+    median = numpy.median(values)
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'std': float(values.std(ddof=ddof)) if len(values) > ddof else 0,
+        'median': float(median),
+        'mad': float(numpy.median(numpy.abs(values - median))),
+    }
+
+
+def zscore_outliers(values, how_many_std, ddof=0):
+    """ Mask of the values farther than how_many_std standard deviations from the mean """
+    stats = describe(values, ddof=ddof)
+    return numpy.abs(values - stats['mean']) > how_many_std * stats['std'], stats
+
+
+def mad_outliers(values, threshold=3.5):
+    """ Mask of the values whose modified z-score (based on median and MAD, Iglewicz and Hoaglin) exceeds threshold """
+    stats = describe(values)
+    if stats['mad'] == 0:
+        return numpy.zeros(len(values), dtype=bool), stats
+    modified_z = MAD_SCALE * (values - stats['median']) / stats['mad']
+    return numpy.abs(modified_z) > threshold, stats
+
+
+def stratified_sample(strata, size, seed=0):
+    """
+    Draws a sample of size elements (all of them if there are fewer) from the elements whose strata are given, at
+    random without replacement within each stratum; the sample of each stratum is proportional to its size, the
+    remaining elements going to the strata with the largest remainders. The same seed gives the same sample.
+    Returns the sorted indexes of the sampled elements and a dictionary stratum -> number of its elements
+    """
+    strata = numpy.asarray(strata)
+    if len(strata) == 0:
+        return numpy.array([], dtype=int), {}
+    size = min(max(size, 0), len(strata))
+    [keys, inverse, counts] = numpy.unique(strata, return_inverse=True, return_counts=True)
+    generator = numpy.random.RandomState(seed)
+    quotas = counts * size / len(strata)
+    allocation = numpy.floor(quotas).astype(int)
+    # ties between remainders (e.g. many strata of the same size) are broken at random
+    order = generator.permutation(len(keys))
+    allocation[order[numpy.argsort((allocation - quotas)[order], kind='stable')][:size - allocation.sum()]] += 1
+    members = numpy.split(numpy.argsort(inverse.ravel(), kind='stable'), numpy.cumsum(counts)[:-1])
+    indexes = numpy.concatenate([generator.permutation(m)[:n] for [m, n] in zip(members, allocation)])
+    return numpy.sort(indexes), {k: int(c) for [k, c] in zip(keys.tolist(), counts)}
+
+
+def stratified_estimate(values, strata, population_sizes, confidence=0.95):
+    """
+    Estimate of the mean of values between 0 and 1 (e.g. 1 for tagged elements and 0 for the others, for a
+    proportion) over a population, from their values for a stratified random sample of it. strata holds the
+    stratum of each sampled value, population_sizes the number of elements of each stratum in the population.
+    Strata are weighted by their size and the variance includes the finite population correction (strata with a
+    single sampled element get the variance of the whole sample). The interval is the Wilson score interval for the
+    effective sample size, so that it stays within [0, 1] and is not empty for proportions close to 0 or 1.
+    Returns the estimate and the bounds of the interval
+    """
+    values = numpy.asarray(values, dtype=float)
+    strata = numpy.asarray(strata)
+    if len(values) == 0:
+        return 0.0, 0.0, 1.0
+    [keys, inverse, counts] = numpy.unique(strata, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    sizes = numpy.array([population_sizes.get(k, 0) for k in keys.tolist()], dtype=float)
+    sizes = numpy.maximum(sizes, counts)
+    weights = sizes / sizes.sum()
+    means = numpy.bincount(inverse, weights=values) / counts
+    estimate = float((weights * means).sum())
+    pooled = values.var(ddof=1) if len(values) > 1 else estimate * (1 - estimate)
+    deviations = numpy.bincount(inverse, weights=(values - means[inverse]) ** 2)
+    variances = numpy.where(counts > 1, deviations / numpy.maximum(counts - 1, 1), pooled)
+    variance = float((weights ** 2 * (1 - counts / sizes) * variances / counts).sum())
+    sampled = counts.sum() / sizes.sum()
+    if sampled >= 1:
+        return estimate, estimate, estimate
+    if variance > 0 and 0 < estimate < 1:
+        n = estimate * (1 - estimate) / variance
+    else:
+        n = counts.sum() / (1 - sampled)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    center = (estimate + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z / (1 + z ** 2 / n) * math.sqrt(estimate * (1 - estimate) / n + z ** 2 / (4 * n ** 2))
+    return estimate, max(center - half_width, 0.0), min(center + half_width, 1.0)
@@ -1,15 +1,68 @@
 import logging
+import requests
 import tweepy
 import threading
 import time
 
 from datetime import timedelta
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from background_task import background
 
+from twitter import api_cache, scheduler
+from twitter.executors import run_metric_batch_computation, run_metric_computation
+
 logger = logging.getLogger(__name__)
 
+# max number of users that can be requested to the users/lookup endpoint at once
+USERS_LOOKUP_SIZE = 100
+
+# tweepy.API clients shared by all the threads of the process, see get_cached_twitter_api
+_twitter_apis = {}
+_twitter_apis_lock = threading.Lock()
+
+
+def _new_twitter_api(api_keys):
+    auth = tweepy.OAuthHandler(api_keys['consumer_key'], api_keys['consumer_secret'])
+    auth.set_access_token(api_keys['access_token'], api_keys['access_token_secret'])
+    api = tweepy.API(auth, wait_on_rate_limit=True)
+    # tweepy >= 4 keeps a single requests session per client: size its pool so that concurrent
+    # tasks using the same account reuse keep-alive connections instead of opening new ones
+    session = getattr(api, 'session', None)
+    if session is not None:
+        pool_size = getattr(settings, 'TWITTER_API_POOL_MAXSIZE', 10)
+        if settings.TWITTER_FAKE_API_URL:
+            from twitter.fake_api import redirect_session
+            redirect_session(session, settings.TWITTER_FAKE_API_URL, pool_connections=1, pool_maxsize=pool_size)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+    return api
+
+
+def get_cached_twitter_api(api_keys, account_id=None):
+    """
+    Returns a tweepy.API for the given keys, creating it only the first time it is requested in this process.
+    Clients are cached by account id when given (by keys otherwise) and are rebuilt when the keys change
+    """
+    credentials = (api_keys['consumer_key'], api_keys['consumer_secret'],
+                   api_keys['access_token'], api_keys['access_token_secret'])
+    cache_key = credentials if account_id is None else account_id
+    with _twitter_apis_lock:
+        cached = _twitter_apis.get(cache_key)
+        if cached is None or cached[0] != credentials:
+            cached = (credentials, _new_twitter_api(api_keys))
+            _twitter_apis[cache_key] = cached
+    return cached[1]
+
+
+def forget_twitter_api(account_id):
+    """ Drops the cached client of an account, e.g. after its credentials have been changed or removed """
+    with _twitter_apis_lock:
+        _twitter_apis.pop(account_id, None)
+
 
 @background(queue='streamers-queue')
 def background_stream(streamer_id):
@@ -88,6 +141,9 @@ def background_stream(streamer_id):
                     myStreamListener.set_entities(tracking_entities)
                     logger.warning("[*] Starting tracking streamer for entities %s " % tracking_terms)
                     myStreamListener.set_tweepy_stream(myStreamListener, streamer.id)
+                    if settings.TWITTER_FAKE_API_URL:
+                        from twitter.fake_api import redirect_session
+                        myStreamListener.session = redirect_session(requests.Session(), settings.TWITTER_FAKE_API_URL)
                     myStreamListener.filter(track=tracking_terms)
             except Exception as ex:
                 logger.error('Exception during streamer %d attempt for %s' % (attempts, streamer))
@@ -101,7 +157,7 @@ def get_ids_from_names(api, screen_names):
     todo = screen_names
     try:
         for screen_name in todo:
-            user = api.get_user(screen_name)
+            user = api_cache.get_user(api, screen_name=screen_name)
             ids.append(user.id_str)
             todo.remove(screen_name)
     except tweepy.TweepError as ex:
@@ -151,13 +207,29 @@ def _get_friends(api, id_str, max_users=0):
     return friends
 
 
+def _start_chunk(chunk_id):
+    """ Returns the OperationChunk the task is working on (if any), marking it as running """
+    from .models import OperationChunk
+
+    if chunk_id == -1:
+        return None
+    chunk = OperationChunk.objects.get(pk=chunk_id)
+    chunk.start()
+    return chunk
+
+
+def _get_chunk_api(campaign, chunk):
+    """ Chunks may be assigned to a different account than the campaign one, to spread rate limits """
+    if chunk is not None and chunk.account is not None:
+        return chunk.account.get_twitter_api()
+    return campaign.get_twitter_api()
+
+
 @background(queue='operations')
 def get_user_timeline(api_keys, id_str, max_tweets=1000):
     from .models import Tweet
 
-    auth = tweepy.OAuthHandler(api_keys['consumer_key'], api_keys['consumer_secret'])
-    auth.set_access_token(api_keys['access_token'], api_keys['access_token_secret'])
-    api = tweepy.API(auth, wait_on_rate_limit=True)
+    api = get_cached_twitter_api(api_keys)
 
     for status in limit_handled(tweepy.Cursor(api.user_timeline, id=id_str).items(max_tweets)):
         logger.debug(status)
@@ -166,13 +238,15 @@ def get_user_timeline(api_keys, id_str, max_tweets=1000):
 
 
 @background(queue='operations')
+@scheduler.capped
 def get_users_followers(
-        campaign_slug, twitter_users, max_users=0, days_interval=30, operation_id=-1, max_followers=-1):
+        campaign_slug, twitter_users, max_users=0, days_interval=30, operation_id=-1, max_followers=-1, chunk_id=-1):
     from .models import TwitterUser, Campaign
     from twitter.models.operations import OperationConstructNetwork
 
     campaign = Campaign.objects.get(slug=campaign_slug)
-    api = campaign.get_twitter_api()
+    chunk = _start_chunk(chunk_id)
+    api = _get_chunk_api(campaign, chunk)
 
     for uid in twitter_users:
         user = TwitterUser.objects.get(pk=int(uid))
@@ -193,7 +267,11 @@ def get_users_followers(
                 user.followers.add(u)
             user.followers_filled = timezone.now()
             user.save()
-    if operation_id != -1:
+        if chunk is not None:
+            chunk.inc_done()
+    if chunk is not None:
+        OperationConstructNetwork.objects.get(pk=operation_id).chunk_finished(chunk.id)
+    elif operation_id != -1:
         with transaction.atomic():
             operation = OperationConstructNetwork.objects.select_for_update().get(pk=operation_id)
             operation.followers_filled = True
@@ -201,15 +279,20 @@ def get_users_followers(
             logger.debug(
                 'Getting followers for operation %d finished at %s' % (operation_id, operation.computation_end))
             operation.save()
+            if operation.is_finished():
+                operation.trigger_dependent_metrics()
 
 
 @background(queue='operations')
-def get_users_friends(campaign_slug, twitter_users, max_users=0, days_interval=30, operation_id=-1, max_friends=-1):
+@scheduler.capped
+def get_users_friends(
+        campaign_slug, twitter_users, max_users=0, days_interval=30, operation_id=-1, max_friends=-1, chunk_id=-1):
     from .models import TwitterUser, Campaign
     from twitter.models.operations import OperationConstructNetwork
 
     campaign = Campaign.objects.get(slug=campaign_slug)
-    api = campaign.get_twitter_api()
+    chunk = _start_chunk(chunk_id)
+    api = _get_chunk_api(campaign, chunk)
 
     for uid in twitter_users:
         user = TwitterUser.objects.get(pk=int(uid))
@@ -229,23 +312,31 @@ def get_users_friends(campaign_slug, twitter_users, max_users=0, days_interval=3
                 user.friends.add(u)
             user.friends_filled = timezone.now()
             user.save()
-    if operation_id != -1:
+        if chunk is not None:
+            chunk.inc_done()
+    if chunk is not None:
+        OperationConstructNetwork.objects.get(pk=operation_id).chunk_finished(chunk.id)
+    elif operation_id != -1:
         with transaction.atomic():
             operation = OperationConstructNetwork.objects.select_for_update().get(pk=operation_id)
             operation.friends_filled = True
             operation.computation_end = timezone.now()
             logger.debug('Getting friends for operation %d finished at %s' % (operation_id, operation.computation_end))
             operation.save()
+            if operation.is_finished():
+                operation.trigger_dependent_metrics()
 
 
 @background(queue='operations')
-def get_tweets(campaign_slug, twitter_users, max_tweets=0, operation_id=-1, days_interval=30):
+@scheduler.capped
+def get_tweets(campaign_slug, twitter_users, max_tweets=0, operation_id=-1, days_interval=30, chunk_id=-1):
     from .models import Tweet
     from .models import TwitterUser, Campaign
     from twitter.models.operations import OperationRetrieveTweets
 
     campaign = Campaign.objects.get(slug=campaign_slug)
-    api = campaign.get_twitter_api()
+    chunk = _start_chunk(chunk_id)
+    api = _get_chunk_api(campaign, chunk)
 
     for uid in twitter_users:
         user = TwitterUser.objects.get(pk=uid)
@@ -261,8 +352,12 @@ def get_tweets(campaign_slug, twitter_users, max_tweets=0, operation_id=-1, days
                 counter += 1
                 if counter >= max_tweets:
                     break
+        if chunk is not None:
+            chunk.inc_done()
 
-    if operation_id != -1:
+    if chunk is not None:
+        OperationRetrieveTweets.objects.get(pk=operation_id).chunk_finished(chunk.id)
+    elif operation_id != -1:
         with transaction.atomic():
             operation = OperationRetrieveTweets.objects.select_for_update().get(pk=operation_id)
             operation.finished = True
@@ -270,17 +365,80 @@ def get_tweets(campaign_slug, twitter_users, max_tweets=0, operation_id=-1, days
             logger.debug(
                 'Getting tweets for operation %d finished at %s' % (operation_id, operation.computation_end))
             operation.save()
+            if operation.is_finished():
+                operation.trigger_dependent_metrics()
+
+
+def _lookup_users(api, ids, window_limit=15):
+    """ Returns the profiles of at most 100 users with a single call to the users/lookup endpoint """
+    while True:
+        try:
+            return api.lookup_users(user_ids=ids)
+        except tweepy.RateLimitError:
+            logger.debug('Lookup rate reached. Sleeping %d minutes' % window_limit)
+            time.sleep(window_limit * 60)
+        except tweepy.error.TweepError as ex:
+            if ex.api_code == 17:
+                # none of the ids matches an existing user
+                return []
+            raise ex
+
+
+@background(queue='operations')
+@scheduler.capped
+def hydrate_users(campaign_slug, twitter_users, operation_id=-1, chunk_id=-1):
+    from .models import TwitterUser, Campaign
+    from twitter.models.operations import OperationHydrateUsers
+
+    campaign = Campaign.objects.get(slug=campaign_slug)
+    chunk = _start_chunk(chunk_id)
+    api = _get_chunk_api(campaign, chunk)
+
+    for start in range(0, len(twitter_users), USERS_LOOKUP_SIZE):
+        ids = [int(uid) for uid in twitter_users[start:start + USERS_LOOKUP_SIZE]]
+        status_users = _lookup_users(api, ids)
+        api_cache.remember_users(status_users)
+        hydrated = TwitterUser.bulk_from_statuses(status_users)
+        missing = set(ids) - set(u.id for u in status_users)
+        if missing:
+            TwitterUser.objects.filter(pk__in=missing).update(unresolvable=True)
+        logger.debug('Hydrated %d users, %d could not be resolved' % (len(hydrated), len(missing)))
+        if chunk is not None:
+            chunk.inc_done(len(ids))
+
+    if chunk is not None:
+        OperationHydrateUsers.objects.get(pk=operation_id).chunk_finished(chunk.id)
 
 
 @background(queue='metrics-computation')
-def background_metric(metric_id, start):
+@scheduler.capped
+def background_metric(metric_id, start, since=None):
     from .models import Metric
     metric = Metric.objects.get_subclass(pk=metric_id)
     logger.info('Starting computation for metric %s [%d]' % (metric.name, metric.id))
     if start:
         metric.start()
-    if metric._computation():
+    computed = run_metric_computation(metric, since=parse_datetime(since) if since else None)
+    if computed:
         metric.stop()
         logger.info('Computation finished for metric %s [%d]' % (metric.name, metric.id))
     else:
         logger.warning('Metric computation returned False')
+
+
+@background(queue='metrics-computation')
+@scheduler.capped
+def background_metric_batch(metric_ids, start):
+    from .models import MetricBatch
+    batch = MetricBatch.get(metric_ids)
+    logger.info('Starting computation for metrics %s in batch' % ', '.join(
+        '%s [%d]' % (m.name, m.id) for m in batch.metrics))
+    if start:
+        batch.start()
+    results = run_metric_batch_computation(batch)
+    for metric in batch.metrics:
+        if results.get(metric.id):
+            metric.stop()
+            logger.info('Computation finished for metric %s [%d]' % (metric.name, metric.id))
+        else:
+            logger.warning('Computation of metric %s [%d] returned False' % (metric.name, metric.id))
@@ -38,8 +38,7 @@ def counter_update(obj_id,args):
 	"""
 	return mark_safe(script)
 
-@register.filter
-def distribution_chart(distribution):
+def _distribution_script(frequency, labels, data_points):
 
 	string_daily ="""<script>
 var ctx = document.getElementById('{css_id}').getContext('2d');
@@ -101,26 +100,17 @@ var myChart = new Chart(ctx, {{
 }});
 </script>"""
 
-	weekdays = ['"Sunday"', '"Monday"', '"Tuesday"', '"Wednesday"', '"Thursday"', '"Friday"', '"Saturday"']
-
-	if distribution.frequency == 'w':
-		data_points = ','.join(str(x) for x in distribution.labeled_data_points.values_list('counter',flat=True))
-		labels = ','.join(str(weekdays[x-1]) for x in distribution.labeled_data_points.values_list('label',flat=True))
+	if frequency == 'w':
 		frequency_label = 'weekly'
 		css_id = 'myChartWeekly'
 		chart_style = 'horizontalBar'
 		string = string_weekly
-	elif distribution.frequency == 'h':
-		data_points = ','.join(str(x) for x in distribution.labeled_data_points.values_list('counter',flat=True))
-		labels = ','.join('"%s"' % x for x in distribution.labeled_data_points.values_list('label',flat=True))
+	elif frequency == 'h':
 		frequency_label = 'hourly'
 		css_id = 'myChartHourly'
 		chart_style = 'bar'
 		string = string_weekly
-
-	elif distribution.frequency == 'd':
-		data_points = ','.join(str(x) for x in distribution.dated_data_points.values_list('counter',flat=True))
-		labels = ','.join('"%s"' % x.strftime('%Y-%m-%d') for x in distribution.dated_data_points.values_list('date',flat=True))
+	elif frequency == 'd':
 		frequency_label = 'daily'
 		css_id = 'myChartDaily'
 		chart_style = 'line'
@@ -128,15 +118,45 @@ var myChart = new Chart(ctx, {{
 	else:
 		return ''
 
-	string = string.format(
+	return string.format(
 		chart_style=chart_style,
 		css_id=css_id,
-		labels=labels,
+		labels=','.join(labels),
 		frequency_label=frequency_label,
-		data_points=data_points
+		data_points=','.join(str(x) for x in data_points)
 	)
 
-	return mark_safe(string)
+
+WEEKDAYS = ['"Sunday"', '"Monday"', '"Tuesday"', '"Wednesday"', '"Thursday"', '"Friday"', '"Saturday"']
+
+
+@register.filter
+def distribution_chart(distribution):
+	if distribution.frequency in ['w', 'h']:
+		points = distribution.labeled_data_points.values_list('label', 'counter')
+		if distribution.frequency == 'w':
+			labels = [WEEKDAYS[x-1] for [x, _] in points]
+		else:
+			labels = ['"%s"' % x for [x, _] in points]
+	elif distribution.frequency == 'd':
+		points = distribution.dated_data_points.values_list('date', 'counter')
+		labels = ['"%s"' % x.strftime('%Y-%m-%d') for [x, _] in points]
+	else:
+		return ''
+	data_points = [counter for [_, counter] in points]
+	return mark_safe(_distribution_script(distribution.frequency, labels, data_points))
+
+
+@register.filter
+def rollup_charts(distributions):
+	""" Daily, hourly and weekday charts from the output of TweetRollup.get_distributions """
+	daily = _distribution_script(
+		'd', ['"%s"' % d.strftime('%Y-%m-%d') for [d, _] in distributions['daily']],
+		[total for [_, total] in distributions['daily']])
+	hourly = _distribution_script('h', ['"%d"' % h for h in range(24)], distributions['hourly'])
+	# weekdays are counted from Monday
+	weekly = _distribution_script('w', WEEKDAYS[1:] + WEEKDAYS[:1], distributions['weekly'])
+	return mark_safe(daily + hourly + weekly)
 
 
 
@@ -0,0 +1,47 @@
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from twitter.models import Campaign, MetricGraphTweetNetwork, MetricTweetTimeDistribution, Tweet, TwitterUser
+
+
+class SelectionDashboardTest(TestCase):
+    def setUp(self):
+        self.campaign = Campaign.objects.create(name='campaign')
+        TwitterUser.objects.create(id_int=1, id_str='1', filled=True, screen_name='user')
+        # ids whose string order differs from the numeric one
+        for pk in [999, 1001, 10000]:
+            Tweet.objects.create(id_int=pk, id_str=str(pk), author_id=1, text='text', created_at=timezone.now())
+
+    def _computed_metric(self, metric_class, tweet_ids):
+        metric = metric_class.objects.create(name='metric', campaign=self.campaign)
+        metric.set_target(tweets=tweet_ids)
+        metric.computing = False
+        metric.computation_end = timezone.now()
+        metric.save()
+        return metric
+
+    def test_finds_metrics_computed_on_the_selection(self):
+        tweet_ids = ['10000', '999', '1001']
+        distribution = self._computed_metric(MetricTweetTimeDistribution, tweet_ids)
+        graph = self._computed_metric(MetricGraphTweetNetwork, tweet_ids)
+        other = self._computed_metric(MetricTweetTimeDistribution, ['999'])
+        session = self.client.session
+        # the session holds the ids as strings
+        session['tweets'] = tweet_ids
+        session['campaign'] = str(self.campaign.id)
+        session.save()
+
+        response = self.client.get(reverse('selection_dashboard', args=['tweets']))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['distribution_metric'], distribution)
+        self.assertEqual(response.context['tweet_graph_metric'], graph)
+        metric_ids = {m.pk for m in response.context['metrics']}
+        self.assertIn(distribution.pk, metric_ids)
+        self.assertNotIn(other.pk, metric_ids)
+
+    def test_get_computed_accepts_string_ids(self):
+        distribution = self._computed_metric(MetricTweetTimeDistribution, [999, 1001, 10000])
+        self.assertEqual(MetricTweetTimeDistribution.get_computed(self.campaign, tweet_ids=['10000', '999', '1001']),
+                         distribution)
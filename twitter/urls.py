@@ -18,7 +18,9 @@ urlpatterns = [
     path('entity/<slug:slug>/', views.entity, name='entity'),
     path('campaign/', views.campaigns, name='campaigns'),
     path('campaign/<slug:campaign_slug>/', views.campaign, name='campaign'),
+    path('campaign/<slug:campaign_slug>/hydrate/', views.campaign_hydrate, name='campaign_hydrate'),
     path('campaign/<slug:campaign_slug>/datacenter/<int:data_center>/', views.campaign_datacenter, name='campaign_datacenter'),
+    path('campaign/<slug:campaign_slug>/timeline/', views.campaign_timeline, name='campaign_timeline'),
     path('manage/', views.manage_index, name='manage_index'),
     path('manage/twitter_accounts/', views.manage_twitter_accounts, name='manage_twitter_accounts'),
     path('manage/streamers/', views.manage_streamers, name='manage_streamers'),
@@ -28,6 +30,7 @@ urlpatterns = [
     path('manage/campaign/', views.manage_campaign, name='manage_campaign'),
     path('manage/campaign/<slug:campaign_slug>/', views.manage_campaign, name='manage_campaign'),
     path('metric/<int:metric_id>/', views.metric_detail, name='metric_detail'),
+    path('metric/<int:metric_id>/refresh/', views.metric_refresh, name='metric_refresh'),
     path('twitter_user/', views.twitter_users, name='twitter_users'),
     path('twitter_user/<int:id_str>/', views.twitter_user, name='twitter_user'),
     path('tweet/<int:id_str>/', views.tweet, name='tweet'),
@@ -39,6 +42,7 @@ urlpatterns = [
     path('graph/<int:id>/', views.graph, name='graph'),
     path('community/<int:community_id>/', views.community, name='community'),
     path('ajax/metric/', views.metric_compute, name='metric_compute'),
+    path('ajax/metric/batch/', views.metric_compute_batch, name='metric_compute_batch'),
     path('ajax/user_graph/', views.twitter_user_graph_detail, name='twitter_user_graph_detail'),
     path('ajax/user/', views.twitter_user_detail, name='twitter_user_detail'),
     path('ajax/tweet/', views.tweet_detail, name='tweet_detail'),
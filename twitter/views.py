@@ -2,6 +2,7 @@ import logging
 import tweepy
 import re
 
+from datetime import timedelta
 from functools import wraps
 from django.conf import settings
 from django.contrib import messages
@@ -9,6 +10,9 @@ from django.contrib.messages import get_messages
 from django.http import HttpResponse, JsonResponse, Http404
 from django.shortcuts import get_object_or_404, render, redirect
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.core.paginator import Paginator
 from django.forms import modelformset_factory
 from django.db.models import Count
@@ -21,14 +25,17 @@ from .models import Streamer
 from .models import Entity
 from .models import Campaign, Location
 from .models import TwitterUser
-from .models import Metric
+from .models import Metric, MetricBatch, get_target_fingerprint
 from .models import Tweet
 from .models import TweetSource
 from .models import URL
 from .models import Hashtag
 from .models import List
+from . import api_cache
 from .forms import EntityForm, CampaignForm, StreamerForm, TwitterAccountForm
 from .models import MetricTweetTimeDistribution, MetricGraphTweetNetwork, CommunityGraph, Community, TwitterAccount
+from .models import TweetRollup
+from .models.operations import OperationHydrateUsers
 
 logger = logging.getLogger(__name__)
 
@@ -426,6 +433,7 @@ def _get_dashboard_data(campaign, tweet_ids=None):
                 computation_end__isnull=False).order_by('-computation_end')[0]
         except Exception as ex:
             tweet_graph_metric = None
+        time_distributions = TweetRollup.get_distributions(campaign=campaign)
     else:
         # dashboard on a selected set of tweets
         tweet_ids = set(tweet_ids)
@@ -435,27 +443,14 @@ def _get_dashboard_data(campaign, tweet_ids=None):
 
         # After hours trying to understand why the filtering does not work I decided to go this way
         # I could spend some time trying to understand why, but I guess I'll just go out and have a Pastis
-        distribution_metric = None
-        tweet_graph_metric = None
-        metrics = Metric.objects.filter(tweets__in=tweets).distinct()
-        distribution_metrics = MetricTweetTimeDistribution.objects.filter(
-            tweets__in=tweets, campaign=campaign).order_by('-computation_end')
-        tweet_graph_metrics = MetricGraphTweetNetwork.objects.filter(
-            tweets__in=tweets,
-            campaign=campaign,
-            computation_end__isnull=False).order_by('-computation_end')
-        for d in distribution_metrics:
-            if d.tweets.count() == tweets.count():
-                distribution_metric = d
-                break
-        for t in tweet_graph_metrics:
-            if t.tweets.count() == tweets.count():
-                tweet_graph_metric = t
-                break
-        for m in metrics:
-            if m.tweets.count() != tweets.count():
-                metrics = metrics.exclude(id=m.id)
-                break
+        # metrics computed on exactly the selected tweets share their target fingerprint, computed on the ids of
+        # the existing tweets in the order of Metric.set_fingerprints (the session holds strings)
+        target_ids = list(tweets.order_by('pk').values_list('pk', flat=True))
+        target_fingerprint = get_target_fingerprint(campaign.id, target_ids, [])
+        metrics = Metric.objects.filter(target_fingerprint=target_fingerprint)
+        distribution_metric = MetricTweetTimeDistribution.get_computed(campaign, tweet_ids=target_ids)
+        time_distributions = None
+        tweet_graph_metric = MetricGraphTweetNetwork.get_computed(campaign, tweet_ids=target_ids)
 
     sources = TweetSource.objects.filter(tweets__in=tweets).annotate(counter=Count('name')).order_by('-counter')
     hashtags = Hashtag.objects.filter(tweets__in=tweets).annotate(counter=Count('text')).order_by('-counter')
@@ -478,6 +473,7 @@ def _get_dashboard_data(campaign, tweet_ids=None):
         'urls': urls,
         'data_centers': data_centers,
         'distribution_metric': distribution_metric,
+        'time_distributions': time_distributions,
         'tweet_graph_metric': tweet_graph_metric,
         'domains': domains,
         'available_metrics': available_metrics,
@@ -512,6 +508,40 @@ def campaign(request, campaign_slug):
     return render(request, 'campaign.html', context)
 
 
+@csrf_protect
+@require_http_methods(['POST'])
+@auth_required
+def campaign_hydrate(request, campaign_slug):
+    """ Starts an operation filling the profiles of the stub users (mentioned, replied to, followers...) of a campaign """
+    campaign = get_object_or_404(Campaign, slug=campaign_slug)
+    operation = OperationHydrateUsers.objects.create(campaign=campaign)
+    stubs = operation.run()
+    messages.add_message(request, messages.SUCCESS, 'Started hydration of %d stub users' % stubs)
+    response = _messages_response(request)
+    return JsonResponse(response)
+
+
+@require_http_methods(['GET'])
+def campaign_timeline(request, campaign_slug):
+    """
+    Number of tweets of the campaign (or of one of its entities, with GET param 'entity') by interval, read from the
+    rollups. GET params: 'step' in seconds (default one hour), 'start' and 'end' as ISO 8601 datetimes
+    """
+    campaign = get_object_or_404(Campaign, slug=campaign_slug)
+    if not campaign.active and not request.user.is_authenticated:
+        raise Http404()
+    entity = get_object_or_404(campaign.entities.all(), pk=request.GET['entity']) if 'entity' in request.GET else None
+    try:
+        step = timedelta(seconds=int(request.GET.get('step', 3600)))
+        start = parse_datetime(request.GET['start']) if 'start' in request.GET else None
+        end = parse_datetime(request.GET['end']) if 'end' in request.GET else None
+        counts = TweetRollup.get_counts(campaign=None if entity else campaign, entity=entity,
+                                        start=start, end=end, step=step)
+    except ValueError as ex:
+        return _error(str(ex), status=400)
+    return JsonResponse({'counts': [[bucket.isoformat(), total] for [bucket, total] in counts]})
+
+
 @require_http_methods(['GET'])
 def campaign_datacenter(request, campaign_slug, data_center):
     campaign = get_object_or_404(Campaign, slug=campaign_slug)
@@ -530,6 +560,8 @@ def metric_compute(request):
     The target can be set in different ways, indicated by POST param 'target':
         - selection: a list of id_str for twitter users (uid) and/or tweets (tweets)
         - whole_campaign: elements are drawn from the campaign. metric is set as campaign_wide
+    With whole_campaign, the optional POST param 'sampling' (see Metric.SAMPLING_CHOICES) computes the metric on a
+    sample of 'sample_size' elements drawn with 'sample_seed', estimating its value with a 'confidence' interval
     :param request:
     :return:
     """
@@ -560,6 +592,22 @@ def metric_compute(request):
     except:
         metric.name = '%s for campaign %s' % (request.POST['metric'], request.POST['campaign'])
 
+    if request.POST.get('sampling'):
+        if request.POST['target'] != 'whole_campaign' or \
+                request.POST['sampling'] not in metric.get_sampling_methods():
+            metric.delete()
+            return _error('Metric %s cannot be computed on a %s sample of this target' % (
+                metric_class.__name__, request.POST['sampling']))
+        try:
+            metric.sample_size = max(int(request.POST.get('sample_size', metric.sample_size)), 1)
+            metric.sample_seed = max(int(request.POST.get('sample_seed', metric.sample_seed)), 0)
+            metric.confidence = min(max(float(request.POST.get('confidence', metric.confidence)), 0.5), 0.999)
+        except ValueError:
+            metric.delete()
+            return _error('Invalid sampling parameters')
+        metric.sampling = request.POST['sampling']
+        metric.save()
+
     target_users = None
     target_tweets = None
 
@@ -574,16 +622,20 @@ def metric_compute(request):
             return _error('Missing target tweets')
         if metric.target_type == Metric.TARGET_ANY and (not target_tweets and not target_users):
             return _error('Missing target tweets or users')
+        metric.set_target(twitter_users=target_users, tweets=target_tweets)
     elif 'whole_campaign' == request.POST['target']:
-        metric.campaign_wide = True
-        if metric.target_type in [Metric.TARGET_USERS, Metric.TARGET_BOTH]:
-            target_users = campaign.get_twitter_users()
-        if metric.target_type in [Metric.TARGET_TWEETS, Metric.TARGET_BOTH, Metric.TARGET_ANY]:
-            target_tweets = campaign.get_tweets()
+        metric.set_campaign_target()
     else:
         return _error('Target selection method not implemented')
 
-    metric.set_target(twitter_users=target_users, tweets=target_tweets)
+    computed = metric.get_computed_duplicate()
+    if computed is not None:
+        metric.delete()
+        messages.add_message(request, messages.INFO, mark_safe(
+            'Metric <a href="%s">%s</a> was already computed on the same elements with the same parameters' % (
+                computed.get_absolute_url(), escape(computed.name))))
+        return JsonResponse(_messages_response(request))
+
     results = metric.compute()
     if results:
         messages.add_message(request, messages.SUCCESS, 'Computation for metric %s started' % metric.name)
@@ -596,6 +648,86 @@ def metric_compute(request):
     return JsonResponse(response)
 
 
+@csrf_protect
+@require_http_methods(['POST'])
+@auth_required
+def metric_compute_batch(request):
+    """
+    Computes several metrics (POST param 'metrics', with their default parameters) on the same target in a single
+    task, which loads the target once. The target is given as in metric_compute
+    """
+    if 'campaign' not in request.POST.keys():
+        return _error('missing compulsory fields: campaign')
+    if 'target' not in request.POST.keys():
+        return _error('missing compulsory fields: target')
+    if not request.POST.getlist('metrics'):
+        return _error('missing compulsory fields: metrics')
+    if request.POST['target'] not in ['selection', 'whole_campaign']:
+        return _error('Target selection method not implemented')
+
+    campaign = get_object_or_404(Campaign, pk=request.POST['campaign'])
+    metric_classes = [Metric.instantiate(name) for name in request.POST.getlist('metrics')]
+    if None in metric_classes:
+        return _error('Metric not found')
+    target_users = request.POST.getlist('uid') or None
+    target_tweets = request.POST.getlist('tweets') or None
+    if request.POST['target'] == 'selection':
+        for metric_class in metric_classes:
+            if metric_class.target_type in [Metric.TARGET_USERS, Metric.TARGET_BOTH] and not target_users:
+                return _error('Missing target users for metric %s' % metric_class.__name__)
+            if metric_class.target_type in [Metric.TARGET_TWEETS, Metric.TARGET_BOTH] and not target_tweets:
+                return _error('Missing target tweets for metric %s' % metric_class.__name__)
+            if metric_class.target_type == Metric.TARGET_ANY and (not target_tweets and not target_users):
+                return _error('Missing target tweets or users for metric %s' % metric_class.__name__)
+
+    metrics = []
+    for metric_class in metric_classes:
+        metric = metric_class(campaign=campaign, name='%s %s' % (metric_class.__name__, campaign.name))
+        metric.description = 'Metric %s computed for the campaign %s on %s' % (
+            metric_class.__name__, campaign.name, timezone.now())
+        metric.save()
+        metrics.append(metric)
+    batch = MetricBatch(metrics)
+    if request.POST['target'] == 'selection':
+        batch.set_target(twitter_users=target_users, tweets=target_tweets)
+    else:
+        batch.set_campaign_target()
+
+    to_compute = []
+    for metric in batch.metrics:
+        computed = metric.get_computed_duplicate()
+        if computed is not None:
+            metric.delete()
+            messages.add_message(request, messages.INFO, mark_safe(
+                'Metric <a href="%s">%s</a> was already computed on the same elements with the same parameters' % (
+                    computed.get_absolute_url(), escape(computed.name))))
+        else:
+            to_compute.append(metric)
+    if to_compute:
+        MetricBatch(to_compute).compute()
+        messages.add_message(request, messages.SUCCESS, 'Computation for metrics %s started' % ', '.join(
+            m.name for m in to_compute))
+    return JsonResponse(_messages_response(request))
+
+
+@csrf_protect
+@require_http_methods(['POST'])
+@auth_required
+def metric_refresh(request, metric_id):
+    """ Updates a campaign wide metric with the tweets collected since its last computation """
+    metric = get_object_or_404(Metric.objects.select_subclasses(), pk=metric_id)
+    if not metric.campaign_wide or not metric.is_incremental():
+        return _error('Metric %s cannot be refreshed' % metric.name)
+    if metric.computing:
+        messages.add_message(request, messages.WARNING, 'Metric %s is still being computed' % metric.name)
+    elif metric.refresh():
+        messages.add_message(request, messages.SUCCESS, 'Refresh of metric %s started' % metric.name)
+    else:
+        messages.add_message(request, messages.INFO, 'No new tweets since the last computation of %s' % metric.name)
+    response = _messages_response(request)
+    return JsonResponse(response)
+
+
 @require_http_methods(['GET'])
 def metric_detail(request, metric_id):
     metric = Metric.objects.get_subclass(pk=metric_id)
@@ -651,7 +783,7 @@ def twitter_user(request, id_str):
             if error_response is not None:
                 return error_response
             try:
-                user = api.get_user(id_str)
+                user = api_cache.get_user(api, id_str=id_str)
                 twitter_user.update_from_status(user)
                 messages.add_message(request, messages.SUCCESS,
                                      'User updated')